@@ -19,6 +19,7 @@
 package.
 
 """
+import functools
 import sys
 import warnings
 
@@ -37,6 +38,8 @@ with warnings.catch_warnings():
 from scipy import fftpack, ndimage, signal
 from scipy.signal import savgol_filter
 
+import capcalc.multiproc as ccalc_mp
+
 if pyfftwpresent:
     fftpack = pyfftw.interfaces.scipy_fftpack
     pyfftw.interfaces.cache.enable()
@@ -160,6 +163,71 @@ def ssmooth(xsize, ysize, zsize, sigma, inputdata):
     return ndimage.gaussian_filter(inputdata, [sigma / xsize, sigma / ysize, sigma / zsize])
 
 
+def _affineresamplevolumes(inputdata, voxelmap, targetshape, order):
+    # resample a 4D block of volumes in one call - the last axis maps to itself
+    thematrix = np.eye(4)
+    thematrix[:3, :3] = voxelmap[:3, :3]
+    theoffset = np.zeros((4), dtype=np.float64)
+    theoffset[:3] = voxelmap[:3, 3]
+    return ndimage.affine_transform(
+        inputdata,
+        thematrix,
+        offset=theoffset,
+        output_shape=tuple(targetshape) + (inputdata.shape[3],),
+        order=order,
+        mode="constant",
+        cval=0.0,
+    )
+
+
+def affineresample(inputdata, inputaffine, targetaffine, targetshape, order=1, nprocs=1):
+    r"""Resample 3D or 4D data onto a different voxel grid in the same world space.
+
+    Parameters
+    ----------
+    inputdata : 3D or 4D numeric array
+        The data to resample.  All volumes of a 4D array are resampled the same way.
+    inputaffine : 4x4 array
+        The voxel to world affine of the input data
+    targetaffine : 4x4 array
+        The voxel to world affine of the target grid
+    targetshape : tuple of int
+        The spatial shape of the target grid
+    order : int, optional
+        The interpolation order.  Use 0 (nearest neighbor) for labels, and 1 (linear) for
+        continuous values.  Default is 1.
+    nprocs : int, optional
+        Number of worker processes to split the volumes over.  Default is 1.
+
+    Returns
+    -------
+    outputdata : 3D or 4D numeric array
+        The resampled data, with the spatial shape targetshape.  Points that fall outside
+        of the input grid are 0.
+    """
+    voxelmap = np.linalg.inv(np.asarray(inputaffine)) @ np.asarray(targetaffine)
+    targetshape = tuple(int(thedim) for thedim in targetshape[:3])
+    is3d = inputdata.ndim == 3
+    if is3d:
+        inputdata = inputdata[:, :, :, None]
+    numvols = inputdata.shape[3]
+    thechunks = np.array_split(np.arange(numvols), min(ccalc_mp.getnprocs(nprocs), numvols))
+    outputdata = np.concatenate(
+        ccalc_mp.run_multiproc(
+            _affineresamplevolumes,
+            [
+                (inputdata[:, :, :, thechunk[0] : thechunk[-1] + 1], voxelmap, targetshape, order)
+                for thechunk in thechunks
+            ],
+            nprocs=nprocs,
+        ),
+        axis=3,
+    )
+    if is3d:
+        return outputdata[:, :, :, 0]
+    return outputdata
+
+
 # - butterworth filters
 
 
@@ -1413,6 +1481,167 @@ def arb_pass(
             )
 
 
+# --------------------------- Cached filter kernels -------------------------------------------------
+DEFAULT_FILTER_CHUNKSIZE = 10000
+
+
+@functools.lru_cache(maxsize=64)
+def _cachedtransfunc(
+    Fs, numpoints, lowerstop, lowerpass, upperpass, upperstop, passtype, transferfunc
+):
+    # build (and remember) an FFT transfer function, exactly as the arb_pass path does
+    dummydata = np.zeros(numpoints, dtype=np.float64)
+    if passtype == "lowpass":
+        thetransfunc = getlptransfunc(
+            Fs, dummydata, upperpass=upperpass, upperstop=upperstop, type=transferfunc
+        )
+    elif passtype == "highpass":
+        if lowerstop is None:
+            lowerstop = lowerpass * (1.0 / 1.05)
+        thetransfunc = 1.0 - getlptransfunc(
+            Fs, dummydata, upperpass=lowerstop, upperstop=lowerpass, type=transferfunc
+        )
+    else:
+        if lowerstop is None:
+            lowerstop = lowerpass * (1.0 / 1.05)
+        thetransfunc = getlptransfunc(
+            Fs, dummydata, upperpass=upperpass, upperstop=upperstop, type=transferfunc
+        ) * gethptransfunc(
+            Fs, dummydata, lowerstop=lowerstop, lowerpass=lowerpass, type=transferfunc
+        )
+    thetransfunc.setflags(write=False)
+    return thetransfunc
+
+
+@functools.lru_cache(maxsize=64)
+def _cachedbutter(order, Wn, btype):
+    return signal.butter(order, Wn, btype)
+
+
+def _padrows(inputdata, padlen=20, cyclic=False):
+    # padvec along the last axis of a 2D array
+    if padlen > inputdata.shape[-1]:
+        print(
+            "ERROR: padlen (",
+            padlen,
+            ") is greater than input data length (",
+            inputdata.shape[-1],
+            ")",
+        )
+        sys.exit()
+
+    if padlen > 0:
+        if cyclic:
+            return np.concatenate(
+                (inputdata[:, -padlen:], inputdata, inputdata[:, 0:padlen]), axis=-1
+            )
+        else:
+            return np.concatenate(
+                (
+                    inputdata[:, ::-1][:, -padlen:],
+                    inputdata,
+                    inputdata[:, ::-1][:, 0:padlen],
+                ),
+                axis=-1,
+            )
+    else:
+        return inputdata
+
+
+def _unpadrows(inputdata, padlen=20):
+    if padlen > 0:
+        return inputdata[:, padlen:-padlen]
+    else:
+        return inputdata
+
+
+def _butterrows(Fs, inputdata, lowerpass, upperpass, passtype, order, padlen=20):
+    # the butterworth branches of arb_pass, applied along the last axis of a 2D array
+    if passtype in ["lowpass", "bandpass"]:
+        if upperpass > Fs / 2.0:
+            upperpass = Fs / 2.0
+        b, a = _cachedbutter(order, 2.0 * upperpass / Fs, "lowpass")
+        inputdata = _unpadrows(
+            signal.filtfilt(b, a, _padrows(inputdata, padlen=padlen), axis=-1).real,
+            padlen=padlen,
+        ).astype(np.float64)
+    if passtype in ["highpass", "bandpass"]:
+        if lowerpass < 0.0:
+            lowerpass = 0.0
+        b, a = _cachedbutter(order, 2.0 * lowerpass / Fs, "highpass")
+        inputdata = _unpadrows(
+            signal.filtfilt(b, a, _padrows(inputdata, padlen=padlen), axis=-1).real,
+            padlen=padlen,
+        )
+    return inputdata
+
+
+def arb_pass_rows(
+    Fs,
+    inputdata,
+    lowerstop,
+    lowerpass,
+    upperpass,
+    upperstop,
+    transferfunc="trapezoidal",
+    butterorder=6,
+    padlen=20,
+    cyclic=False,
+):
+    r"""Filters every row of a 2D array over a specified range.  This is a vectorized
+    version of arb_pass - the transfer function or filter coefficients are computed
+    (or retrieved from a cache) once and applied to all rows.
+
+    Parameters
+    ----------
+    Fs : float
+        Sample rate in Hz
+    inputdata : 2D numpy array
+        Input data to be filtered, one timecourse per row
+    lowerstop, lowerpass, upperpass, upperstop : float
+        Filter band limits in Hz (see arb_pass)
+    transferfunc : str, optional
+        'trapezoidal', 'brickwall', 'gaussian', or 'butterworth'.  Default is 'trapezoidal'.
+    butterorder : int, optional
+        Order of Butterworth filter, if used.  Default is 6.
+    padlen : int, optional
+        Amount of points to reflect around each end of the rows prior to filtering.  Default is 20.
+    cyclic : bool, optional
+        If True, pad by wrapping the data in a cyclic manner rather than reflecting at the ends
+
+    Returns
+    -------
+    filtereddata : 2D float array
+        The filtered data
+    """
+    if lowerpass <= 0.0:
+        passtype = "lowpass"
+    elif (upperpass >= Fs / 2.0) or (upperpass <= 0.0):
+        passtype = "highpass"
+    else:
+        passtype = "bandpass"
+
+    if transferfunc == "butterworth":
+        return _butterrows(
+            Fs, inputdata, lowerpass, upperpass, passtype, butterorder, padlen=padlen
+        )
+    else:
+        padinputdata = _padrows(inputdata, padlen=padlen, cyclic=cyclic)
+        thetransfunc = _cachedtransfunc(
+            float(Fs),
+            padinputdata.shape[-1],
+            None if lowerstop is None else float(lowerstop),
+            float(lowerpass),
+            float(upperpass),
+            None if upperstop is None else float(upperstop),
+            passtype,
+            transferfunc,
+        )
+        inputdata_trans = fftpack.fft(padinputdata, axis=-1)
+        inputdata_trans *= thetransfunc
+        return _unpadrows(fftpack.ifft(inputdata_trans, axis=-1).real, padlen=padlen)
+
+
 class Plethfilter:
     def __init_(self, Fs, Fl, Fh, order=4, attenuation=20):
         self.Fs = Fs
@@ -1640,20 +1869,25 @@ class NoncausalFilter:
     def getfreqs(self):
         return self.lowerstop, self.lowerpass, self.upperpass, self.upperstop
 
-    def apply(self, Fs, data):
+    def apply(self, Fs, data, axis=-1, chunksize=DEFAULT_FILTER_CHUNKSIZE):
         r"""Apply the filter to a dataset.
 
         Parameters
         ----------
         Fs : float
             Sample frequency
-        data : 1D float array
-            The data to filter
+        data : float array
+            The data to filter.  May have any number of dimensions.
+        axis : int, optional
+            The time axis of data - every 1D slice along this axis is filtered.  Default is -1.
+        chunksize : int, optional
+            Maximum number of timecourses to filter in a single call, to bound the size
+            of the temporary arrays.  Default is 10000.
 
         Returns
         -------
-        filtereddata : 1D float array
-            The filtered data
+        filtereddata : float array
+            The filtered data, with the same shape as data
         """
         # if filterband is None, just return the data
         if self.filtertype == "None":
@@ -1661,7 +1895,8 @@ class NoncausalFilter:
 
         # do some bounds checking
         nyquistlimit = 0.5 * Fs
-        lowestfreq = 2.0 * Fs / np.shape(data)[0]
+        numpoints = np.shape(data)[axis]
+        lowestfreq = 2.0 * Fs / numpoints
 
         # first see if entire range is out of bounds
         if self.lowerpass >= nyquistlimit:
@@ -1744,7 +1979,7 @@ class NoncausalFilter:
                 sys.exit()
 
         if self.padtime < 0.0:
-            padlen = int(len(data) // 2)
+            padlen = int(numpoints // 2)
         else:
             padlen = int(self.padtime * Fs)
         if self.debug:
@@ -1759,93 +1994,67 @@ class NoncausalFilter:
             print("cyclic=", self.cyclic)
 
         # now do the actual filtering
-        if self.filtertype == "None":
-            return data
-        elif self.filtertype == "ringstop":
-            return arb_pass(
-                Fs,
-                data,
-                0.0,
-                0.0,
-                Fs / 4.0,
-                1.1 * Fs / 4.0,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
-            )
-        elif (
-            self.filtertype == "vlf"
-            or self.filtertype == "lfo"
-            or self.filtertype == "lfo_legacy"
-            or self.filtertype == "resp"
-            or self.filtertype == "cardiac"
-        ):
-            return arb_pass(
-                Fs,
-                data,
-                self.lowerstop,
-                self.lowerpass,
-                self.upperpass,
-                self.upperstop,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
-            )
-        elif (
-            self.filtertype == "vlf_stop"
-            or self.filtertype == "lfo_stop"
-            or self.filtertype == "lfo_legacy_stop"
-            or self.filtertype == "resp_stop"
-            or self.filtertype == "cardiac_stop"
-        ):
-            return data - arb_pass(
-                Fs,
-                data,
-                self.lowerstop,
-                self.lowerpass,
-                self.upperpass,
-                self.upperstop,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
-            )
+        if self.filtertype == "ringstop":
+            thefreqs = (0.0, 0.0, Fs / 4.0, 1.1 * Fs / 4.0)
+            stopband = False
+        elif self.filtertype in ["vlf", "lfo", "lfo_legacy", "resp", "cardiac"]:
+            thefreqs = (self.lowerstop, self.lowerpass, self.upperpass, self.upperstop)
+            stopband = False
+        elif self.filtertype in [
+            "vlf_stop",
+            "lfo_stop",
+            "lfo_legacy_stop",
+            "resp_stop",
+            "cardiac_stop",
+        ]:
+            thefreqs = (self.lowerstop, self.lowerpass, self.upperpass, self.upperstop)
+            stopband = True
         elif self.filtertype == "arb":
-            return arb_pass(
-                Fs,
-                data,
+            thefreqs = (
                 self.arb_lowerstop,
                 self.arb_lowerpass,
                 self.arb_upperpass,
                 self.arb_upperstop,
-                transferfunc=self.transferfunc,
-                butterorder=self.butterworthorder,
-                padlen=padlen,
-                cyclic=self.cyclic,
-                debug=self.debug,
             )
+            stopband = False
         elif self.filtertype == "arb_stop":
-            return data - arb_pass(
-                Fs,
-                data,
+            thefreqs = (
                 self.arb_lowerstop,
                 self.arb_lowerpass,
                 self.arb_upperpass,
                 self.arb_upperstop,
+            )
+            stopband = True
+        else:
+            print(f"bad filter type: {self.filtertype}")
+            sys.exit()
+
+        # flatten everything to (timecourses, timepoints) and filter in blocks.  The filtering
+        # is always done in double precision, but single precision data stays single precision.
+        inputdata = np.asarray(data)
+        theshape = np.moveaxis(inputdata, axis, -1).shape
+        rowdata = np.moveaxis(inputdata, axis, -1).reshape((-1, numpoints))
+        if inputdata.dtype == np.float32:
+            outputdtype = np.float32
+        else:
+            outputdtype = np.float64
+        filtereddata = np.empty(rowdata.shape, dtype=outputdtype)
+        for startrow in range(0, rowdata.shape[0], chunksize):
+            endrow = min(startrow + chunksize, rowdata.shape[0])
+            thechunk = rowdata[startrow:endrow, :].astype(np.float64, copy=False)
+            filteredchunk = arb_pass_rows(
+                Fs,
+                thechunk,
+                *thefreqs,
                 transferfunc=self.transferfunc,
                 butterorder=self.butterworthorder,
                 padlen=padlen,
                 cyclic=self.cyclic,
-                debug=self.debug,
             )
-        else:
-            print(f"bad filter type: {self.filtertype}")
-            sys.exit()
+            if stopband:
+                filteredchunk = thechunk - filteredchunk
+            filtereddata[startrow:endrow, :] = filteredchunk
+        return np.moveaxis(filtereddata.reshape(theshape), -1, axis)
 
 
 # --------------------------- FFT helper functions ---------------------------------------------
@@ -1520,6 +1520,63 @@ def mlregress(x, y, intercept=True):
     return np.atleast_1d(solution[0].T), R
 
 
+def mlregressbatch(x, y, intercept=True):
+    r"""Fit the same set of regressors to many timecourses at once.
+
+    This gives the same results as calling mlregress on each timecourse, but the design
+    matrix is pseudoinverted once and all of the timecourses are solved with a single
+    matrix product.
+
+    Parameters
+    ----------
+    x : 2D array
+        The independent variables (pxn or nxp)
+    y : 2D array
+        The dependent variables, one timecourse per row (mxn)
+    intercept : bool, optional
+        Fit a constant term as well.  Default is True.
+
+    Returns
+    -------
+    coefficients : 2D array
+        The coefficients for each timecourse, with shape (m, p + 1) - the constant term
+        first - or (m, p) if intercept is False
+    R : 1D array
+        The multiple correlation coefficient of each timecourse with the regressors.  This
+        is nan for timecourses with no variance.
+    """
+    y = np.atleast_2d(y)
+    n = y.shape[1]
+
+    x = np.atleast_2d(x)
+    p, nx = x.shape
+
+    if nx != n:
+        x = x.transpose()
+        p, nx = x.shape
+        if nx != n:
+            raise AttributeError(
+                "x and y must have have the same number of samples (%d and %d)" % (nx, n)
+            )
+
+    if intercept is True:
+        xc = np.vstack((np.ones(n), x))
+    else:
+        xc = x
+    coefficients = y @ np.linalg.pinv(xc)
+
+    # the coefficient of determination from the correlations of each timecourse with the
+    # regressors, as in mlregress, but for all of the timecourses at once
+    xz = (x - np.mean(x, axis=1, keepdims=True)) / np.std(x, axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        yz = (y - np.mean(y, axis=1, keepdims=True)) / np.std(y, axis=1, keepdims=True)
+    c = (yz @ xz.T) / n
+    Rx = np.atleast_2d(np.corrcoef(x, rowvar=1))
+    R = np.sqrt(np.sum((c @ np.linalg.inv(Rx)) * c, axis=1))
+
+    return coefficients, R
+
+
 # --------------------------- Peak detection functions ----------------------------------------------
 # The following three functions are taken from the peakdetect distribution by Sixten Bergman
 # They were distributed under the DWTFYWTPL, so I'm relicensing them under Apache 2.0
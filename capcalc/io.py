@@ -28,13 +28,40 @@ import pandas as pd
 
 
 # ---------------------------------------- NIFTI file manipulation ---------------------------
-def readfromnifti(inputfile):
+def _findniftifile(inputfile):
+    if os.path.isfile(inputfile):
+        return inputfile
+    elif os.path.isfile(f"{inputfile}.nii.gz"):
+        return f"{inputfile}.nii.gz"
+    elif os.path.isfile(f"{inputfile}.nii"):
+        return f"{inputfile}.nii"
+    else:
+        raise FileNotFoundError(f"nifti file {inputfile} does not exist")
+
+
+def _findciftifile(inputfile):
+    if os.path.isfile(inputfile):
+        return inputfile
+    elif os.path.isfile(f"{inputfile}.nii"):
+        return f"{inputfile}.nii"
+    else:
+        raise FileNotFoundError(f"cifti file {inputfile} does not exist")
+
+
+def _volumesperblock(spatialshape, itemsize, blockbytes):
+    return int(np.max([1, blockbytes // (np.prod(spatialshape) * itemsize)]))
+
+
+def readfromnifti(inputfile, thedtype=np.float64):
     r"""Open a nifti file and read in the various important parts
 
     Parameters
     ----------
     inputfile : str
         The name of the nifti file.
+    thedtype : numpy floating point dtype, optional
+        The type of the returned data array.  Scaled data is converted directly to this
+        type, without an intermediate float64 copy.  Default is np.float64.
 
     Returns
     -------
@@ -45,22 +72,168 @@ def readfromnifti(inputfile):
     thesizes : float array
 
     """
-    if os.path.isfile(inputfile):
-        inputfilename = inputfile
-    elif os.path.isfile(f"{inputfile}.nii.gz"):
-        inputfilename = f"{inputfile}.nii.gz"
-    elif os.path.isfile(f"{inputfile}.nii"):
-        inputfilename = f"{inputfile}.nii"
-    else:
-        raise FileNotFoundError(f"nifti file {inputfile} does not exist")
-    nim = nib.load(inputfilename)
-    nim_data = nim.get_fdata()
+    nim = nib.load(_findniftifile(inputfile))
+    nim_data = nim.get_fdata(dtype=thedtype)
     nim_hdr = nim.header.copy()
     thedims = nim_hdr["dim"].copy()
     thesizes = nim_hdr["pixdim"].copy()
     return nim, nim_data, nim_hdr, thedims, thesizes
 
 
+def readniftiheader(inputfile):
+    r"""Read the header of a nifti file, without reading any of the data.
+
+    Parameters
+    ----------
+    inputfile : str
+        The name of the nifti file.
+
+    Returns
+    -------
+    nim_hdr : nifti header
+    thedims : int array
+    thesizes : float array
+
+    """
+    nim_hdr = nib.load(_findniftifile(inputfile)).header.copy()
+    return nim_hdr, nim_hdr["dim"].copy(), nim_hdr["pixdim"].copy()
+
+
+def iterniftiblocks(inputfile, themask, thedtype=np.float64, blockbytes=2**26, debug=False):
+    r"""Read the voxels inside a mask from a nifti file, one block of volumes at a time.
+
+    The blocks are read straight from the file (a .nii.gz file is decompressed one block at
+    a time), so only one block of the image is ever held in memory.
+
+    Parameters
+    ----------
+    inputfile : str
+        The name of the nifti file.
+    themask : array-like
+        The mask.  Must have the same spatial shape as the image; voxels with nonzero
+        values are read.
+    thedtype : numpy floating point dtype, optional
+        The type of the returned data.  Default is np.float64.
+    blockbytes : int, optional
+        Approximate number of bytes of the file to read at a time.  Default is 64MB.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Yields
+    ------
+    startvol : int
+        The index of the first volume in the block
+    theblock : 2D array
+        The data inside the mask, with shape (number of voxels in mask, volumes in block),
+        in the same voxel order as data.reshape((numspatiallocs, timepoints))[np.where(mask)]
+
+    """
+    theproxy = nib.load(_findniftifile(inputfile)).dataobj
+    spatialshape = tuple(theproxy.shape[:3]) + (1,) * (3 - len(theproxy.shape[:3]))
+    numvols = int(np.prod(theproxy.shape[3:]))
+    themask = np.asarray(themask)
+    if themask.size != np.prod(spatialshape):
+        print("mask spatial dimensions do not match data")
+        sys.exit()
+    maskindices = np.nonzero(themask.reshape(spatialshape))
+
+    # nifti voxel data is stored with x varying fastest, so each volume is a contiguous run
+    # of the file and a block of volumes can be read with a single sequential read
+    rawdtype = theproxy.dtype
+    volbytes = int(np.prod(spatialshape)) * rawdtype.itemsize
+    volsperblock = _volumesperblock(spatialshape, rawdtype.itemsize, blockbytes)
+    slope, inter = float(theproxy.slope), float(theproxy.inter)
+    isscaled = (slope != 1.0) or (inter != 0.0)
+    if debug:
+        print(
+            f"reading {len(maskindices[0])} of {np.prod(spatialshape)} voxels from {inputfile}, "
+            f"{volsperblock} volumes at a time"
+        )
+    with nib.openers.ImageOpener(theproxy.file_like) as thefile:
+        thefile.seek(theproxy.offset)
+        for startvol in range(0, numvols, volsperblock):
+            blockvols = np.min([volsperblock, numvols - startvol])
+            theblock = np.frombuffer(thefile.read(blockvols * volbytes), dtype=rawdtype).reshape(
+                spatialshape + (blockvols,), order="F"
+            )
+            if isscaled:
+                yield startvol, (theblock[maskindices] * slope + inter).astype(
+                    thedtype, copy=False
+                )
+            else:
+                yield startvol, theblock[maskindices].astype(thedtype, copy=False)
+
+
+def readniftislices(inputfile, startslice, endslice, thedtype=np.float64):
+    r"""Read a range of slices from a nifti file.
+
+    Only the requested slices are read from the file.  This is efficient for uncompressed
+    files, and for compressed files if indexed_gzip is installed.
+
+    Parameters
+    ----------
+    inputfile : str
+        The name of the nifti file.
+    startslice : int
+        The first slice (index along the third spatial axis) to read
+    endslice : int
+        One past the last slice to read
+    thedtype : numpy floating point dtype, optional
+        The type of the returned data array.  Default is np.float64.
+
+    Returns
+    -------
+    theslab : 4D array
+        The data, with shape (xsize, ysize, endslice - startslice, timepoints)
+
+    """
+    theproxy = nib.load(_findniftifile(inputfile)).dataobj
+    theslab = np.asarray(theproxy[:, :, startslice:endslice, ...], dtype=thedtype)
+    if theslab.ndim == 3:
+        theslab = theslab[:, :, :, None]
+    return theslab
+
+
+def readmaskedfromnifti(inputfile, themask, thedtype=np.float64, blockbytes=2**26, debug=False):
+    r"""Read only the voxels inside a mask from a nifti file.
+
+    The image is read a block of whole volumes at a time (see iterniftiblocks), and only the
+    voxels inside the mask are kept, so the full 4D array is never held in memory.
+
+    Parameters
+    ----------
+    inputfile : str
+        The name of the nifti file.
+    themask : array-like
+        The mask.  Must have the same spatial shape as the image; voxels with nonzero
+        values are read.
+    thedtype : numpy floating point dtype, optional
+        The type of the returned data array.  Default is np.float64.
+    blockbytes : int, optional
+        Approximate number of bytes of the file to read at a time.  Default is 64MB.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    masked_data : 2D array
+        The data inside the mask, with shape (number of voxels in mask, timepoints), in
+        the same voxel order as data.reshape((numspatiallocs, timepoints))[np.where(mask)]
+    nim_hdr : nifti header
+    thedims : int array
+    thesizes : float array
+
+    """
+    nim_hdr, thedims, thesizes = readniftiheader(inputfile)
+    numvols = int(np.prod(thedims[4 : thedims[0] + 1]))
+    masked_data = np.zeros((np.count_nonzero(themask), numvols), dtype=thedtype)
+    for startvol, theblock in iterniftiblocks(
+        inputfile, themask, thedtype=thedtype, blockbytes=blockbytes, debug=debug
+    ):
+        masked_data[:, startvol : startvol + theblock.shape[1]] = theblock
+    return masked_data, nim_hdr, thedims, thesizes
+
+
 def readfromcifti(inputfile, debug=False):
     r"""Open a cifti file and read in the various important parts
 
@@ -78,14 +251,7 @@ def readfromcifti(inputfile, debug=False):
     thesizes : float array
 
     """
-    if os.path.isfile(inputfile):
-        inputfilename = inputfile
-    elif os.path.isfile(f"{inputfile}.nii"):
-        inputfilename = f"{inputfile}.nii"
-    else:
-        raise FileNotFoundError(f"cifti file {inputfile} does not exist")
-
-    cifti = nib.load(inputfilename)
+    cifti = nib.load(_findciftifile(inputfile))
     nifti_data = np.transpose(cifti.get_fdata(dtype=np.float32))
     cifti_hdr = cifti.header
     nifti_hdr = cifti.nifti_header
@@ -104,6 +270,61 @@ def readfromcifti(inputfile, debug=False):
     return cifti, cifti_hdr, nifti_data, nifti_hdr, thedims, thesizes, timestep
 
 
+def readciftiheader(inputfile):
+    r"""Read the headers of a cifti file, without reading any of the data.
+
+    Parameters
+    ----------
+    inputfile : str
+        The name of the cifti file.
+
+    Returns
+    -------
+    cifti_hdr : cifti header
+    nifti_hdr : nifti header
+    thedims : int array
+    thesizes : float array
+    timestep : float
+        The time between points for a dense timeseries, otherwise None
+
+    """
+    cifti = nib.load(_findciftifile(inputfile))
+    cifti_hdr = cifti.header
+    nifti_hdr = cifti.nifti_header
+    if nifti_hdr["intent_code"] == 3002:
+        timestep, starttime = getciftitr(cifti_hdr)
+    else:
+        timestep, starttime = None, None
+    return cifti_hdr, nifti_hdr, nifti_hdr["dim"].copy(), nifti_hdr["pixdim"].copy(), timestep
+
+
+def readciftichunk(inputfile, startpt, endpt, thedtype=np.float64):
+    r"""Read a range of grayordinates from a cifti file.
+
+    Only the requested grayordinates are read from the file.
+
+    Parameters
+    ----------
+    inputfile : str
+        The name of the cifti file.
+    startpt : int
+        The first grayordinate to read
+    endpt : int
+        One past the last grayordinate to read
+    thedtype : numpy floating point dtype, optional
+        The type of the returned data array.  Default is np.float64.
+
+    Returns
+    -------
+    thechunk : 2D array
+        The data, with shape (endpt - startpt, timepoints), in the same order as the data
+        returned by readfromcifti
+
+    """
+    theproxy = nib.load(_findciftifile(inputfile)).dataobj
+    return np.transpose(np.asarray(theproxy[:, startpt:endpt], dtype=thedtype))
+
+
 def getciftitr(cifti_hdr):
     seriesaxis = None
     for theaxis in cifti_hdr.matrix.mapped_indices:
@@ -216,6 +437,73 @@ def savetonifti(thearray, theheader, thename):
     output_nifti = None
 
 
+def savemaskedtonifti(thearray, themask, theheader, thename, blockbytes=2**26, debug=False):
+    r"""Save data from inside a mask to a nifti file, with zeros outside of the mask.
+
+    The file is written a block of whole volumes at a time, so the full 4D array is
+    never allocated.
+
+    Parameters
+    ----------
+    thearray : 1D or 2D array
+        The data inside the mask, with shape (number of voxels in mask, timepoints), in the
+        order returned by readmaskedfromnifti.  A 1D array is saved as a 3D file.
+    themask : array-like
+        The mask, with the spatial shape of the output file
+    theheader : nifti header
+        A valid nifti header.  The dimensions are set from thearray.
+    thename : str
+        The name of the nifti file to save
+    blockbytes : int, optional
+        Approximate number of bytes to write at a time.  Default is 64MB.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+
+    """
+    themask = np.asarray(themask)
+    spatialshape = themask.shape + (1,) * (3 - themask.ndim)
+    maskindices = np.nonzero(themask.reshape(spatialshape))
+    thearray = np.asarray(thearray)
+    inputdims = thearray.ndim
+    if inputdims == 1:
+        thearray = thearray.reshape((-1, 1))
+    if thearray.shape[0] != len(maskindices[0]):
+        print("number of data rows does not match the number of voxels in the mask")
+        sys.exit()
+    numvols = thearray.shape[1]
+
+    outputheader = theheader.copy()
+    if inputdims == 1:
+        outputheader.set_data_shape(spatialshape)
+    else:
+        outputheader.set_data_shape(spatialshape + (numvols,))
+    # like savetonifti, keep the data type of the header if it can hold the data without scaling
+    if outputheader.get_data_dtype().kind != "f":
+        outputheader.set_data_dtype(thearray.dtype)
+    outputheader.set_slope_inter(1.0, 0.0)
+    outputheader["vox_offset"] = 0
+    if outputheader["magic"] == b"n+2":
+        suffix = ".nii"
+    else:
+        suffix = ".nii.gz"
+    # the header may specify a different byte order than the array
+    outputdtype = outputheader.get_data_dtype()
+    volsperblock = _volumesperblock(spatialshape, outputdtype.itemsize, blockbytes)
+    if debug:
+        print(f"writing {thename + suffix}, {volsperblock} volumes at a time")
+    with nib.openers.ImageOpener(thename + suffix, "wb") as thefile:
+        outputheader.write_to(thefile)
+        thefile.write(b"\x00" * (int(outputheader.get_data_offset()) - thefile.tell()))
+        for startvol in range(0, numvols, volsperblock):
+            blockvols = np.min([volsperblock, numvols - startvol])
+            theblock = np.zeros(spatialshape + (blockvols,), dtype=outputdtype)
+            theblock[maskindices] = thearray[:, startvol : startvol + blockvols]
+            thefile.write(theblock.tobytes(order="F"))
+
+
 def savetocifti(
     thearray,
     theciftiheader,
@@ -1693,17 +1981,99 @@ def readcolfromtextfile(inputfilespec):
         return inputdata[:, 0]
 
 
-def readvecs(inputfilename, colspec=None, numskip=0, debug=False, thedtype=float):
-    r"""
+def npyname(thefilename):
+    r"""Return the name of the binary (.npy) version of a vector file.
 
     Parameters
     ----------
-    inputfilename
+    thefilename : str
+        The name of the file, with or without an extension
 
     Returns
     -------
+    npyfilename : str
+        thefilename with its extension (if any) replaced by '.npy'
+    """
+    return os.path.splitext(thefilename)[0] + ".npy"
 
+
+def readnpyvecs(inputfilename, colspec=None, numskip=0, mmap=True, thedtype=None, debug=False):
+    r"""Read an array written by writenpvecs with filetype='npy'.
+
+    Parameters
+    ----------
+    inputfilename : str
+        The name of the .npy file
+    colspec : str, optional
+        The vectors (rows of the returned array) to read, in the format used by readvecs.
+        Default is to read all of them.
+    numskip : int, optional
+        Number of initial points to skip in each vector.  Default is 0.
+    mmap : bool, optional
+        Memory map the file rather than reading it into memory.  Default is True.
+    thedtype : dtype, optional
+        If given, and different from the type on disk, convert the data (which makes an
+        in memory copy).
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    theoutarray : 2D numpy array
+        The data, with shape (numvecs, numpoints)
     """
+    theoutarray = np.load(inputfilename, mmap_mode=("r" if mmap else None))
+    if theoutarray.ndim == 1:
+        theoutarray = theoutarray.reshape((1, -1))
+    if debug:
+        print(f"read {theoutarray.shape} array of type {theoutarray.dtype} from {inputfilename}")
+    if colspec is not None:
+        collist = colspectolist(colspec)
+        if max(collist) > theoutarray.shape[0] - 1:
+            raise ValueError("READVECS: requested column", max(collist), "too large - exiting")
+        theoutarray = theoutarray[collist, :]
+    if numskip > 0:
+        theoutarray = theoutarray[:, numskip:]
+    if (thedtype is not None) and (theoutarray.dtype != np.dtype(thedtype)):
+        theoutarray = theoutarray.astype(thedtype)
+    return theoutarray
+
+
+def readvecs(inputfilename, colspec=None, numskip=0, debug=False, thedtype=float, mmap=True):
+    r"""Read one or more vectors from a text or binary file.
+
+    Parameters
+    ----------
+    inputfilename : str
+        The name of the file.  Files ending in '.npy' are read with readnpyvecs, as are
+        text files that do not exist but have a binary version.
+    colspec : str, optional
+        The columns to read.  Default is to read all of them.
+    numskip : int, optional
+        Number of initial lines to skip.  Default is 0.
+    debug : bool, optional
+        Print extended debugging information.
+    thedtype : dtype, optional
+        Type of the returned data.  Default is float.
+    mmap : bool, optional
+        Memory map binary files rather than reading them into memory.  Default is True.
+
+    Returns
+    -------
+    theoutarray : 2D numpy array
+        The data, with shape (numcolumns, numlines)
+    """
+    if inputfilename.endswith(".npy") or (
+        not os.path.isfile(inputfilename) and os.path.isfile(npyname(inputfilename))
+    ):
+        return readnpyvecs(
+            npyname(inputfilename),
+            colspec=colspec,
+            numskip=numskip,
+            mmap=mmap,
+            thedtype=thedtype,
+            debug=debug,
+        )
     """if False:
         dataarray = pd.read_table(inputfilename, sep=None, header=None)
         if colspec is None:
@@ -1771,6 +2141,10 @@ def readvec(inputfilename, numskip=0):
         The data from the file
 
     """
+    if inputfilename.endswith(".npy") or (
+        not os.path.isfile(inputfilename) and os.path.isfile(npyname(inputfilename))
+    ):
+        return readnpyvecs(npyname(inputfilename), numskip=numskip, thedtype=float)[0, :]
     inputvec = []
     with open(inputfilename, "r") as thefile:
         lines = thefile.readlines()
@@ -1944,8 +2318,8 @@ def writevectorstotextfile(
     filetype="text",
     lineend="",
 ):
-    if filetype == "text":
-        writenpvecs(thevecs, outputfile, lineend=lineend)
+    if filetype == "text" or filetype == "npy":
+        writenpvecs(thevecs, outputfile, lineend=lineend, filetype=filetype)
     elif filetype == "bidscontinuous":
         writebidstsv(
             outputfile.split(".")[0],
@@ -1978,8 +2352,8 @@ def writevectorstotextfile(
 
 
 # rewritten to guarantee file closure, combines writenpvec and writenpvecs
-def writenpvecs(thevecs, outputfile, lineend=""):
-    r"""Write out a two dimensional numpy array to a text file
+def writenpvecs(thevecs, outputfile, lineend="", filetype="text"):
+    r"""Write out a two dimensional numpy array to a text or binary file
 
     Parameters
     ----------
@@ -1989,30 +2363,35 @@ def writenpvecs(thevecs, outputfile, lineend=""):
         The name of the output file
     lineend : { 'mac', 'win', 'linux' }, optional
         Line ending style to use. Default is 'linux'.
+    filetype : { 'text', 'npy' }, optional
+        Output format.  'text' writes one vector per tab separated column.  'npy' writes
+        the array unchanged in numpy binary format, replacing the extension of outputfile
+        with '.npy', so that it can be memory mapped by readvecs.  Default is 'text'.
 
     Returns
     -------
 
     """
-    theshape = np.shape(thevecs)
+    if filetype == "npy":
+        np.save(npyname(outputfile), np.asarray(thevecs))
+        return
+    elif filetype != "text":
+        raise ValueError("illegal file type")
     if lineend == "mac":
         thelineending = "\r"
-        openmode = "wb"
     elif lineend == "win":
         thelineending = "\r\n"
-        openmode = "wb"
-    elif lineend == "linux":
-        thelineending = "\n"
-        openmode = "wb"
     else:
         thelineending = "\n"
-        openmode = "w"
-    with open(outputfile, openmode) as FILE:
+    thevecs = np.asarray(thevecs)
+    with open(outputfile, "w", newline="") as FILE:
         if thevecs.ndim == 2:
-            for i in range(0, theshape[1]):
-                for j in range(0, theshape[0]):
-                    FILE.writelines(str(thevecs[j, i]) + "\t")
-                FILE.writelines(thelineending)
+            np.savetxt(
+                FILE,
+                np.transpose(thevecs),
+                fmt="%s",
+                delimiter="\t",
+                newline="\t" + thelineending,
+            )
         else:
-            for i in range(0, theshape[0]):
-                FILE.writelines(str(thevecs[i]) + thelineending)
+            np.savetxt(FILE, thevecs, fmt="%s", newline=thelineending)
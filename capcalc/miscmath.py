@@ -16,10 +16,14 @@
 #   limitations under the License.
 #
 #
+import sys
+import time
 import warnings
 
 import matplotlib.pyplot as plt
 import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.utils.extmath import svd_flip
 from statsmodels.robust import mad
 
 import capcalc.filter as ccalc_filt
@@ -346,9 +350,7 @@ def ppnormalize(vector):
 def imagevariance(thedata, thefilter, samplefreq, debug=False):
     if debug:
         print(f"IMAGEVARIANCE: {thedata.shape}, {thefilter}, {samplefreq}")
-    filteredim = thedata * 0.0
-    for thevoxel in range(thedata.shape[0]):
-        filteredim[thevoxel, :] = thefilter.apply(samplefreq, thedata[thevoxel, :])
+    filteredim = thefilter.apply(samplefreq, thedata, axis=1)
     return np.var(filteredim, axis=1)
 
 
@@ -470,19 +472,120 @@ def trendfilt(inputdata, order=3, ndevs=3.0, debug=False):
     return detrended + thefittc
 
 
+def randomizedcomplexsvd(matrix, n_components, n_oversamples=10, n_iter=4, random_state=None):
+    r"""Truncated SVD of a (possibly complex) matrix by randomized range finding.
+
+    The cost scales with n_components rather than with the smaller matrix dimension.
+
+    Parameters
+    ----------
+    matrix : 2D array
+        The matrix to decompose, with shape (N, M)
+    n_components : int
+        Number of singular values and vectors to return
+    n_oversamples : int, optional
+        Additional random vectors used to sample the range of the matrix.  Default is 10.
+    n_iter : int, optional
+        Number of power iterations, which improve the accuracy when the singular values
+        decay slowly.  Default is 4.
+    random_state : int, optional
+        Seed for the random test matrix.  Default is None.
+
+    Returns
+    -------
+    u : 2D array
+        The left singular vectors, with shape (N, n_components)
+    s : 1D float array
+        The singular values, in decreasing order
+    vh : 2D array
+        The conjugated right singular vectors, with shape (n_components, M)
+    """
+    rng = np.random.default_rng(random_state)
+    numvecs = int(np.min([n_components + n_oversamples, np.min(matrix.shape)]))
+    testmatrix = rng.standard_normal((matrix.shape[1], numvecs))
+    if np.iscomplexobj(matrix):
+        testmatrix = testmatrix + 1j * rng.standard_normal((matrix.shape[1], numvecs))
+    testmatrix = testmatrix.astype(np.result_type(matrix.dtype, np.float32), copy=False)
+
+    # find an orthonormal basis for the range of the matrix, renormalizing between the power
+    # iterations to keep the small singular values from being lost to roundoff
+    therange, _ = np.linalg.qr(matrix @ testmatrix)
+    for i in range(n_iter):
+        therange, _ = np.linalg.qr(np.conj(matrix.T) @ therange)
+        therange, _ = np.linalg.qr(matrix @ therange)
+
+    # the SVD of the small projected matrix gives the SVD of the original
+    ub, s, vh = np.linalg.svd(np.conj(therange.T) @ matrix, full_matrices=False)
+    return (therange @ ub)[:, :n_components], s[:n_components], vh[:n_components]
+
+
 # found here: https://datascience.stackexchange.com/questions/75733/pca-for-complex-valued-data
 class ComplexPCA:
-    def __init__(self, n_components):
+    def __init__(
+        self,
+        n_components,
+        svd_solver="full",
+        n_oversamples=10,
+        n_iter=4,
+        random_state=None,
+    ):
+        r"""PCA for complex valued data.
+
+        Only the first n_components components are kept.  Like the original implementation,
+        the decomposition is of the uncentered data; the mean is removed when transforming.
+
+        Parameters
+        ----------
+        n_components : int or None
+            Number of components to keep.  If None, keep min(N, M) (or, for partial_fit,
+            the size of the first block).
+        svd_solver : {'full', 'randomized'}, optional
+            'full' uses a full SVD.  'randomized' uses a truncated randomized SVD, whose cost
+            scales with n_components.  Default is 'full'.
+        n_oversamples : int, optional
+            Additional random vectors used by the randomized solver.  Default is 10.
+        n_iter : int, optional
+            Number of power iterations used by the randomized solver.  Default is 4.
+        random_state : int, optional
+            Seed for the randomized solver.  Default is None.
+        """
+        if svd_solver not in ["full", "randomized"]:
+            print("illegal svd_solver", svd_solver)
+            sys.exit()
         self.n_components = n_components
+        self.svd_solver = svd_solver
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.random_state = random_state
         self.u = self.s = self.components_ = None
         self.mean_ = None
+        self.n_samples_seen_ = 0
 
     @property
     def explained_variance_ratio_(self):
         return self.s
 
+    def _svd(self, matrix, n_components):
+        if self.svd_solver == "randomized":
+            _, s, vh = randomizedcomplexsvd(
+                matrix,
+                n_components,
+                n_oversamples=self.n_oversamples,
+                n_iter=self.n_iter,
+                random_state=self.random_state,
+            )
+        else:
+            # full=False ==> num_pc = min(N, M)
+            _, s, vh = np.linalg.svd(matrix, full_matrices=False)
+        return s[:n_components], vh[:n_components]
+
     def fit(self, matrix, use_gpu=False):
         self.mean_ = matrix.mean(axis=0)
+        self.n_samples_seen_ = matrix.shape[0]
+        if self.n_components is None:
+            n_components = int(np.min(matrix.shape))
+        else:
+            n_components = int(self.n_components)
         if use_gpu:
             import tensorflow as tf  # torch doesn't handle complex values.
 
@@ -490,14 +593,49 @@ class ComplexPCA:
             u, s, vh = tf.linalg.svd(
                 tensor, full_matrices=False
             )  # full=False ==> num_pc = min(N, M)
-            # It would be faster if the SVD was truncated to only n_components instead of min(M, N)
+            vh = vh[:n_components]
         else:
-            _, self.s, vh = np.linalg.svd(
-                matrix, full_matrices=False
-            )  # full=False ==> num_pc = min(N, M)
-            # It would be faster if the SVD was truncated to only n_components instead of min(M, N)
+            self.s, vh = self._svd(matrix, n_components)
         self.components_ = vh  # already conjugated.
         # Leave those components as rows of matrix so that it is compatible with Sklearn PCA.
+        return self
+
+    def partial_fit(self, matrix):
+        r"""Update the decomposition with another block of samples.
+
+        The current components, scaled by their singular values, summarize all of the data
+        seen so far, so the SVD of them stacked on top of the new block updates the
+        decomposition without revisiting the earlier blocks.  Memory use is set by the
+        block size and n_components.
+
+        Parameters
+        ----------
+        matrix : 2D array
+            The new samples, with shape (n_samples, M)
+
+        Returns
+        -------
+        self : ComplexPCA
+        """
+        if self.components_ is None:
+            if self.n_components is None:
+                self.n_components = int(np.min(matrix.shape))
+            self.mean_ = np.zeros(matrix.shape[1], dtype=np.result_type(matrix.dtype, np.float64))
+            self.n_samples_seen_ = 0
+            stacked = matrix
+        else:
+            if matrix.shape[1] != self.components_.shape[1]:
+                print("number of features does not match the previous blocks")
+                sys.exit()
+            stacked = np.concatenate((self.s[:, None] * self.components_, matrix), axis=0)
+
+        totalsamples = self.n_samples_seen_ + matrix.shape[0]
+        self.mean_ = (
+            self.mean_ * self.n_samples_seen_ + np.sum(matrix, axis=0, dtype=self.mean_.dtype)
+        ) / totalsamples
+        self.n_samples_seen_ = totalsamples
+        self.s, self.components_ = self._svd(stacked, int(self.n_components))
+        return self
 
     def transform(self, matrix):
         data = matrix - self.mean_
@@ -507,3 +645,179 @@ class ComplexPCA:
     def inverse_transform(self, matrix):
         result = matrix @ np.conj(self.components_)
         return self.mean_ + result
+
+
+# ---------------------------------------- PCA solvers ------------------------------------------------
+PCASOLVERS = ["auto", "full", "arpack", "randomized", "gram"]
+
+
+def _truncatepca(thepca, numcomponents):
+    # keep only the first numcomponents components of a fitted PCA, and recalculate the noise
+    # variance (the mean variance of the discarded components) to match
+    totalvariance = np.sum(thepca.explained_variance_, dtype=np.float64) / np.sum(
+        thepca.explained_variance_ratio_, dtype=np.float64
+    )
+    maxrank = np.min([thepca.n_samples_, thepca.n_features_in_])
+    if numcomponents < maxrank:
+        thepca.noise_variance_ = float(
+            (totalvariance - np.sum(thepca.explained_variance_[:numcomponents], dtype=np.float64))
+            / (maxrank - numcomponents)
+        )
+    else:
+        thepca.noise_variance_ = 0.0
+    thepca.components_ = thepca.components_[:numcomponents]
+    thepca.explained_variance_ = thepca.explained_variance_[:numcomponents]
+    thepca.explained_variance_ratio_ = thepca.explained_variance_ratio_[:numcomponents]
+    thepca.singular_values_ = thepca.singular_values_[:numcomponents]
+    thepca.n_components_ = numcomponents
+    thepca.n_components = numcomponents
+    return thepca
+
+
+def _numforfraction(explained_variance_ratio, fraction):
+    # the number of components needed to explain more than fraction of the variance
+    return int(np.searchsorted(np.cumsum(explained_variance_ratio), fraction, side="right") + 1)
+
+
+def _gramfit(thepca, thedata, n_components):
+    # fit a PCA from the eigendecomposition of the smaller of the (n_samples, n_samples) Gram
+    # matrix and the (n_features, n_features) covariance matrix, which is much smaller than the
+    # data when one of its dimensions is much smaller than the other
+    n_samples, n_features = thedata.shape
+    themean = np.mean(thedata, axis=0, dtype=np.float64)
+    centered = thedata - themean.astype(thedata.dtype)
+    usegram = n_samples <= n_features
+    if usegram:
+        thecross = (centered @ centered.T).astype(np.float64)
+    else:
+        thecross = (centered.T @ centered).astype(np.float64)
+    theevals, theevecs = np.linalg.eigh(thecross)
+    theevals = np.clip(theevals[::-1], 0.0, None)
+    theevecs = theevecs[:, ::-1]
+    therank = int(np.sum(theevals > theevals[0] * np.finfo(thedata.dtype).eps * thecross.shape[0]))
+    thecross = None
+    thesingvals = np.sqrt(theevals[:therank])
+    theevecs = theevecs[:, :therank].astype(thedata.dtype)
+    if usegram:
+        theu = theevecs
+        thecomponents = (theu.T @ centered) / thesingvals[:, None].astype(thedata.dtype)
+    else:
+        thecomponents = theevecs.T
+        theu = (centered @ theevecs) / thesingvals[None, :].astype(thedata.dtype)
+    theu, thecomponents = svd_flip(theu, thecomponents, u_based_decision=False)
+
+    explained_variance = theevals / (n_samples - 1)
+    explained_variance_ratio = explained_variance / np.sum(explained_variance)
+    if 0.0 < n_components < 1.0:
+        numcomponents = _numforfraction(explained_variance_ratio, n_components)
+    else:
+        numcomponents = int(n_components)
+    numcomponents = int(np.min([numcomponents, therank]))
+
+    thepca.mean_ = themean.astype(thedata.dtype)
+    thepca.components_ = thecomponents
+    thepca.explained_variance_ = explained_variance[:therank].astype(thedata.dtype)
+    thepca.explained_variance_ratio_ = explained_variance_ratio[:therank].astype(thedata.dtype)
+    thepca.singular_values_ = thesingvals.astype(thedata.dtype)
+    thepca.n_samples_ = n_samples
+    thepca.n_features_in_ = n_features
+    return _truncatepca(thepca, numcomponents)
+
+
+def fitpca(
+    thedata,
+    n_components,
+    solver="auto",
+    n_oversamples=10,
+    iterated_power="auto",
+    random_state=None,
+    debug=False,
+):
+    r"""Fit a PCA to a data array with a selectable SVD solver.
+
+    The time taken and the fraction of the variance captured are printed, so that the speed
+    and accuracy of the solvers can be compared.
+
+    Parameters
+    ----------
+    thedata : 2D float array
+        The data, with shape (n_samples, n_features)
+    n_components : int, float, or 'mle'
+        Number of components to keep.  A value between 0 and 1 keeps the components needed
+        to explain that fraction of the variance, and 'mle' estimates the number (this
+        requires the full solver).
+    solver : {'auto', 'full', 'arpack', 'randomized', 'gram'}, optional
+        'auto', 'full', 'arpack', and 'randomized' are the scikit-learn PCA solvers.  For the
+        truncated solvers, a variance fraction is reached by fitting an increasing number of
+        components.  'gram' gets the exact decomposition from the eigendecomposition of the
+        smaller of the (n_samples, n_samples) Gram matrix and the (n_features, n_features)
+        covariance matrix, and is fastest when one data dimension is much smaller than the
+        other.
+        Default is 'auto'.
+    n_oversamples : int, optional
+        Additional random vectors used by the randomized solver.  Default is 10.
+    iterated_power : int or 'auto', optional
+        Number of power iterations used by the randomized solver.  Default is 'auto'.
+    random_state : int, optional
+        Seed for the randomized and arpack solvers.  Default is None.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    thepca : sklearn.decomposition.PCA
+        The fitted PCA
+    """
+    if solver not in PCASOLVERS:
+        print("illegal pca solver", solver)
+        sys.exit()
+    n_samples, n_features = thedata.shape
+    maxrank = int(np.min([n_samples, n_features]))
+    if n_components == "mle":
+        if solver not in ["auto", "full"]:
+            print("mle component estimation requires the full solver - using it")
+        solver = "full"
+    if debug:
+        print(f"fitpca: {n_samples} samples, {n_features} features, {solver} solver")
+
+    starttime = time.time()
+    if solver == "gram":
+        thepca = _gramfit(PCA(n_components=n_components), thedata, n_components)
+    elif solver in ["auto", "full"]:
+        thepca = PCA(n_components=n_components, svd_solver=solver).fit(thedata)
+    else:
+        # the truncated solvers need an integer number of components (arpack needs fewer
+        # than the smaller data dimension)
+        if solver == "arpack":
+            maxrank -= 1
+        if 0.0 < n_components < 1.0:
+            numtofit = int(np.min([50, maxrank]))
+        else:
+            numtofit = int(np.min([int(n_components), maxrank]))
+        while True:
+            thepca = PCA(
+                n_components=numtofit,
+                svd_solver=solver,
+                n_oversamples=n_oversamples,
+                iterated_power=iterated_power,
+                random_state=random_state,
+            ).fit(thedata)
+            if not (0.0 < n_components < 1.0):
+                break
+            if np.sum(thepca.explained_variance_ratio_) > n_components:
+                thepca = _truncatepca(
+                    thepca, _numforfraction(thepca.explained_variance_ratio_, n_components)
+                )
+                break
+            if numtofit == maxrank:
+                print(f"{maxrank} components explain less than {n_components} of the variance")
+                break
+            if debug:
+                print(f"fitpca: {numtofit} components are not enough - doubling")
+            numtofit = int(np.min([2 * numtofit, maxrank]))
+    print(
+        f"pca ({solver} solver) took {time.time() - starttime:.2f} seconds, "
+        f"{thepca.n_components_} components capture "
+        f"{100.0 * np.sum(thepca.explained_variance_ratio_):.2f}% of the variance"
+    )
+    return thepca
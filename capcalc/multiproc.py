@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2019-2025 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Support functions for running independent jobs in worker processes.
+"""
+import multiprocessing as mp
+
+
+def getnprocs(nprocs):
+    r"""Translate a requested number of processes into an actual number.
+
+    Parameters
+    ----------
+    nprocs : int
+        The requested number of worker processes.  Values less than 1 select
+        one less than the number of available cpus.
+
+    Returns
+    -------
+    nprocs : int
+        The number of worker processes to use (at least 1)
+    """
+    if nprocs < 1:
+        return max(1, mp.cpu_count() - 1)
+    return int(nprocs)
+
+
+def run_multiproc(thefunc, arglist, nprocs=1, debug=False):
+    r"""Call a function on each of a list of argument tuples, possibly in parallel.
+
+    Parameters
+    ----------
+    thefunc : function
+        The function to call.  Must be defined at module level so it can be pickled.
+    arglist : list of tuples
+        The positional arguments for each call.
+    nprocs : int, optional
+        Number of worker processes (see getnprocs).  If 1, everything is run in the
+        current process.  Default is 1.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    results : list
+        The return values of the calls, in the same order as arglist
+    """
+    nprocs = min(getnprocs(nprocs), len(arglist))
+    if debug:
+        print(f"run_multiproc: {len(arglist)} jobs on {nprocs} processes")
+    if nprocs <= 1:
+        return [thefunc(*theargs) for theargs in arglist]
+    with mp.Pool(processes=nprocs) as pool:
+        return pool.starmap(thefunc, arglist)
+
+
+def _indexedcall(thejob):
+    # worker side of iter_multiproc - call the function and tag the result with its index
+    thefunc, theindex, theargs = thejob
+    return theindex, thefunc(*theargs)
+
+
+def iter_multiproc(thefunc, arglist, nprocs=1, debug=False):
+    r"""Call a function on each of a list of argument tuples, possibly in parallel, and yield
+    the results as they finish.
+
+    Parameters
+    ----------
+    thefunc : function
+        The function to call.  Must be defined at module level so it can be pickled.
+    arglist : list of tuples
+        The positional arguments for each call.
+    nprocs : int, optional
+        Number of worker processes (see getnprocs).  If 1, everything is run in the
+        current process, in order.  Default is 1.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Yields
+    ------
+    index, result : int, object
+        The position of the call in arglist, and its return value.  With more than one
+        process, results arrive in the order they finish.  Closing the generator early
+        stops any calls that are still running.
+    """
+    nprocs = min(getnprocs(nprocs), len(arglist))
+    if debug:
+        print(f"iter_multiproc: {len(arglist)} jobs on {nprocs} processes")
+    if nprocs <= 1:
+        for theindex, theargs in enumerate(arglist):
+            yield theindex, thefunc(*theargs)
+        return
+    with mp.Pool(processes=nprocs) as pool:
+        yield from pool.imap_unordered(
+            _indexedcall,
+            [(thefunc, theindex, theargs) for theindex, theargs in enumerate(arglist)],
+        )
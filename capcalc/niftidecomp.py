@@ -16,15 +16,262 @@
 #   limitations under the License.
 #
 #
+import copy
+import os
+import shutil
 import sys
+import tempfile
 
 import joblib
 import numpy as np
-from sklearn.decomposition import PCA, FastICA, SparsePCA
-from statsmodels.robust import mad
+from sklearn.decomposition import FastICA, IncrementalPCA, SparsePCA
 
 import capcalc.filter as tide_filt
 import capcalc.io as tide_io
+import capcalc.miscmath as ccalc_math
+import capcalc.multiproc as ccalc_mp
+import capcalc.preprocess as ccalc_preproc
+
+
+def _readmaskedfile(datafile, procmask, sigma=0.0, theprefilter=None, datadtype=np.float64):
+    # read a single file, smooth and filter it, and return only the voxels in procmask.  Unless
+    # the data has to be spatially smoothed first, only the voxels in the mask are ever read.
+    print(f"reading {datafile}...")
+    if sigma > 0.0:
+        (
+            datafile_img,
+            datafile_data,
+            datafile_hdr,
+            datafiledims,
+            datafilesizes,
+        ) = tide_io.readfromnifti(datafile, thedtype=datadtype)
+        xsize, ysize, numslices, timepoints = tide_io.parseniftidims(datafiledims)
+        xdim, ydim, slicethickness, tr = tide_io.parseniftisizes(datafilesizes)
+        numspatiallocs = int(xsize) * int(ysize) * int(numslices)
+
+        # smooth the data
+        print("\tsmoothing data")
+        for i in range(timepoints):
+            datafile_data[:, :, :, i] = tide_filt.ssmooth(
+                xdim, ydim, slicethickness, sigma, datafile_data[:, :, :, i]
+            )
+
+        procdata = datafile_data.reshape((numspatiallocs, timepoints))[procmask, :]
+        datafile_data = None
+    else:
+        procdata, datafile_hdr, datafiledims, datafilesizes = tide_io.readmaskedfromnifti(
+            datafile, procmask, thedtype=datadtype
+        )
+        xdim, ydim, slicethickness, tr = tide_io.parseniftisizes(datafilesizes)
+
+    # prefilter the data.  NoncausalFilter.apply adjusts the filter limits to suit the data
+    # length, so use a private copy to keep the result independent of the other files and of
+    # whether this is running in a worker process.  The filter passband generally excludes DC,
+    # so restore the unfiltered voxel means afterwards - otherwise percent normalization would
+    # divide by the (near zero) mean of the filtered data.
+    if theprefilter is not None:
+        print("\ttemporally filtering data")
+        themeans = np.mean(procdata, axis=1, dtype=np.float64, keepdims=True)
+        procdata = (
+            copy.deepcopy(theprefilter).apply(1.0 / tr, procdata).astype(datadtype, copy=False)
+        )
+        themeans -= np.mean(procdata, axis=1, dtype=np.float64, keepdims=True)
+        procdata += themeans.astype(datadtype)
+
+    return procdata, datafile_hdr, datafiledims, datafilesizes
+
+
+def _readfileintoarray(
+    datafile, outputarray, startpoint, procmask, sigma=0.0, theprefilter=None, datadtype=np.float64
+):
+    # read the masked voxels of a single file, smooth and filter it, and copy it into the columns
+    # of outputarray starting at startpoint
+    procdata, datafile_hdr, datafiledims, datafilesizes = _readmaskedfile(
+        datafile, procmask, sigma=sigma, theprefilter=theprefilter, datadtype=datadtype
+    )
+    outputarray[:, startpoint : startpoint + procdata.shape[1]] = procdata
+    return datafile_hdr, datafiledims, datafilesizes
+
+
+def _readfileintomemmap(
+    datafile,
+    memmapname,
+    memmapshape,
+    startpoint,
+    procmask,
+    sigma=0.0,
+    theprefilter=None,
+    datadtype=np.float64,
+):
+    # worker process version of _readfileintoarray that writes into a shared memmapped array
+    outputarray = np.memmap(memmapname, dtype=datadtype, mode="r+", shape=memmapshape)
+    fileinfo = _readfileintoarray(
+        datafile,
+        outputarray,
+        startpoint,
+        procmask,
+        sigma=sigma,
+        theprefilter=theprefilter,
+        datadtype=datadtype,
+    )
+    outputarray.flush()
+    del outputarray
+    return fileinfo
+
+
+def _streamingpca_workflow(
+    datafilelist,
+    outputroot,
+    datamaskdims,
+    procmask,
+    numspatiallocs,
+    pcacomponents=0.5,
+    trainedmodelroot=None,
+    normmethod="None",
+    demean=True,
+    theprefilter=None,
+    sigma=0.0,
+    segmentnorm=True,
+    datadtype=np.float64,
+):
+    # fit the pca one file at a time, so that only a single masked file is ever in memory
+    numfiles = len(datafilelist)
+    filelens = np.zeros((numfiles), dtype=int)
+
+    def _preprocessedfiles():
+        for idx, datafile in enumerate(datafilelist):
+            procdata, datafile_hdr, datafiledims, datafilesizes = _readmaskedfile(
+                datafile, procmask, sigma=sigma, theprefilter=theprefilter, datadtype=datadtype
+            )
+            if idx == 0:
+                print("checking mask dimensions")
+                if not tide_io.checkspacedimmatch(datafiledims, datamaskdims):
+                    print("input mask spatial dimensions do not match image")
+                    exit()
+                originaldatafiledims = datafiledims.copy()
+                originaldatafilesizes = datafilesizes.copy()
+            else:
+                if (not tide_io.checkspacedimmatch(datafiledims, originaldatafiledims)) or (
+                    not tide_io.checkspaceresmatch(datafilesizes, originaldatafilesizes)
+                ):
+                    print("all input data files must have the same spatial dimensions")
+                    exit()
+            filelens[idx] = procdata.shape[1]
+            print(f"normalizing {filelens[idx]} images in segment {idx}")
+            themeans, thenormfacs = ccalc_preproc.SegmentNormalizer(
+                normmethod=normmethod, demean=demean, axis=(1 if segmentnorm else 0)
+            ).normalize(procdata)
+            if segmentnorm:
+                themeans, thenormfacs = themeans[:, 0], thenormfacs[:, 0]
+            yield idx, np.nan_to_num(procdata, copy=False), themeans, thenormfacs, (
+                datafile_hdr,
+                datafiledims,
+                datafilesizes,
+            )
+
+    if trainedmodelroot is not None:
+        modelfilename = trainedmodelroot + "_pca.joblib"
+        print("reading PCA from", modelfilename)
+        try:
+            thepca = joblib.load(modelfilename)
+        except Exception as ex:
+            template = (
+                "An exception of type {0} occurred when trying to open {1}. Arguments:\n{2!r}"
+            )
+            message = template.format(type(ex).__name__, modelfilename, ex.args)
+            print(message)
+            sys.exit()
+    else:
+        # every call to partial_fit needs at least n_components time points, so the number of
+        # components that can be fit is limited by the shortest file
+        for idx, datafile in enumerate(datafilelist):
+            datafilesizes, datafiledims = tide_io.fmriheaderinfo(datafile)
+            filelens[idx] = tide_io.parseniftidims(datafiledims)[3]
+        maxcomponents = int(min(np.min(filelens), np.sum(procmask)))
+
+        print("performing incremental pca decomposition")
+        if 0.0 < pcacomponents < 1.0:
+            print(
+                "will return the components accounting for",
+                pcacomponents * 100.0,
+                "% of the variance",
+            )
+            thepca = IncrementalPCA(n_components=maxcomponents)
+        elif pcacomponents < 0.0:
+            print("mle component estimation is not available when streaming - keeping all")
+            thepca = IncrementalPCA(n_components=maxcomponents)
+        else:
+            if int(pcacomponents) > maxcomponents:
+                print(
+                    f"cannot fit {int(pcacomponents)} components when streaming - the shortest",
+                    f"file has {np.min(filelens)} time points",
+                )
+                sys.exit()
+            thepca = IncrementalPCA(n_components=int(pcacomponents))
+
+        # first pass - fit the model
+        for idx, procdata, themeans, thenormfacs, theinfo in _preprocessedfiles():
+            print(f"fitting segment {idx}")
+            thepca.partial_fit(np.transpose(procdata))
+
+        # save the model
+        joblib.dump(thepca, outputroot + "_pca.joblib")
+
+    # figure out how many components to keep
+    if 0.0 < pcacomponents < 1.0:
+        numcomponents = int(
+            np.searchsorted(np.cumsum(thepca.explained_variance_ratio_), pcacomponents) + 1
+        )
+        numcomponents = min(numcomponents, thepca.n_components_)
+    else:
+        numcomponents = thepca.n_components_
+    print("returning", numcomponents, "components")
+
+    # second pass - transform the data
+    thetransforms = []
+    allmeans = []
+    allnormfacs = []
+    for idx, procdata, themeans, thenormfacs, theinfo in _preprocessedfiles():
+        print(f"transforming segment {idx}")
+        thetransforms.append(thepca.transform(np.transpose(procdata))[:, :numcomponents])
+        allmeans.append(themeans)
+        allnormfacs.append(thenormfacs)
+    datafile_hdr, datafiledims, datafilesizes = theinfo
+    xsize, ysize, numslices, timepoints = tide_io.parseniftidims(datafiledims)
+
+    if segmentnorm:
+        themeans = np.stack(allmeans, axis=1)
+        thenormfacs = np.stack(allnormfacs, axis=1)
+    else:
+        themeans = np.concatenate(allmeans)
+        thenormfacs = np.concatenate(allnormfacs)
+
+    # stash the eigenvalues
+    exp_var_pct = 100.0 * thepca.explained_variance_ratio_[:numcomponents]
+
+    # save the component images
+    thecomponents = np.transpose(thepca.components_[:numcomponents])
+    outputcomponents = np.zeros(
+        (numspatiallocs, thecomponents.shape[1]), dtype=thecomponents.dtype
+    )
+    outputcomponents[procmask, :] = thecomponents[:, :]
+    outputcomponents = outputcomponents.reshape((xsize, ysize, numslices, thecomponents.shape[1]))
+
+    # save the coefficients
+    outputcoefficients = np.transpose(np.concatenate(thetransforms, axis=0))
+
+    # the fit data is as large as the input, so it is not regenerated when streaming
+    return (
+        outputcomponents,
+        outputcoefficients,
+        None,
+        exp_var_pct,
+        datafile_hdr,
+        datafiledims,
+        datafilesizes,
+        thenormfacs,
+        themeans,
+    ), thepca
 
 
 def niftidecomp_workflow(
@@ -41,6 +288,13 @@ def niftidecomp_workflow(
     sigma=0.0,
     maskthresh=0.25,
     segmentnorm=True,
+    streaming=False,
+    nprocs=1,
+    datadtype=np.float64,
+    pcasolver="auto",
+    pcaoversamples=10,
+    pcapoweriterations="auto",
+    returnmodel=False,
 ):
     # read in data
     # spatially filter (or not)
@@ -49,6 +303,25 @@ def niftidecomp_workflow(
     # demean (or not)
     # normalize all timecourses (or not)
     # do a pca decomposition to find spatial components
+    #
+    # if streaming is True, the files are read and preprocessed one at a time and fed to an
+    # IncrementalPCA, so peak memory is set by the largest single file rather than the
+    # whole dataset.  The data is read twice (once to fit, once to transform), and the
+    # reconstructed fit data is not returned (outinvtrans is None).
+    #
+    # if nprocs is greater than 1 (or less than 1, to use all but one cpu), the in memory
+    # path reads and preprocesses the files in a pool of worker processes, each of which
+    # writes into its own slice of a temporary memmapped array next to outputroot.
+    #
+    # the image data is held as datadtype throughout (reading, filtering, normalization and
+    # the decomposition itself).  The per voxel means and normalization factors are always
+    # calculated in float64.
+    #
+    # pcasolver, pcaoversamples, and pcapoweriterations select the SVD solver for the in memory
+    # pca (see miscmath.fitpca).
+    #
+    # if returnmodel is True, the fitted decomposition object is returned along with the
+    # results, as (results, model).
 
     print(f"Will perform {decomptype} analysis along the spatial dimension")
 
@@ -69,159 +342,123 @@ def niftidecomp_workflow(
 
     if mask_timepoints == 1:
         themask = datamask_data.reshape((numspatiallocs))
-        proclocs = np.where(themask > maskthresh)
+        procmask = themask > maskthresh
+        proclocs = np.where(procmask)
     else:
         print("mask must have only 3 dimensions")
         sys.exit()
 
+    if streaming:
+        if decomptype != "pca":
+            print("streaming decomposition is only available for pca")
+            sys.exit()
+        theresults, thefit = _streamingpca_workflow(
+            datafilelist,
+            outputroot,
+            datamaskdims,
+            procmask,
+            numspatiallocs,
+            pcacomponents=pcacomponents,
+            trainedmodelroot=trainedmodelroot,
+            normmethod=normmethod,
+            demean=demean,
+            theprefilter=theprefilter,
+            sigma=sigma,
+            segmentnorm=segmentnorm,
+            datadtype=datadtype,
+        )
+        if returnmodel:
+            return theresults, thefit
+        return theresults
+
     # now read in data
     print("reading in data files")
     numfiles = len(datafilelist)
     filelens = np.zeros((numfiles), dtype=int)
     for idx, datafile in enumerate(datafilelist):
-        print(f"reading {datafile}...")
-        (
-            datafile_img,
-            datafile_data,
-            datafile_hdr,
-            datafiledims,
-            datafilesizes,
-        ) = tide_io.readfromnifti(datafile)
-
+        datafilesizes, datafiledims = tide_io.fmriheaderinfo(datafile)
         xsize, ysize, numslices, timepoints = tide_io.parseniftidims(datafiledims)
-        xdim, ydim, slicethickness, tr = tide_io.parseniftisizes(datafilesizes)
         filelens[idx] = timepoints
         if idx == 0:
             originaldatafiledims = datafiledims.copy()
             originaldatafilesizes = datafilesizes.copy()
-            totaltimepoints = numfiles * timepoints
-            rs_datafile = np.zeros((numspatiallocs, totaltimepoints), dtype=float)
         else:
             if (not tide_io.checkspacedimmatch(datafiledims, originaldatafiledims)) or (
                 not tide_io.checkspaceresmatch(datafilesizes, originaldatafilesizes)
             ):
                 print("all input data files must have the same spatial dimensions")
                 exit()
+    totaltimepoints = np.sum(filelens)
+    startpoints = np.cumsum(filelens) - filelens
+    numprocvoxels = len(proclocs[0])
 
-        # smooth the data
-        if sigma > 0.0:
-            print("\tsmoothing data")
-            for i in range(timepoints):
-                datafile_data[:, :, :, i] = tide_filt.ssmooth(
-                    xdim, ydim, slicethickness, sigma, datafile_data[:, :, :, i]
-                )
-
-        # prefilter the data
-        if theprefilter is not None:
-            print("\ttemporally filtering data")
-            rs_singlefile = datafile_data.reshape((numspatiallocs, timepoints))
-            for i in range(numspatiallocs):
-                rs_singlefile[i, :] = theprefilter.apply(1.0 / tr, rs_singlefile[i, :])
+    nprocs = min(ccalc_mp.getnprocs(nprocs), numfiles)
+    if nprocs > 1:
+        # each worker writes its file into its own columns of a shared, disk backed array
+        print(f"reading {numfiles} files using {nprocs} processes")
+        memmapdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outputroot)))
+        try:
+            memmapname = os.path.join(memmapdir, "rs_datafile.dat")
+            rs_datafile = np.memmap(
+                memmapname, dtype=datadtype, mode="w+", shape=(numprocvoxels, totaltimepoints)
+            )
+            rs_datafile.flush()
+            fileinfo = ccalc_mp.run_multiproc(
+                _readfileintomemmap,
+                [
+                    (
+                        datafile,
+                        memmapname,
+                        (numprocvoxels, totaltimepoints),
+                        startpoints[idx],
+                        procmask,
+                        sigma,
+                        theprefilter,
+                        datadtype,
+                    )
+                    for idx, datafile in enumerate(datafilelist)
+                ],
+                nprocs=nprocs,
+            )
 
-        rs_datafile[:, idx * timepoints : (idx + 1) * timepoints] = datafile_data[
-            :, :, :, :
-        ].reshape((numspatiallocs, timepoints))
+            # the normalization works in place and the decomposition needs the whole array in
+            # memory, so copy it out of the memmap here rather than writing every change back
+            # to disk and keeping the temporary file around until the workflow returns
+            procdata = np.array(rs_datafile)
+            del rs_datafile
+        finally:
+            shutil.rmtree(memmapdir, ignore_errors=True)
+    else:
+        procdata = np.zeros((numprocvoxels, totaltimepoints), dtype=datadtype)
+        fileinfo = [
+            _readfileintoarray(
+                datafile, procdata, startpoints[idx], procmask, sigma, theprefilter, datadtype
+            )
+            for idx, datafile in enumerate(datafilelist)
+        ]
+    datafile_hdr, datafiledims, datafilesizes = fileinfo[-1]
 
     # check dimensions
-    if datamaskname is not None:
-        print("checking mask dimensions")
-        if not tide_io.checkspacedimmatch(datafiledims, datamaskdims):
-            print("input mask spatial dimensions do not match image")
-            exit()
-
-    print("masking arrays")
-    if datamaskname is None:
-        datamaskdims = [1, xsize, ysize, numslices, 1]
-        themaxes = np.max(rs_datafile, axis=1)
-        themins = np.min(rs_datafile, axis=1)
-        thediffs = (themaxes - themins).reshape(numspatiallocs)
-        proclocs = np.where(thediffs > 0.0)
-    procdata = rs_datafile[proclocs, :][0]
+    print("checking mask dimensions")
+    if not tide_io.checkspacedimmatch(datafiledims, datamaskdims):
+        print("input mask spatial dimensions do not match image")
+        exit()
+
+    # only the voxels in the mask were read, so the data is already masked
     print("data shapes:")
-    print(f"\t{rs_datafile.shape[0]} total voxels, {rs_datafile.shape[1]} time points")
+    print(f"\t{numspatiallocs} total voxels, {procdata.shape[1]} time points")
     print(f"\t{procdata.shape[0]} valid voxels, {procdata.shape[1]} time points")
 
+    # normalize the individual segments (each voxel in each file), or the individual images
     if segmentnorm:
-        # normalize the individual segments
-        startpoint = 0
-        themeans = np.zeros((procdata.shape[0], numfiles), dtype=float)
-        thenormfacs = np.zeros((procdata.shape[0], numfiles), dtype=float)
-        for idx in range(numfiles):
-            print(f"normalizing {filelens[idx]} images in segment {idx}")
-            themeans[:, idx] = np.mean(
-                procdata[:, startpoint : startpoint + filelens[idx]], axis=1
-            )
-            if demean:
-                print("demeaning array")
-                for i in range(procdata.shape[0]):
-                    procdata[i, startpoint : startpoint + filelens[idx]] -= themeans[i, idx]
-
-            if normmethod == "None":
-                print("will not normalize timecourses")
-                thenormfacs[:, idx] = themeans[:, idx] * 0.0 + 1.0
-            elif normmethod == "percent":
-                print("will normalize timecourses to percentage of mean")
-                thenormfacs[:, idx] = themeans[:, idx]
-            elif normmethod == "stddev":
-                print("will normalize timecourses to standard deviation of 1.0")
-                thenormfacs[:, idx] = np.std(
-                    procdata[:, startpoint : startpoint + filelens[idx]], axis=1
-                )
-            elif normmethod == "z":
-                print("will normalize timecourses to variance of 1.0")
-                thenormfacs[:, idx] = np.var(
-                    procdata[:, startpoint : startpoint + filelens[idx]], axis=1
-                )
-            elif normmethod == "p2p":
-                print("will normalize timecourses to p-p deviation of 1.0")
-                thenormfacs[:, idx] = np.max(
-                    procdata[:, startpoint : startpoint + filelens[idx]], axis=1
-                ) - np.min(procdata[:, startpoint : startpoint + filelens[idx]], axis=1)
-            elif normmethod == "mad":
-                print("will normalize timecourses to median average deviate of 1.0")
-                thenormfacs[:, idx] = mad(
-                    procdata[:, startpoint : startpoint + filelens[idx]], axis=1
-                )
-            else:
-                print("illegal normalization type")
-                sys.exit()
-            for i in range(procdata.shape[0]):
-                procdata[i, startpoint : startpoint + filelens[idx]] /= thenormfacs[i, idx]
-            startpoint += filelens[idx]
-        procdata = np.nan_to_num(procdata)
+        print(f"normalizing {numfiles} segments")
     else:
-        # normalize the individual images
         print(f"normalizing {procdata.shape[1]} images")
-        themeans = np.mean(procdata, axis=0)
-        if demean:
-            print("demeaning array")
-            for i in range(procdata.shape[1]):
-                procdata[:, i] -= themeans[i]
-
-        if normmethod == "None":
-            print("will not normalize timecourses")
-            thenormfacs = themeans * 0.0 + 1.0
-        elif normmethod == "percent":
-            print("will normalize timecourses to percentage of mean")
-            thenormfacs = themeans
-        elif normmethod == "stddev":
-            print("will normalize timecourses to standard deviation of 1.0")
-            thenormfacs = np.std(procdata, axis=0)
-        elif normmethod == "z":
-            print("will normalize timecourses to variance of 1.0")
-            thenormfacs = np.var(procdata, axis=0)
-        elif normmethod == "p2p":
-            print("will normalize timecourses to p-p deviation of 1.0")
-            thenormfacs = np.max(procdata, axis=0) - np.min(procdata, axis=0)
-        elif normmethod == "mad":
-            print("will normalize timecourses to median average deviate of 1.0")
-            thenormfacs = mad(procdata, axis=0)
-        else:
-            print("illegal normalization type")
-            sys.exit()
-        for i in range(procdata.shape[1]):
-            procdata[:, i] /= thenormfacs[i]
-        procdata = np.nan_to_num(procdata)
+    thenormalizer = ccalc_preproc.SegmentNormalizer(
+        normmethod=normmethod, demean=demean, axis=(1 if segmentnorm else 0)
+    )
+    themeans, thenormfacs = thenormalizer.normalize(procdata, seglens=filelens)
+    np.nan_to_num(procdata, copy=False)
 
     # now perform the decomposition
     if decomptype == "ica":
@@ -252,6 +489,7 @@ def niftidecomp_workflow(
                 message = template.format(type(ex).__name__, modelfilename, ex.args)
                 print(message)
                 sys.exit()
+            thepca.fit(np.transpose(procdata))
         else:
             print("performing pca decomposition")
             if 0.0 < pcacomponents < 1.0:
@@ -264,14 +502,20 @@ def niftidecomp_workflow(
                 pcacomponents = "mle"
                 print("will return", pcacomponents, "components")
             if decomptype == "pca":
-                thepca = PCA(n_components=pcacomponents)
+                thepca = ccalc_math.fitpca(
+                    np.transpose(procdata),
+                    pcacomponents,
+                    solver=pcasolver,
+                    n_oversamples=pcaoversamples,
+                    iterated_power=pcapoweriterations,
+                )
             else:
-                thepca = SparsePCA(n_components=pcacomponents)
+                thepca = SparsePCA(n_components=pcacomponents).fit(np.transpose(procdata))
 
             # save the model
             joblib.dump(thepca, outputroot + "_pca.joblib")
 
-        thefit = thepca.fit(np.transpose(procdata))
+        thefit = thepca
         thetransform = thepca.transform(np.transpose(procdata))
         theinvtrans = np.transpose(thepca.inverse_transform(thetransform))
 
@@ -285,7 +529,9 @@ def niftidecomp_workflow(
         exp_var_pct = 100.0 * thefit.explained_variance_ratio_
 
         # save the component images
-        outputcomponents = np.zeros((numspatiallocs, thecomponents.shape[1]), dtype="float")
+        outputcomponents = np.zeros(
+            (numspatiallocs, thecomponents.shape[1]), dtype=thecomponents.dtype
+        )
         outputcomponents[proclocs, :] = thecomponents[:, :]
         outputcomponents = outputcomponents.reshape(
             (xsize, ysize, numslices, thecomponents.shape[1])
@@ -295,28 +541,16 @@ def niftidecomp_workflow(
         outputcoefficients = np.transpose(thetransform)
 
         # denormalize the dimensionality reduced data
-        if segmentnorm:
-            # normalize the individual segments
-            startpoint = 0
-            for idx in range(numfiles):
-                print(f"denormalizing section {idx} with size {filelens[idx]}")
-                theinvtrans[:, startpoint : startpoint + filelens[idx]] = (thenormfacs[:, idx])[
-                    :, None
-                ] * theinvtrans[:, startpoint : startpoint + filelens[idx]] + (themeans[:, idx])[
-                    :, None
-                ]
-                startpoint += filelens[idx]
-        else:
-            for i in range(totaltimepoints):
-                theinvtrans[:, i] = thenormfacs[i] * theinvtrans[:, i] + themeans[i]
+        print("denormalizing fit data")
+        thenormalizer.denormalize(theinvtrans)
 
         print("writing fit data")
         theheader = datafile_hdr
         theheader["dim"][4] = theinvtrans.shape[1]
-        outinvtrans = np.zeros((numspatiallocs, theinvtrans.shape[1]), dtype="float")
+        outinvtrans = np.zeros((numspatiallocs, theinvtrans.shape[1]), dtype=theinvtrans.dtype)
         outinvtrans[proclocs, :] = theinvtrans[:, :]
         outinvtrans = outinvtrans.reshape((xsize, ysize, numslices, theinvtrans.shape[1]))
-    return (
+    theresults = (
         outputcomponents,
         outputcoefficients,
         outinvtrans,
@@ -327,3 +561,6 @@ def niftidecomp_workflow(
         thenormfacs,
         themeans,
     )
+    if returnmodel:
+        return theresults, thefit
+    return theresults
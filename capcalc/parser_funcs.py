@@ -120,6 +120,25 @@ def is_range(parser, arg):
     return arg
 
 
+def is_intrange(parser, arg):
+    """
+    Check if argument is an int or a MIN:MAX[:STEP] range of ints, and return a list of ints.
+    """
+    try:
+        thevals = [int(x) for x in arg.split(":")]
+    except ValueError:
+        parser.error("Value {0} is not an int or a MIN:MAX[:STEP] range".format(arg))
+    if len(thevals) == 1:
+        return thevals
+    elif len(thevals) in [2, 3]:
+        thestep = thevals[2] if len(thevals) == 3 else 1
+        if thestep < 1 or thevals[0] > thevals[1]:
+            parser.error("Range {0} must have MIN <= MAX and STEP >= 1".format(arg))
+        return list(range(thevals[0], thevals[1] + 1, thestep))
+    else:
+        parser.error("Value {0} is not an int or a MIN:MAX[:STEP] range".format(arg))
+
+
 DEFAULT_FILTER_ORDER = 6
 DEFAULT_PAD_SECONDS = 30.0
 DEFAULT_PERMUTATIONMETHOD = "shuffle"
@@ -223,6 +242,80 @@ def addnormalizationopts(
         )
 
 
+def addmultiprocopts(parser):
+    mp_opts = parser.add_argument_group("Multiprocessing options")
+    mp_opts.add_argument(
+        "--nprocs",
+        dest="nprocs",
+        action="store",
+        type=int,
+        metavar="NPROCS",
+        help=(
+            "Use NPROCS worker processes for multiprocessing. "
+            "Setting NPROCS to less than 1 sets the number of "
+            "worker processes to n_cpus - 1.  Default is 1."
+        ),
+        default=1,
+    )
+
+
+def adddtypeopts(parser, default="float32"):
+    dtype_opts = parser.add_argument_group("Data type options")
+    dtype_opts.add_argument(
+        "--dtype",
+        dest="dtype",
+        action="store",
+        type=str,
+        choices=["float32", "float64"],
+        help=(
+            "Floating point type used to hold the image data in memory.  float32 halves the "
+            "memory needed for large datasets; means and other sums are still accumulated "
+            f'in float64.  Default is "{default}".'
+        ),
+        default=default,
+    )
+
+
+def addpcasolveropts(parser):
+    pca_opts = parser.add_argument_group("PCA solver options")
+    pca_opts.add_argument(
+        "--pcasolver",
+        dest="pcasolver",
+        action="store",
+        type=str,
+        choices=["auto", "full", "arpack", "randomized", "gram"],
+        help=(
+            "SVD solver for the PCA.  auto, full, arpack, and randomized are the scikit-learn "
+            "solvers; gram finds the exact decomposition from the smaller of the sample by "
+            "sample Gram matrix and the feature by feature covariance matrix, and is fastest "
+            "when one data dimension is much smaller than the other.  The time taken "
+            'and the variance captured are printed.  Default is "auto".'
+        ),
+        default="auto",
+    )
+    pca_opts.add_argument(
+        "--pcaoversamples",
+        dest="pcaoversamples",
+        action="store",
+        type=lambda x: is_int(parser, x),
+        metavar="NOVERSAMPLES",
+        help="Number of additional random vectors used by the randomized solver.  Default is 10.",
+        default=10,
+    )
+    pca_opts.add_argument(
+        "--pcapoweriterations",
+        dest="pcapoweriterations",
+        action="store",
+        type=lambda x: is_int(parser, x),
+        metavar="NITER",
+        help=(
+            "Number of power iterations used by the randomized solver.  More iterations are "
+            "slower but more accurate.  Default is chosen by scikit-learn."
+        ),
+        default="auto",
+    )
+
+
 def addversionopts(parser):
     version_opts = parser.add_argument_group("Version options")
     version_opts.add_argument(
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2019-2025 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+Batched second stage preprocessing of feature timecourses.
+"""
+import sys
+
+import numpy as np
+from statsmodels.robust import mad
+
+_NORMDESCRIPTIONS = {
+    "None": "will not normalize timecourses",
+    "percent": "will normalize timecourses to percentage of mean",
+    "stddev": "will normalize timecourses to standard deviation of 1.0",
+    "z": "will normalize timecourses to variance of 1.0",
+    "variance": "will normalize timecourses to variance of 1.0",
+    "p2p": "will normalize timecourses to p-p deviation of 1.0",
+    "mad": "will normalize timecourses to median average deviate of 1.0",
+}
+
+
+def detrendrows(thedata, order=1):
+    r"""Remove a polynomial trend from every row of a 2D array.
+
+    This matches fit.detrend (with demean=False) applied to each row, but solves
+    all of the rows at once against a shared design matrix.
+
+    Parameters
+    ----------
+    thedata : 2D float array
+        The data to detrend, one timecourse per row.  Modified in place.
+    order : int, optional
+        Order of the polynomial trend to remove.  Default is 1.
+
+    Returns
+    -------
+    thedata : 2D float array
+        The detrended data
+    """
+    numpoints = thedata.shape[-1]
+    thetimepoints = np.arange(0.0, numpoints, 1.0) - numpoints / 2.0
+    thedesign = np.vander(thetimepoints, order + 1, increasing=True)
+    thecoffs = thedata @ np.linalg.pinv(thedesign).T
+
+    # as in fit.detrend, the constant term is left in
+    thedata -= thecoffs[:, 1:] @ thedesign[:, 1:].T
+    return thedata
+
+
+def normalizerows(thedata, method="None"):
+    r"""Normalize every row of a 2D array.
+
+    This matches the per-timecourse normalizations in miscmath, applied to each row.
+
+    Parameters
+    ----------
+    thedata : 2D float array
+        The data to normalize, one timecourse per row.  Modified in place.
+    method : {'None', 'percent', 'variance', 'z', 'stddev', 'p2p', 'mad'}, optional
+        Normalization method.  'None' only demeans the data, 'variance' and 'z' divide
+        the demeaned data by its variance.  Any other value leaves the data unchanged.
+        Default is 'None'.
+
+    Returns
+    -------
+    thedata : 2D float array
+        The normalized data
+    """
+    if method == "percent":
+        themeans = np.mean(thedata, axis=1)
+        valid = themeans > 0.0
+        thedata[valid, :] /= themeans[valid, None]
+        thedata[valid, :] -= 1.0
+        return thedata
+    elif method == "mad":
+        SegmentNormalizer(normmethod="mad", center="median", verbose=False).normalize(thedata)
+    elif method in ["None", "variance", "z", "stddev", "p2p"]:
+        SegmentNormalizer(normmethod=method, verbose=False).normalize(thedata)
+    return thedata
+
+
+class SegmentNormalizer:
+    def __init__(
+        self,
+        normmethod="None",
+        demean=True,
+        center="mean",
+        axis=1,
+        blockelements=2**22,
+        verbose=True,
+    ):
+        r"""Normalize a 2D array in place, segment by segment, and undo it afterwards.
+
+        With axis=1 every row is a timecourse and the columns are divided into segments
+        (one per input file, for example); each row of each segment is centered and scaled
+        by its own statistics.  With axis=0 every column is an image, and each column is
+        centered and scaled by its statistics across the rows.  The data is processed a
+        block of rows (or columns) at a time, so no temporary is larger than blockelements.
+
+        Parameters
+        ----------
+        normmethod : {'None', 'percent', 'stddev', 'z', 'variance', 'p2p', 'mad'}, optional
+            The scale factor to divide by: 1.0, the center, the standard deviation, the
+            variance ('z' and 'variance' are synonyms), the peak to peak range, or the
+            median absolute deviation.  Spreads are calculated after centering.  Default
+            is 'None'.
+        demean : bool, optional
+            Subtract the center before scaling.  Default is True.
+        center : {'mean', 'median'}, optional
+            The statistic used as the center.  Default is 'mean'.
+        axis : {1, 0}, optional
+            The axis along which the statistics are calculated.  Default is 1.
+        blockelements : int, optional
+            Approximate number of array elements to process at a time.  Default is 2**22.
+        verbose : bool, optional
+            Print the normalization being applied.  Default is True.
+
+        Notes
+        -----
+        The centers and scale factors are calculated in float64 whatever the type of the
+        data.  Where a scale factor is zero the data is left unscaled.
+        """
+        if normmethod not in _NORMDESCRIPTIONS:
+            print("illegal normalization type")
+            sys.exit()
+        if center not in ["mean", "median"]:
+            print("illegal center type")
+            sys.exit()
+        if axis not in [0, 1]:
+            print("axis must be 0 or 1")
+            sys.exit()
+        self.normmethod = normmethod
+        self.demean = demean
+        self.center = center
+        self.axis = axis
+        self.blockelements = blockelements
+        self.verbose = verbose
+        self.seglens = None
+        self.thecenters = None
+        self.thenormfacs = None
+
+    def _blocks(self, theshape):
+        # yield the index of each segment, and a slice of the data covering one block of it
+        if self.axis == 1:
+            segstarts = np.cumsum([0] + list(self.seglens))
+            for segnum in range(len(self.seglens)):
+                numrows = int(np.max([1, self.blockelements // np.max([1, self.seglens[segnum]])]))
+                for startrow in range(0, theshape[0], numrows):
+                    yield segnum, (
+                        slice(startrow, np.min([startrow + numrows, theshape[0]])),
+                        slice(segstarts[segnum], segstarts[segnum + 1]),
+                    )
+        else:
+            numcols = int(np.max([1, self.blockelements // np.max([1, theshape[0]])]))
+            for startcol in range(0, theshape[1], numcols):
+                yield 0, (slice(None), slice(startcol, np.min([startcol + numcols, theshape[1]])))
+
+    def _stats(self, theslice, segnum):
+        if self.axis == 1:
+            return (theslice[0], segnum), (slice(None), None)
+        else:
+            return theslice[1], (None, slice(None))
+
+    def _scalefactors(self, theblock, thecenters):
+        if self.normmethod == "None":
+            return np.ones_like(thecenters)
+        elif self.normmethod == "percent":
+            return thecenters + 0.0
+        elif self.normmethod == "stddev":
+            return np.std(theblock, axis=self.axis, dtype=np.float64)
+        elif self.normmethod in ["z", "variance"]:
+            return np.var(theblock, axis=self.axis, dtype=np.float64)
+        elif self.normmethod == "p2p":
+            return (np.max(theblock, axis=self.axis) - np.min(theblock, axis=self.axis)).astype(
+                np.float64
+            )
+        else:
+            return mad(theblock, axis=self.axis).astype(np.float64)
+
+    def normalize(self, thedata, seglens=None):
+        r"""Normalize the data in place.
+
+        Parameters
+        ----------
+        thedata : 2D float array
+            The data.  Modified in place.
+        seglens : list of int, optional
+            The lengths of the consecutive segments along axis 1, which must sum to the
+            number of columns.  Ignored if axis is 0.  Default is a single segment.
+
+        Returns
+        -------
+        thecenters : float64 array
+            The center of each row in each segment, with shape (rows, segments), or of
+            each column if axis is 0
+        thenormfacs : float64 array
+            The scale factors, with the same shape as thecenters
+        """
+        if self.verbose:
+            if self.demean:
+                print("demeaning array")
+            print(_NORMDESCRIPTIONS[self.normmethod])
+        if self.axis == 1:
+            if seglens is None:
+                seglens = [thedata.shape[1]]
+            if np.sum(seglens) != thedata.shape[1]:
+                print("segment lengths do not match the data")
+                sys.exit()
+            self.seglens = list(seglens)
+            statshape = (thedata.shape[0], len(self.seglens))
+        else:
+            statshape = (thedata.shape[1],)
+        self.thecenters = np.zeros(statshape, dtype=np.float64)
+        self.thenormfacs = np.ones(statshape, dtype=np.float64)
+        for segnum, theslice in self._blocks(thedata.shape):
+            theblock = thedata[theslice]
+            statindex, expand = self._stats(theslice, segnum)
+            if self.center == "median":
+                thecenters = np.median(theblock, axis=self.axis).astype(np.float64)
+            else:
+                thecenters = np.mean(theblock, axis=self.axis, dtype=np.float64)
+            if self.demean:
+                theblock -= thecenters[expand]
+            thenormfacs = self._scalefactors(theblock, thecenters)
+            theblock /= np.where(thenormfacs != 0.0, thenormfacs, 1.0)[expand]
+            self.thecenters[statindex] = thecenters
+            self.thenormfacs[statindex] = thenormfacs
+        return self.thecenters, self.thenormfacs
+
+    def denormalize(self, thedata):
+        r"""Undo the last normalization in place.
+
+        Parameters
+        ----------
+        thedata : 2D float array
+            Data with the same shape as the data that was normalized (for example, a
+            reconstruction of it).  Modified in place.
+
+        Returns
+        -------
+        thedata : 2D float array
+            The denormalized data
+        """
+        if self.thenormfacs is None:
+            print("denormalize called before normalize")
+            sys.exit()
+        for segnum, theslice in self._blocks(thedata.shape):
+            theblock = thedata[theslice]
+            statindex, expand = self._stats(theslice, segnum)
+            thenormfacs = self.thenormfacs[statindex]
+            theblock *= np.where(thenormfacs != 0.0, thenormfacs, 1.0)[expand]
+            if self.demean:
+                theblock += self.thecenters[statindex][expand]
+        return thedata
+
+
+def preprocesssegments(
+    thedata,
+    Fs,
+    subsegs,
+    detrendorder=1,
+    normmethod="None",
+    thefilter=None,
+    debug=False,
+):
+    r"""Detrend, normalize, and filter every subsegment of every feature timecourse.
+
+    The data is laid out as numsegs repeats of a segment, each of which is made up of
+    the subsegments in subsegs.  All of the subsegments that share a length are
+    gathered into a single (n_features * numsegs, subseglen) block and processed
+    together.
+
+    Parameters
+    ----------
+    thedata : 2D float array
+        The data, with shape (n_features, n_samples).  Modified in place.
+    Fs : float
+        Sample frequency in Hz.
+    subsegs : list of int
+        The lengths of the subsegments making up each segment.  n_samples must be a
+        multiple of their sum.
+    detrendorder : int, optional
+        Order of the polynomial trend to remove from each subsegment.  0 disables
+        detrending.  Default is 1.
+    normmethod : str, optional
+        Normalization method to apply to each subsegment (see normalizerows).
+        Default is 'None'.
+    thefilter : NoncausalFilter, optional
+        Filter to apply to each subsegment.  Default is None.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    thedata : 2D float array
+        The preprocessed data
+    """
+    n_features, n_samples = thedata.shape
+    segsize = int(np.sum(np.asarray(subsegs)))
+    numsegs = n_samples // segsize
+    segview = thedata.reshape((n_features, numsegs, segsize))
+    subsegstarts = np.cumsum([0] + list(subsegs))[:-1]
+    for subseglen in sorted(set(subsegs)):
+        theoffsets = [subsegstarts[i] for i in range(len(subsegs)) if subsegs[i] == subseglen]
+        if debug:
+            print(
+                f"preprocessing {len(theoffsets) * numsegs * n_features} subsegments of length {subseglen}"
+            )
+        theindices = (np.asarray(theoffsets)[:, None] + np.arange(subseglen)[None, :]).reshape(-1)
+        theblock = segview[:, :, theindices].reshape((-1, subseglen))
+        if detrendorder > 0:
+            detrendrows(theblock, order=detrendorder)
+        normalizerows(theblock, method=normmethod)
+        if thefilter is not None:
+            theblock = thefilter.apply(Fs, theblock)
+        segview[:, :, theindices] = theblock.reshape(
+            (n_features, numsegs, len(theoffsets) * subseglen)
+        )
+    if not np.shares_memory(segview, thedata):
+        thedata[:, :] = segview.reshape((n_features, n_samples))
+    return thedata
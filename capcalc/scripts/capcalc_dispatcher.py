@@ -35,6 +35,7 @@ def main():
         "capfromtcs",
         "clustercomp",
         "clusternifti",
+        "exportsegments",
         "fitglm",
         "kmeans",
         "maptoroi",
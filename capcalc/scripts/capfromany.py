@@ -17,6 +17,7 @@
 #
 #
 import argparse
+import os
 import sys
 
 import joblib
@@ -29,13 +30,18 @@ from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.decomposition import PCA, FastICA, IncrementalPCA
 from sklearn.ensemble import GradientBoostingRegressor
 from sklearn.feature_selection import SelectPercentile, f_classif
+from sklearn.metrics import davies_bouldin_score
 from sklearn.preprocessing import StandardScaler
 
 import capcalc.filter as ccalc_filt
 import capcalc.fit as ccalc_fit
 import capcalc.io as ccalc_io
 import capcalc.miscmath as ccalc_math
+import capcalc.multiproc as ccalc_mp
 import capcalc.parser_funcs as pf
+import capcalc.preprocess as ccalc_preproc
+import capcalc.segmentstore as ccalc_segstore
+import capcalc.stagecache as ccalc_cache
 import capcalc.stats as ccalc_stats
 import capcalc.utils as ccalc_utils
 from capcalc.niftidecomp import niftidecomp_workflow
@@ -63,6 +69,15 @@ def niftitotimecourse(
     sigma=0.0,
     maskthresh=0.25,
     segmentnorm=True,
+    streaming=False,
+    nprocs=1,
+    outputfiletype="text",
+    thecache=None,
+    cachekey=None,
+    datadtype=np.float64,
+    pcasolver="auto",
+    pcaoversamples=10,
+    pcapoweriterations="auto",
     debug=False,
 ):
     # read in a list of NIFTI files
@@ -82,8 +97,46 @@ def niftitotimecourse(
     print(f"number of spatial points from mask = {numspatialpoints}")
     themask = datamask_data.reshape((numspatialpoints))
     thevalidpoints = np.where(themask > maskthresh)
+    datamask = themask > maskthresh
 
     # Load the data.  If input is nifti, the first thing to do is reduce dimensionality A LOT
+    thedecomp = None
+    if thecache is not None:
+        thecachedresult = thecache.load("niftitotimecourse", cachekey)
+        if thecachedresult is not None:
+            thedecomp, thepca = thecachedresult
+            if trainedmodelroot is None:
+                joblib.dump(thepca, f"{outputroot}_pca.joblib")
+    if thedecomp is None:
+        thedecomp, thepca = niftidecomp_workflow(
+            infilename,
+            outputroot,
+            datamaskname=datamaskname,
+            decomptype="pca",
+            pcacomponents=n_pca,
+            icacomponents=None,
+            trainedmodelroot=trainedmodelroot,
+            normmethod=normmethod,
+            demean=True,
+            theprefilter=theprefilter,
+            sigma=sigma,
+            maskthresh=maskthresh,
+            segmentnorm=segmentnorm,
+            streaming=streaming,
+            nprocs=nprocs,
+            datadtype=datadtype,
+            pcasolver=pcasolver,
+            pcaoversamples=pcaoversamples,
+            pcapoweriterations=pcapoweriterations,
+            returnmodel=True,
+        )
+        if thecache is not None:
+            # the reconstructed data is only used for debugging, so don't store it
+            thecache.save(
+                "niftitotimecourse",
+                cachekey,
+                (thedecomp[0:2] + (None,) + thedecomp[3:], thepca),
+            )
     (
         outputcomponents,
         inputdata,
@@ -94,27 +147,14 @@ def niftitotimecourse(
         datafilesizes,
         prenormfacs,
         premeans,
-    ) = niftidecomp_workflow(
-        infilename,
-        outputroot,
-        datamaskname=datamaskname,
-        decomptype="pca",
-        pcacomponents=n_pca,
-        icacomponents=None,
-        trainedmodelroot=trainedmodelroot,
-        normmethod=normmethod,
-        demean=True,
-        theprefilter=theprefilter,
-        sigma=sigma,
-        maskthresh=maskthresh,
-        segmentnorm=segmentnorm,
-    )
+    ) = thedecomp
     Fs = 1.0 / datafilesizes[4]
 
     if debug:
         print(f"{outputcomponents.shape=}")
         print(f"{inputdata.shape=}")
-        print(f"{outinvtrans.shape=}")
+        if outinvtrans is not None:
+            print(f"{outinvtrans.shape=}")
         print(f"{exp_var_pct.shape=}")
         print(f"{datafiledims.shape=}")
         print(f"{datafilesizes.shape=}")
@@ -137,7 +177,7 @@ def niftitotimecourse(
         f"{outputroot}_components",
     )
     print("writing out the coefficients")
-    ccalc_io.writenpvecs(inputdata, f"{outputroot}_coefficients.txt")
+    ccalc_io.writenpvecs(inputdata, f"{outputroot}_coefficients.txt", filetype=outputfiletype)
     if debug:
         print("input data shape is ", inputdata.shape)
     ccalc_io.writenpvecs(prenormfacs, f"{outputroot}_prenormfacs.txt")
@@ -146,7 +186,7 @@ def niftitotimecourse(
     startpoint = max([int(starttime * Fs), 0]) + skippts
     endpoint = min([startpoint + int(duration * Fs), numpoints])
     trimmeddata = inputdata[:, startpoint:endpoint]
-    return trimmeddata, outputcomponents, Fs, prenormfacs, premeans, theheader
+    return trimmeddata, outputcomponents, Fs, prenormfacs, premeans, theheader, datamask
 
 
 def readtcsfromtext(
@@ -174,7 +214,8 @@ def readtcsfromtext(
             print("input data shape is ", inputdata.shape)
         numpoints = inputdata.shape[1]
         endpoint = min([startpoint + int(duration * Fs), numpoints])
-        trimmeddata = inputdata[:, startpoint:endpoint]
+        # copy the selected points, since the input may be a read-only memory map
+        trimmeddata = np.array(inputdata[:, startpoint:endpoint])
     elif len(infilename) == 2:
         print("processing two input files")
         inputdata1 = ccalc_io.readvec(infilename[0])
@@ -195,6 +236,34 @@ def readtcsfromtext(
     return trimmeddata
 
 
+def fitclusters(
+    X,
+    n_clusters,
+    minibatch=True,
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_iter=DEFAULT_MAXITER,
+    n_init=DEFAULT_NINIT,
+    initialcenters=None,
+):
+    # train a kmeans model - this is a separate function so it can be run in a worker process
+    if initialcenters is None:
+        theinit = "k-means++"
+    else:
+        theinit = initialcenters
+        max_iter = 1
+
+    print(f"training model with {n_clusters} clusters")
+    if minibatch:
+        kmeans = MiniBatchKMeans(
+            n_clusters=n_clusters, batch_size=batch_size, max_iter=max_iter, init=theinit
+        ).fit(X)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, max_iter=max_iter, n_init=n_init, init=theinit).fit(
+            X
+        )
+    return kmeans
+
+
 def doclustering(
     X,
     outputroot,
@@ -205,27 +274,33 @@ def doclustering(
     n_init=DEFAULT_NINIT,
     trainedmodelroot=None,
     initialcenters=None,
+    thecache=None,
+    cachekey=None,
+    kmeans=None,
 ):
+    # if kmeans is given, it is a model that has already been trained on X, and is just saved
     print("setting up kmeans")
-    if trainedmodelroot is None:
-        if initialcenters is None:
-            theinit = "k-means++"
-        else:
-            theinit = initialcenters
-            max_iter = 1
-
-        print("training model")
-        if minibatch:
-            kmeans = MiniBatchKMeans(
-                n_clusters=n_clusters, batch_size=batch_size, max_iter=max_iter, init=theinit
-            ).fit(X)
-        else:
-            kmeans = KMeans(
-                n_clusters=n_clusters, max_iter=max_iter, n_init=n_init, init=theinit
-            ).fit(X)
+    if kmeans is None and thecache is not None:
+        kmeans = thecache.load("doclustering", cachekey)
+    elif kmeans is not None and thecache is not None:
+        thecache.save("doclustering", cachekey, kmeans)
+    if kmeans is not None:
+        joblib.dump(kmeans, outputroot + "_kmeans.joblib")
+    elif trainedmodelroot is None:
+        kmeans = fitclusters(
+            X,
+            n_clusters,
+            minibatch=minibatch,
+            batch_size=batch_size,
+            max_iter=max_iter,
+            n_init=n_init,
+            initialcenters=initialcenters,
+        )
 
         # save the model
         joblib.dump(kmeans, outputroot + "_kmeans.joblib")
+        if thecache is not None:
+            thecache.save("doclustering", cachekey, kmeans)
     else:
         modelfilename = trainedmodelroot + "_kmeans.joblib"
         print("reading kmeans model from", modelfilename)
@@ -238,6 +313,10 @@ def doclustering(
             message = template.format(type(ex).__name__, modelfilename, ex.args)
             print(message)
             sys.exit()
+        if kmeans.cluster_centers_.dtype != X.dtype:
+            # sklearn can only label data of the same type as the cluster centers
+            print(f"converting cluster centers to {X.dtype} to match the data")
+            kmeans.cluster_centers_ = kmeans.cluster_centers_.astype(X.dtype)
 
     # save the clusters
     theclusters = np.transpose(kmeans.cluster_centers_)
@@ -258,6 +337,366 @@ def doclustering(
     return kmeans
 
 
+def summarizeclusters(
+    X,
+    kmeans,
+    outputroot,
+    n_clusters,
+    args,
+    theniftiheader,
+    outputcomponents,
+    groups,
+    numsegs,
+    segsize,
+    sampletime,
+    thecache=None,
+    clusterkey=None,
+    datamask=None,
+):
+    # project the cluster centers to image space, then label the states and calculate
+    # and save all of the state statistics for a clustering of X
+    n_features = X.shape[1]
+
+    # project the clusters to image space and write them out
+    theclusters = kmeans.cluster_centers_
+    numclusters = theclusters.shape[0]
+    projclusterheader = theniftiheader.copy()
+    projclusterheader["dim"][4] = numclusters
+    projclusters = ccalc_utils.maskedprojection(
+        outputcomponents, np.transpose(theclusters), themask=datamask, debug=args.debug
+    )
+    ccalc_io.savetonifti(projclusters, projclusterheader, outputroot + "_clustercenters")
+
+    # generate the state labels
+    thestatelabels = kmeans.predict(X)
+    print("thestatelabels shape", thestatelabels.shape)
+
+    # save the states
+    ccalc_io.writenpvecs(
+        thestatelabels, outputroot + "_statelabels.txt", filetype=args.outputfiletype
+    )
+
+    # find most important features
+    print("finding most important features")
+    print(
+        "calling SelectPercentiles with X and y of dimensions",
+        X.shape,
+        thestatelabels.shape,
+    )
+    selector = SelectPercentile(f_classif, percentile=10)
+    selector.fit(X, thestatelabels)
+    print(selector.get_params())
+    X_indices = np.arange(X.shape[-1])
+    scores = -np.nan_to_num(np.log10(np.nan_to_num(selector.pvalues_)))
+    scores /= scores.max()
+    sortedscores = np.sort(np.nan_to_num(selector.scores_))[::-1]
+    print(sortedscores)
+    if args.display:
+        plt.bar(
+            X_indices - 0.45,
+            scores,
+            width=0.2,
+            label=r"Univariate score ($-Log(p_{value})$)",
+            color="darkorange",
+        )
+        print(selector.get_support(indices=True))
+        fig = plt.subplots(1, 1)
+        plt.plot(sortedscores)
+        plt.show()
+
+    # now do some stats!
+    statsresult = None
+    if thecache is not None:
+        statskey = thecache.key(
+            "statestats",
+            {
+                "n_clusters": n_clusters,
+                "segsize": int(segsize),
+                "summaryonly": args.summaryonly,
+                "minoutlength": args.minoutlength,
+                "minholdlength": args.minholdlength,
+            },
+            parentkeys=[clusterkey],
+        )
+        statsresult = thecache.load("statestats", statskey)
+    if statsresult is None:
+        thesilavgs, thesilclusterstats = ccalc_utils.silhouette_test(
+            X, kmeans, n_clusters, numsegs, segsize, args.summaryonly
+        )
+        rawtransmats, segmentstats, lenlists = ccalc_utils.statestats_batch(
+            np.reshape(thestatelabels, (numsegs, segsize)),
+            n_clusters,
+            0,
+            minout=args.minoutlength,
+            minhold=args.minholdlength,
+        )
+        allsegmentstats = [
+            (rawtransmats[segment], segmentstats[segment], lenlists[segment])
+            for segment in range(numsegs)
+        ]
+        if thecache is not None:
+            thecache.save(
+                "statestats", statskey, (thesilavgs, thesilclusterstats, allsegmentstats)
+            )
+    else:
+        thesilavgs, thesilclusterstats, allsegmentstats = statsresult
+    ccalc_io.writenpvecs(thesilavgs, outputroot + "_silhouettesegmentstats.txt")
+
+    silinfo = []
+    for state in range(n_clusters):
+        silinfo.append([])
+    print("shape going in:", thestatelabels.shape)
+    statelabelsbysegment = np.reshape(thestatelabels, (-1, segsize))
+    print("shape coming out:", statelabelsbysegment.shape)
+
+    # do the subsegment summaries
+    for key in groups:
+        groups[key]["meaninstate"] = np.zeros(
+            (n_clusters, groups[key]["seglen"][0]), dtype="float"
+        )
+        groups[key]["stdinstate"] = np.zeros((n_clusters, groups[key]["seglen"][0]), dtype="float")
+        for state in range(n_clusters):
+            tcbyseg = []
+            for seginstance in range(len(groups[key]["segnum"])):
+                startpos = groups[key]["segstart"][seginstance]
+                endpos = startpos + groups[key]["seglen"][seginstance]
+                tcbyseg.append(np.where(statelabelsbysegment[:, startpos:endpos] == state, 1, 0))
+            groups[key]["meaninstate"][state, :] = np.mean(np.concatenate(tcbyseg, axis=0), axis=0)
+            groups[key]["stdinstate"][state, :] = np.std(np.concatenate(tcbyseg, axis=0), axis=0)
+        ccalc_io.writenpvecs(
+            groups[key]["meaninstate"],
+            outputroot + "_" + str(key) + "_meaninstate.txt",
+        )
+        ccalc_io.writenpvecs(
+            groups[key]["stdinstate"], outputroot + "_" + str(key) + "_stdinstate.txt"
+        )
+    allstatestats = []
+    allrawtransmats = []
+    alllenlists = []
+    for i in range(n_clusters):
+        alllenlists.append([])
+    for segment in range(numsegs):
+        rawtransmat, thestats, lenlist = allsegmentstats[segment]
+        allrawtransmats.append(rawtransmat * 1.0)
+        allstatestats.append(thestats)
+        for i in range(n_clusters):
+            alllenlists[i] += lenlist[i]
+        print("Segment %d average silhouette Coefficient: %0.3f" % (segment, thesilavgs[segment]))
+        for state in range(n_clusters):
+            if thestats[state, 2] > 0:
+                silinfo[state].append(thesilclusterstats[segment, 0, state])
+
+    # write all of the per segment results in one go
+    if args.summaryonly:
+        segsilclusterstats = None
+    else:
+        segsilclusterstats = thesilclusterstats
+    storename = ccalc_segstore.writesegmentstore(
+        outputroot,
+        statelabelsbysegment,
+        np.asarray(allrawtransmats),
+        np.asarray(allstatestats),
+        sampletime,
+        silclusterstats=segsilclusterstats,
+        debug=args.debug,
+    )
+    if args.segmentoutput == "files":
+        ccalc_segstore.exportsegmentstore(
+            storename,
+            outputroot=outputroot,
+            statelabelfiletype=args.outputfiletype,
+            debug=args.debug,
+        )
+
+    # now generate some summary information
+    overallstatestats = []
+    thetimestats = []
+    alllens = 0
+    for i in range(n_clusters):
+        alllens += np.sum(np.asarray(alllenlists[i], dtype="float"))
+
+    for i in range(n_clusters):
+        lenarray = np.asarray(alllenlists[i], dtype="float")
+        if len(lenarray) > 2:
+            overallstatestats.append(
+                [
+                    100.0 * np.sum(lenarray) / alllens,
+                    len(lenarray),
+                    np.sum(lenarray),
+                    np.min(lenarray),
+                    np.max(lenarray),
+                    np.mean(lenarray),
+                    np.median(lenarray),
+                    np.std(lenarray),
+                ]
+            )
+            thetimestats.append(
+                [
+                    100.0 * np.sum(lenarray) / alllens,
+                    sampletime * len(lenarray),
+                    sampletime * np.sum(lenarray),
+                    sampletime * np.min(lenarray),
+                    sampletime * np.max(lenarray),
+                    sampletime * np.mean(lenarray),
+                    sampletime * np.median(lenarray),
+                    sampletime * np.std(lenarray),
+                ]
+            )
+
+    cols = [
+        "% TRs in state",
+        "Number of runs in state",
+        "Total TRs in state",
+        "Min run (TRs)",
+        "Max run (TRs)",
+        "Mean run (TRs)",
+        "Median run (TRs)",
+        "StdDev run (TRs)",
+    ]
+    df = pd.DataFrame(data=overallstatestats, columns=cols)
+    df.to_csv(
+        outputroot + "_overall_statestats.csv",
+        index=False,
+    )
+
+    cols = [
+        "% Seconds in state",
+        "Number of runs in state",
+        "Total seconds in state",
+        "Min run (sec)",
+        "Max run (sec)",
+        "Mean run (sec)",
+        "Median run (sec)",
+        "StdDev run (sec)",
+    ]
+    df = pd.DataFrame(data=thetimestats, columns=cols)
+    df.to_csv(
+        outputroot + "_overall_statetimestats.csv",
+        index=False,
+    )
+
+    outputaffine = np.eye(4)
+    overallrawtransmat = allrawtransmats[0] * 0.0
+    if args.debug:
+        print(f"{len(allrawtransmats)=}")
+    for segment in range(numsegs):
+        overallrawtransmat += allrawtransmats[segment]
+    overallnormtransmat, overalloffdiagtransmat = ccalc_utils.calcmats(
+        overallrawtransmat, n_clusters
+    )
+    init_img = nib.Nifti1Image(overallnormtransmat, outputaffine)
+    init_hdr = init_img.header
+    init_sizes = init_hdr["pixdim"]
+    ccalc_io.savetonifti(
+        np.transpose(overallrawtransmat),
+        init_hdr,
+        outputroot + "_overall_rawtransmat",
+    )
+    ccalc_io.savetonifti(
+        np.transpose(overallnormtransmat),
+        init_hdr,
+        outputroot + "_overall_normtransmat",
+    )
+    ccalc_io.savetonifti(
+        np.transpose(overalloffdiagtransmat),
+        init_hdr,
+        outputroot + "_overall_offdiagtransmat",
+    )
+    themaxlen = 0
+    for i in range(n_clusters):
+        themaxlen = int(np.max([themaxlen, np.max(alllenlists[i])]))
+    for i in range(n_clusters):
+        thishist = ccalc_stats.makeandsavehistogram(
+            np.array(alllenlists[i]),
+            themaxlen,
+            0,
+            outputroot + "_" + str(i).zfill(2) + "_lenhist",
+            therange=[1, themaxlen],
+        )
+    silavgs = []
+    if not args.summaryonly:
+        for state in range(n_clusters):
+            silavgs.append(np.mean(np.asarray(silinfo[state], dtype="float")))
+        ccalc_io.writenpvecs(
+            np.asarray(silavgs, dtype="float"),
+            outputroot + "_overallsilhouettemean.txt",
+        )
+    pctarray = np.asarray(allstatestats[:], dtype="float")
+    cols = [
+        "% TRs in state",
+        "Number of runs in state",
+        "Total TRs in state",
+        "Min run (TRs)",
+        "Max run (TRs)",
+        "Mean run (TRs)",
+        "Median run (TRs)",
+        "StdDev run (TRs)",
+    ]
+    df = pd.DataFrame(data=np.mean(pctarray, axis=0), columns=cols)
+    df.to_csv(
+        outputroot + "_seg_" + str(segment).zfill(4) + "_overallmeanstats.csv",
+        index=False,
+    )
+    # ccalc_io.writenpvecs(np.transpose(np.mean(pctarray, axis=0)), outputroot + '_overallmeanstats.txt')
+
+    if args.doGBR:
+        clf = GradientBoostingRegressor().fit(X, thestatelabels)
+        print("GBR fitting score is:", clf.score(X, thestatelabels))
+        ccalc_io.writenpvecs(
+            np.reshape(clf.feature_importances_, (n_features, 1)),
+            outputroot + "_featureimportances.txt",
+        )
+
+    return thestatelabels, thesilavgs
+
+
+def _cachekeyfiles(filenames, isnifti=False):
+    # the files that go into a cache key are checksummed before they are loaded, so resolve
+    # them here (nifti names may omit the extension) and report missing files the same way
+    # as the loaders would
+    thefiles = []
+    for filename in filenames:
+        try:
+            if filename is None:
+                thefiles.append(None)
+            elif isnifti:
+                thefiles.append(ccalc_io._findniftifile(filename))
+            else:
+                os.stat(filename)
+                thefiles.append(filename)
+        except Exception as ex:
+            template = (
+                "An exception of type {0} occurred when trying to open {1}. Arguments:\n{2!r}"
+            )
+            message = template.format(type(ex).__name__, filename, ex.args)
+            print(message)
+            sys.exit()
+    return thefiles
+
+
+def _clusterkey(thecache, args, n_clusters, preprockey):
+    # cache key for the clustering stage
+    if thecache is None:
+        return None
+    clusterfiles = []
+    if args.trainedmodelroot is not None:
+        clusterfiles.append(args.trainedmodelroot + "_kmeans.joblib")
+    if args.initialcenters is not None:
+        clusterfiles.append(args.initialcenters)
+    return thecache.key(
+        "doclustering",
+        {
+            "minibatch": args.minibatch,
+            "batch_size": args.batch_size,
+            "n_clusters": n_clusters,
+            "max_iter": args.max_iter,
+            "n_init": args.n_init,
+        },
+        inputfiles=_cachekeyfiles(clusterfiles),
+        parentkeys=[preprockey],
+    )
+
+
 def _get_parser():
     # get the command line parameters
     parser = argparse.ArgumentParser(
@@ -344,6 +783,16 @@ def _get_parser():
         ),
         default=True,
     )
+    preproc_opts.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Read and decompose the NIFTI files one at a time using incremental PCA.  "
+            "This bounds memory use by the size of a single file, at the cost of reading "
+            "each file twice."
+        ),
+        default=False,
+    )
     preproc_opts.add_argument(
         "--skip",
         type=int,
@@ -364,14 +813,29 @@ def _get_parser():
     # normalization
     pf.addnormalizationopts(parser, phases=["pre", "post"], defaultmethods=["percent", "z"])
 
+    # multiprocessing
+    pf.addmultiprocopts(parser)
+
+    # data type
+    pf.adddtypeopts(parser)
+
+    # pca solver
+    pf.addpcasolveropts(parser)
+
     # clustering
     cluster_opts = parser.add_argument_group("Clustering options")
     cluster_opts.add_argument(
         "--n_clusters",
-        type=int,
+        type=lambda x: pf.is_intrange(parser, x),
         metavar="N_CLUSTERS",
-        help=f"Number of clusters to find.  Default is {DEFAULT_NCLUSTERS}.",
-        default=DEFAULT_NCLUSTERS,
+        help=(
+            f"Number of clusters to find.  Default is {DEFAULT_NCLUSTERS}.  "
+            "Specify a range as MIN:MAX (or MIN:MAX:STEP) to fit every number of clusters "
+            "in the range from the same preprocessed data, writing the results for each "
+            "to OUTPUTROOT_kNN and a summary of the fit quality to "
+            "OUTPUTROOT_clustersweep.csv.  Use --nprocs to fit the models in parallel."
+        ),
+        default=[DEFAULT_NCLUSTERS],
     )
     cluster_opts.add_argument(
         "--max_iter",
@@ -475,6 +939,47 @@ def _get_parser():
     )
 
     misc_opts = parser.add_argument_group("Miscellaneous options")
+    misc_opts.add_argument(
+        "--cachedir",
+        dest="cachedir",
+        action="store",
+        type=str,
+        metavar="DIR",
+        help=(
+            "Keep the results of each processing stage (decomposition, preprocessing, "
+            "clustering, and state statistics) in DIR, and reuse them in later runs "
+            "whenever the input files and the options that affect a stage are unchanged.  "
+            "Default is not to cache results."
+        ),
+        default=None,
+    )
+    misc_opts.add_argument(
+        "--outputfiletype",
+        dest="outputfiletype",
+        action="store",
+        type=str,
+        choices=["npy", "text"],
+        help=(
+            "Format for the coefficient, preprocessed data, and state label files.  "
+            '"npy" writes numpy binary files that are memory mapped when read back in; '
+            '"text" writes tab separated text files.  Default is "npy".'
+        ),
+        default="npy",
+    )
+    misc_opts.add_argument(
+        "--segmentoutput",
+        dest="segmentoutput",
+        action="store",
+        type=str,
+        choices=["store", "files"],
+        help=(
+            "How to save the per segment results.  "
+            '"store" writes them all to a single file, OUTPUTROOT_segments.npz; '
+            '"files" also writes the original set of OUTPUTROOT_seg_XXXX_* files for every '
+            'segment.  Default is "store".'
+        ),
+        default="store",
+    )
     misc_opts.add_argument(
         "--debug",
         dest="debug",
@@ -496,6 +1001,16 @@ def capfromany_main():
 
     args, theprefilter = pf.postprocessfilteropts(args, debug=args.debug)
 
+    # see if we are fitting more than one number of clusters
+    clustercounts = args.n_clusters
+    sweepmode = len(clustercounts) > 1
+    if sweepmode:
+        if (args.trainedmodelroot is not None) or (args.initialcenters is not None):
+            print("cannot sweep the number of clusters when using a trained model or centers")
+            sys.exit()
+    else:
+        args.n_clusters = clustercounts[0]
+
     if args.debug:
         print(args)
 
@@ -588,9 +1103,40 @@ def capfromany_main():
         print("illegal prenormalization type")
         sys.exit()
 
+    # set up the stage cache.  The filter settings are recorded now, since applying the filter
+    # can adjust them.
+    if args.cachedir is not None:
+        thecache = ccalc_cache.StageCache(args.cachedir, debug=args.debug)
+    else:
+        thecache = None
+    filtersig = ccalc_cache.filtersignature(theprefilter)
+
     # read in the files and get everything trimmed to the right length
     if ccalc_io.checkifnifti(args.infilename[0]):
         inputisnifti = True
+        if thecache is not None:
+            modelfiles = []
+            if args.trainedmodelroot is not None:
+                modelfiles = [args.trainedmodelroot + "_pca.joblib"]
+            decompkey = thecache.key(
+                "niftitotimecourse",
+                {
+                    "n_pca": args.n_pca,
+                    "prefilter": filtersig,
+                    "prenormmethod": args.prenormmethod,
+                    "sigma": args.sigma,
+                    "segmentnorm": args.segmentnorm,
+                    "streaming": args.streaming,
+                    "dtype": args.dtype,
+                    "pcasolver": args.pcasolver,
+                    "pcaoversamples": args.pcaoversamples,
+                    "pcapoweriterations": args.pcapoweriterations,
+                },
+                inputfiles=_cachekeyfiles(args.infilename + [args.datamaskname], isnifti=True)
+                + _cachekeyfiles(modelfiles),
+            )
+        else:
+            decompkey = None
         (
             trimmeddata,
             outputcomponents,
@@ -598,6 +1144,7 @@ def capfromany_main():
             prenormfacs,
             premeans,
             theniftiheader,
+            datamask,
         ) = niftitotimecourse(
             args.infilename,
             args.datamaskname,
@@ -611,6 +1158,15 @@ def capfromany_main():
             sigma=args.sigma,
             skippts=args.skip,
             segmentnorm=args.segmentnorm,
+            streaming=args.streaming,
+            nprocs=args.nprocs,
+            outputfiletype=args.outputfiletype,
+            thecache=thecache,
+            cachekey=decompkey,
+            datadtype=args.dtype,
+            pcasolver=args.pcasolver,
+            pcaoversamples=args.pcaoversamples,
+            pcapoweriterations=args.pcapoweriterations,
         )
         sampletime = 1.0 / Fs
     else:
@@ -646,44 +1202,45 @@ def capfromany_main():
     if len(subsegs) > 1:
         print(f"    each segment is broken into {len(subsegs)} subsegments of length {subsegs}")
 
-    for feature in range(n_features):
+    preprocresult = None
+    if thecache is not None:
+        preprockey = thecache.key(
+            "preprocessing",
+            {
+                "skip": args.skip,
+                "starttime": args.starttime,
+                "duration": args.duration,
+                "subsegs": [int(x) for x in subsegs],
+                "detrendorder": args.detrendorder,
+                "postnormmethod": args.postnormmethod,
+                "prefilter": filtersig,
+                "standardscale": args.standardscale,
+            },
+            parentkeys=[decompkey],
+        )
+        preprocresult = thecache.load("preprocessing", preprockey)
+    else:
+        preprockey = None
+    if preprocresult is None:
+        ccalc_preproc.preprocesssegments(
+            reformdata,
+            Fs,
+            subsegs,
+            detrendorder=args.detrendorder,
+            normmethod=args.postnormmethod,
+            thefilter=theprefilter,
+            debug=args.debug,
+        )
+        X = np.nan_to_num(np.transpose(reformdata))
         if args.debug:
-            print("second stage feature preprocessing ", feature)
-        for segment in range(numsegs):
-            subsegstart = segment * segsize
-            for subseglen in subsegs:
-                if args.detrendorder > 0:
-                    segdata = ccalc_fit.detrend(
-                        reformdata[feature, subsegstart : subsegstart + subseglen]
-                    )
-                else:
-                    segdata = reformdata[feature, subsegstart : subsegstart + subseglen]
-
-                if args.postnormmethod == "None":
-                    segnorm = segdata - np.mean(segdata)
-                elif args.postnormmethod == "percent":
-                    segnorm = ccalc_math.pcnormalize(segdata)
-                elif args.postnormmethod == "z":
-                    segnorm = ccalc_math.varnormalize(segdata)
-                elif args.postnormmethod == "stddev":
-                    segnorm = ccalc_math.stdnormalize(segdata)
-                elif args.postnormmethod == "p2p":
-                    segnorm = ccalc_math.ppnormalize(segdata)
-                elif args.postnormmethod == "mad":
-                    segnorm = ccalc_math.madnormalize(segdata)
-                else:
-                    segnorm = segdata
-
-                reformdata[feature, subsegstart : subsegstart + subseglen] = theprefilter.apply(
-                    Fs, segnorm
-                )
-                subsegstart += subseglen
-    X = np.nan_to_num(np.transpose(reformdata))
-    if args.debug:
-        print(f"X matrix has dimensions {X.shape}")
+            print(f"X matrix has dimensions {X.shape}")
 
-    if args.standardscale:
-        X = StandardScaler().fit_transform(X)
+        if args.standardscale:
+            X = StandardScaler().fit_transform(X)
+        if thecache is not None:
+            thecache.save("preprocessing", preprockey, (reformdata, X))
+    else:
+        reformdata, X = preprocresult
 
     """if preprocessingtype == "pca":
         print("running PCA")
@@ -756,378 +1313,119 @@ def capfromany_main():
             np.transpose(theica.components_), outputroot + "_icacomponents_transpose.txt"
         )"""
 
-    ccalc_io.writenpvecs(reformdata, args.outputroot + "_preprocessed.txt")
+    ccalc_io.writenpvecs(
+        reformdata, args.outputroot + "_preprocessed.txt", filetype=args.outputfiletype
+    )
     if args.preproconly:
         print("preprocessing done - quitting")
         sys.exit()
 
-    kmeans = doclustering(
-        X,
-        args.outputroot,
-        minibatch=args.minibatch,
-        batch_size=args.batch_size,
-        n_clusters=args.n_clusters,
-        max_iter=args.max_iter,
-        n_init=args.n_init,
-        trainedmodelroot=args.trainedmodelroot,
-        initialcenters=args.initialcenters,
-    )
-
-    # project the clusters to image space and write them out
-    theclusters = kmeans.cluster_centers_
-    numclusters, numfeatures = theclusters.shape
-    projclusterheader = theniftiheader.copy()
-    projclusterheader["dim"][4] = numclusters
-    xdim, ydim, zdim, dummy = ccalc_io.parseniftidims(projclusterheader["dim"])
-    projclusters = np.zeros((xdim, ydim, zdim, theclusters.shape[0]), dtype=float)
-    for clusternum in range(numclusters):
-        for pcacomp in range(numfeatures):
-            projclusters[:, :, :, clusternum] += (
-                theclusters[clusternum, pcacomp] * outputcomponents[:, :, :, pcacomp]
-            )
-    ccalc_io.savetonifti(projclusters, projclusterheader, args.outputroot + "_clustercenters")
-
-    # generate the state labels
-    thestatelabels = kmeans.predict(X)
-    print("thestatelabels shape", thestatelabels.shape)
-
-    # save the states
-    ccalc_io.writenpvecs(thestatelabels, args.outputroot + "_statelabels.txt")
-
-    # find most important features
-    print("finding most important features")
-    print(
-        "calling SelectPercentiles with X and y of dimensions",
-        X.shape,
-        thestatelabels.shape,
-    )
-    selector = SelectPercentile(f_classif, percentile=10)
-    selector.fit(X, thestatelabels)
-    print(selector.get_params())
-    X_indices = np.arange(X.shape[-1])
-    scores = -np.nan_to_num(np.log10(np.nan_to_num(selector.pvalues_)))
-    scores /= scores.max()
-    sortedscores = np.sort(np.nan_to_num(selector.scores_))[::-1]
-    print(sortedscores)
-    if args.display:
-        plt.bar(
-            X_indices - 0.45,
-            scores,
-            width=0.2,
-            label=r"Univariate score ($-Log(p_{value})$)",
-            color="darkorange",
-        )
-        print(selector.get_support(indices=True))
-        fig = plt.subplots(1, 1)
-        plt.plot(sortedscores)
-        plt.show()
-
-    # now do some stats!
-    thesilavgs, thesilclusterstats = ccalc_utils.silhouette_test(
-        X, kmeans, args.n_clusters, numsegs, segsize, args.summaryonly
-    )
-    ccalc_io.writenpvecs(thesilavgs, args.outputroot + "_silhouettesegmentstats.txt")
-
-    silinfo = []
-    for state in range(args.n_clusters):
-        silinfo.append([])
-    print("shape going in:", thestatelabels.shape)
-    statelabelsbysegment = np.reshape(thestatelabels, (-1, segsize))
-    print("shape coming out:", statelabelsbysegment.shape)
-
-    # do the subsegment summaries
-    for key in groups:
-        groups[key]["meaninstate"] = np.zeros(
-            (args.n_clusters, groups[key]["seglen"][0]), dtype="float"
-        )
-        groups[key]["stdinstate"] = np.zeros(
-            (args.n_clusters, groups[key]["seglen"][0]), dtype="float"
-        )
-        for state in range(args.n_clusters):
-            tcbyseg = []
-            for seginstance in range(len(groups[key]["segnum"])):
-                startpos = groups[key]["segstart"][seginstance]
-                endpos = startpos + groups[key]["seglen"][seginstance]
-                tcbyseg.append(np.where(statelabelsbysegment[:, startpos:endpos] == state, 1, 0))
-            groups[key]["meaninstate"][state, :] = np.mean(np.concatenate(tcbyseg, axis=0), axis=0)
-            groups[key]["stdinstate"][state, :] = np.std(np.concatenate(tcbyseg, axis=0), axis=0)
-        ccalc_io.writenpvecs(
-            groups[key]["meaninstate"],
-            args.outputroot + "_" + str(key) + "_meaninstate.txt",
-        )
-        ccalc_io.writenpvecs(
-            groups[key]["stdinstate"], args.outputroot + "_" + str(key) + "_stdinstate.txt"
+    if not sweepmode:
+        clusterkey = _clusterkey(thecache, args, args.n_clusters, preprockey)
+        kmeans = doclustering(
+            X,
+            args.outputroot,
+            minibatch=args.minibatch,
+            batch_size=args.batch_size,
+            n_clusters=args.n_clusters,
+            max_iter=args.max_iter,
+            n_init=args.n_init,
+            trainedmodelroot=args.trainedmodelroot,
+            initialcenters=args.initialcenters,
+            thecache=thecache,
+            cachekey=clusterkey,
         )
-    allstatestats = []
-    allrawtransmats = []
-    alllenlists = []
-    for i in range(args.n_clusters):
-        alllenlists.append([])
-    for segment in range(numsegs):
-        thesestatelabels = thestatelabels[segment * segsize : (segment + 1) * segsize]
 
-        outputaffine = np.eye(4)
-        rawtransmat, thestats, lenlist = ccalc_utils.statestats(
-            thesestatelabels,
+        summarizeclusters(
+            X,
+            kmeans,
+            args.outputroot,
             args.n_clusters,
-            0,
-            minout=args.minoutlength,
-            minhold=args.minholdlength,
-        )
-        allrawtransmats.append(rawtransmat * 1.0)
-        allstatestats.append(thestats)
-        for i in range(args.n_clusters):
-            alllenlists[i] += lenlist[i]
-        normtransmat, offdiagtransmat = ccalc_utils.calcmats(rawtransmat, args.n_clusters)
-        init_img = nib.Nifti1Image(normtransmat, outputaffine)
-        init_hdr = init_img.header
-        init_sizes = init_hdr["pixdim"]
-        ccalc_io.savetonifti(
-            np.transpose(rawtransmat),
-            init_hdr,
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_rawtransmat",
-        )
-        ccalc_io.savetonifti(
-            np.transpose(normtransmat),
-            init_hdr,
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_normtransmat",
-        )
-        ccalc_io.savetonifti(
-            np.transpose(offdiagtransmat),
-            init_hdr,
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_offdiagtransmat",
-        )
-
-        # write as text as well
-        rows = []
-        cols = []
-        for i in range(args.n_clusters):
-            rows.append("from state " + str(i + 1))
-            cols.append("to state " + str(i + 1))
-        df = pd.DataFrame(data=rawtransmat, columns=cols)
-        df.insert(0, "sources", pd.Series(rows))
-        df.to_csv(
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_rawtransmat.csv",
-            index=False,
-        )
-        df = pd.DataFrame(data=normtransmat, columns=cols)
-        df.insert(0, "sources", pd.Series(rows))
-        df.to_csv(
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_normtransmat.csv",
-            index=False,
-        )
-        df = pd.DataFrame(data=offdiagtransmat, columns=cols)
-        df.insert(0, "sources", pd.Series(rows))
-        df.to_csv(
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_offdiagtransmat.csv",
-            index=False,
-        )
-        # rawtransmat files are an args.n_clusters by args.n_clusters matrix with the total number of transitions from each state to each other state.
-        # normtransmat files are an args.n_clusters by args.n_clusters matrix with the total for of transitions from each state to each other state.
-
-        cols = [
-            "% TRs in state",
-            "Number of runs in state",
-            "Total TRs in state",
-            "Min run (TRs)",
-            "Max run (TRs)",
-            "Mean run (TRs)",
-            "Median run (TRs)",
-            "StdDev run (TRs)",
-        ]
-        df = pd.DataFrame(data=thestats, columns=cols)
-        df.to_csv(
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_statestats.csv",
-            index=False,
+            args,
+            theniftiheader,
+            outputcomponents,
+            groups,
+            numsegs,
+            segsize,
+            sampletime,
+            thecache=thecache,
+            clusterkey=clusterkey,
+            datamask=datamask,
         )
-        # ccalc_io.writenpvecs(np.transpose(thestats), outputroot + '_seg_' + str(segment).zfill(4) + '_statestats.txt')
-        thetimestats = 1.0 * thestats
-        thetimestats[:, 2:] *= sampletime
-        cols = [
-            "% Seconds in state",
-            "Number of runs in state",
-            "Total seconds in state",
-            "Min run (sec)",
-            "Max run (sec)",
-            "Mean run (sec)",
-            "Median run (sec)",
-            "StdDev run (sec)",
+    else:
+        # fit all of the models that aren't already cached, in parallel
+        clusterkeys = {}
+        kmeansmodels = {}
+        for n_clusters in clustercounts:
+            clusterkeys[n_clusters] = _clusterkey(thecache, args, n_clusters, preprockey)
+            if thecache is not None:
+                kmeansmodels[n_clusters] = thecache.load("doclustering", clusterkeys[n_clusters])
+        tofit = [
+            n_clusters for n_clusters in clustercounts if kmeansmodels.get(n_clusters) is None
         ]
-        df = pd.DataFrame(data=thetimestats, columns=cols)
-        df.to_csv(
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_statetimestats.csv",
-            index=False,
-        )
-        # ccalc_io.writenpvecs(np.transpose(thetimestats), outputroot + '_seg_' + str(segment).zfill(4) + '_statetimestats.txt')
-
-        ccalc_io.writenpvecs(
-            thesestatelabels,
-            args.outputroot + "_seg_" + str(segment).zfill(4) + "_statelabels.txt",
+        print(f"fitting {len(tofit)} models with {ccalc_mp.getnprocs(args.nprocs)} processes")
+        fittedmodels = ccalc_mp.run_multiproc(
+            fitclusters,
+            [
+                (X, n_clusters, args.minibatch, args.batch_size, args.max_iter, args.n_init)
+                for n_clusters in tofit
+            ],
+            nprocs=args.nprocs,
+            debug=args.debug,
         )
-        print("Segment %d average silhouette Coefficient: %0.3f" % (segment, thesilavgs[segment]))
-        for state in range(args.n_clusters):
-            tc = np.where(thesestatelabels == state, 1, 0)
-            ccalc_io.writenpvecs(
-                tc,
-                args.outputroot
-                + "_seg_"
-                + str(segment).zfill(4)
-                + "_instate_"
-                + str(state).zfill(2)
-                + ".txt",
+        for n_clusters, kmeans in zip(tofit, fittedmodels):
+            kmeansmodels[n_clusters] = kmeans
+
+        # write out the results for each model and summarize
+        sweepstats = []
+        for n_clusters in clustercounts:
+            print(f"summarizing clustering with {n_clusters} clusters")
+            thisoutputroot = f"{args.outputroot}_k{str(n_clusters).zfill(2)}"
+            kmeans = doclustering(
+                X,
+                thisoutputroot,
+                n_clusters=n_clusters,
+                thecache=thecache,
+                cachekey=clusterkeys[n_clusters],
+                kmeans=kmeansmodels[n_clusters],
             )
-        if not args.summaryonly:
-            cols = ["Mean", "Median", "Min", "Max"]
-            df = pd.DataFrame(data=np.transpose(thesilclusterstats[segment, :, :]), columns=cols)
-            df.to_csv(
-                args.outputroot + "_seg_" + str(segment).zfill(4) + "_silhouetteclusterstats.csv",
-                index=False,
+            thestatelabels, thesilavgs = summarizeclusters(
+                X,
+                kmeans,
+                thisoutputroot,
+                n_clusters,
+                args,
+                theniftiheader,
+                outputcomponents,
+                groups,
+                numsegs,
+                segsize,
+                sampletime,
+                thecache=thecache,
+                clusterkey=clusterkeys[n_clusters],
+                datamask=datamask,
+            )
+            if len(set(thestatelabels)) > 1:
+                dbscore = davies_bouldin_score(X, thestatelabels)
+            else:
+                dbscore = np.nan
+            sweepstats.append([n_clusters, kmeans.inertia_, np.mean(thesilavgs), dbscore])
+            print(
+                f"{n_clusters} clusters: inertia = {kmeans.inertia_}, "
+                f"mean silhouette = {np.mean(thesilavgs)}, Davies Bouldin score = {dbscore}"
             )
-            # ccalc_io.writenpvecs(thesilclusterstats[segment, :, :],
-            #             args.outputroot + '_seg_' + str(segment).zfill(4) + '_silhouetteclusterstats.txt')
-
-        for state in range(args.n_clusters):
-            if thestats[state, 2] > 0:
-                silinfo[state].append(thesilclusterstats[segment, 0, state])
-
-        # now generate some summary information
-        overallstatestats = []
-        thetimestats = []
-        alllens = 0
-        for i in range(args.n_clusters):
-            alllens += np.sum(np.asarray(alllenlists[i], dtype="float"))
-
-        for i in range(args.n_clusters):
-            lenarray = np.asarray(alllenlists[i], dtype="float")
-            if len(lenarray) > 2:
-                overallstatestats.append(
-                    [
-                        100.0 * np.sum(lenarray) / alllens,
-                        len(lenarray),
-                        np.sum(lenarray),
-                        np.min(lenarray),
-                        np.max(lenarray),
-                        np.mean(lenarray),
-                        np.median(lenarray),
-                        np.std(lenarray),
-                    ]
-                )
-                thetimestats.append(
-                    [
-                        100.0 * np.sum(lenarray) / alllens,
-                        sampletime * len(lenarray),
-                        sampletime * np.sum(lenarray),
-                        sampletime * np.min(lenarray),
-                        sampletime * np.max(lenarray),
-                        sampletime * np.mean(lenarray),
-                        sampletime * np.median(lenarray),
-                        sampletime * np.std(lenarray),
-                    ]
-                )
-
-        cols = [
-            "% TRs in state",
-            "Number of runs in state",
-            "Total TRs in state",
-            "Min run (TRs)",
-            "Max run (TRs)",
-            "Mean run (TRs)",
-            "Median run (TRs)",
-            "StdDev run (TRs)",
-        ]
-        df = pd.DataFrame(data=overallstatestats, columns=cols)
-        df.to_csv(
-            args.outputroot + "_overall_statestats.csv",
-            index=False,
-        )
-
         cols = [
-            "% Seconds in state",
-            "Number of runs in state",
-            "Total seconds in state",
-            "Min run (sec)",
-            "Max run (sec)",
-            "Mean run (sec)",
-            "Median run (sec)",
-            "StdDev run (sec)",
+            "Number of clusters",
+            "Inertia",
+            "Mean silhouette coefficient",
+            "Davies Bouldin score",
         ]
-        df = pd.DataFrame(data=thetimestats, columns=cols)
+        df = pd.DataFrame(data=sweepstats, columns=cols)
         df.to_csv(
-            args.outputroot + "_overall_statetimestats.csv",
+            args.outputroot + "_clustersweep.csv",
             index=False,
         )
 
-    overallrawtransmat = allrawtransmats[0] * 0.0
-    if args.debug:
-        print(f"{len(allrawtransmats)=}")
-    for segment in range(numsegs):
-        overallrawtransmat += allrawtransmats[segment]
-    overallnormtransmat, overalloffdiagtransmat = ccalc_utils.calcmats(
-        overallrawtransmat, args.n_clusters
-    )
-    init_img = nib.Nifti1Image(overallnormtransmat, outputaffine)
-    init_hdr = init_img.header
-    init_sizes = init_hdr["pixdim"]
-    ccalc_io.savetonifti(
-        np.transpose(overallrawtransmat),
-        init_hdr,
-        args.outputroot + "_overall_rawtransmat",
-    )
-    ccalc_io.savetonifti(
-        np.transpose(overallnormtransmat),
-        init_hdr,
-        args.outputroot + "_overall_normtransmat",
-    )
-    ccalc_io.savetonifti(
-        np.transpose(overalloffdiagtransmat),
-        init_hdr,
-        args.outputroot + "_overall_offdiagtransmat",
-    )
-    themaxlen = 0
-    for i in range(args.n_clusters):
-        themaxlen = int(np.max([themaxlen, np.max(alllenlists[i])]))
-    for i in range(args.n_clusters):
-        thishist = ccalc_stats.makeandsavehistogram(
-            np.array(alllenlists[i]),
-            themaxlen,
-            0,
-            args.outputroot + "_" + str(i).zfill(2) + "_lenhist",
-            therange=[1, themaxlen],
-        )
-    silavgs = []
-    if not args.summaryonly:
-        for state in range(args.n_clusters):
-            silavgs.append(np.mean(np.asarray(silinfo[state], dtype="float")))
-        ccalc_io.writenpvecs(
-            np.asarray(silavgs, dtype="float"),
-            args.outputroot + "_overallsilhouettemean.txt",
-        )
-    pctarray = np.asarray(allstatestats[:], dtype="float")
-    cols = [
-        "% TRs in state",
-        "Number of runs in state",
-        "Total TRs in state",
-        "Min run (TRs)",
-        "Max run (TRs)",
-        "Mean run (TRs)",
-        "Median run (TRs)",
-        "StdDev run (TRs)",
-    ]
-    df = pd.DataFrame(data=np.mean(pctarray, axis=0), columns=cols)
-    df.to_csv(
-        args.outputroot + "_seg_" + str(segment).zfill(4) + "_overallmeanstats.csv",
-        index=False,
-    )
-    # ccalc_io.writenpvecs(np.transpose(np.mean(pctarray, axis=0)), args.outputroot + '_overallmeanstats.txt')
-
-    if args.doGBR:
-        clf = GradientBoostingRegressor().fit(X, thestatelabels)
-        print("GBR fitting score is:", clf.score(X, thestatelabels))
-        ccalc_io.writenpvecs(
-            np.reshape(clf.feature_importances_, (n_features, 1)),
-            args.outputroot + "_featureimportances.txt",
-        )
-
 
 def entrypoint():
     capfromany_main()
@@ -26,7 +26,7 @@ import numpy as np
 import pandas as pd
 from sklearn import metrics
 from sklearn.cluster import DBSCAN, KMeans, MiniBatchKMeans
-from sklearn.decomposition import PCA, FastICA, IncrementalPCA
+from sklearn.decomposition import FastICA, IncrementalPCA
 from sklearn.ensemble import GradientBoostingRegressor
 from sklearn.feature_selection import SelectPercentile, f_classif
 from sklearn.preprocessing import StandardScaler
@@ -35,6 +35,8 @@ import capcalc.filter as ccalc_filt
 import capcalc.fit as ccalc_fit
 import capcalc.io as ccalc_io
 import capcalc.miscmath as ccalc_math
+import capcalc.preprocess as ccalc_preproc
+import capcalc.segmentstore as ccalc_segstore
 import capcalc.stats as ccalc_stats
 from capcalc.niftidecomp import niftidecomp_workflow
 
@@ -62,7 +64,9 @@ def usage():
     print(
         "                  [--noscale] [--nonorm] [--pctnorm] [--varnorm] [--stdnorm] [--ppnorm] [--quality]"
     )
-    print("                  [--pca] [--ica] [-p NUMCOMPONENTS] --modelroot=MODELROOT")
+    print(
+        "                  [--pca] [--ica] [-p NUMCOMPONENTS] [--pcasolver=SOLVER] [--pcaoversamples=NOVERSAMPLES] [--pcapoweriterations=NITER] --modelroot=MODELROOT"
+    )
     print("")
     print("required arguments:")
     print("    -i, --infile=TIMECOURSEFILE  - text file multiple timeseries")
@@ -145,6 +149,16 @@ def usage():
     print(
         "    -p NUMCOMPONENTS             - set the number of p/ica components to NUMCOMPONENTS (default is 8).  Set to -1 to estimate"
     )
+    print(
+        "    --pcasolver=SOLVER           - SVD solver for the PCA: auto (default), full, arpack, randomized, or gram.\n"
+        "                                   The time taken and the variance captured are printed."
+    )
+    print(
+        "    --pcaoversamples=NOVERSAMPLES - number of additional random vectors used by the randomized solver (default is 10)"
+    )
+    print(
+        "    --pcapoweriterations=NITER    - number of power iterations used by the randomized solver (default is chosen by scikit-learn)"
+    )
     print("    --noscale                    - do not apply standard scaler before cluster fitting")
     print("    --preproconly                - do preprocessing then quit")
     print(
@@ -161,6 +175,11 @@ def usage():
     )
     print("    -d                           - display some quality metrics")
     print("    --quality                    - perform a silhouette test to evaluate fit quality")
+    print(
+        "    --segmentoutput=MODE         - save the per segment results to a single file, OUTPUTFILE_segments.npz\n"
+        "                                   (MODE 'store', default), or also write the individual\n"
+        "                                   OUTPUTFILE_seg_XXXX_* files for each segment (MODE 'files')"
+    )
     print(
         "    --sigma                      - if input is nifti, smooth with a kernel of this width in mm"
     )
@@ -182,6 +201,7 @@ def usage():
 def main():
     # get the command line parameters
     summaryonly = True
+    segmentoutput = "store"
 
     # preprocessing options
     preprocessingtype = None
@@ -192,6 +212,9 @@ def main():
     minibatch = False
     n_clusters = 8
     n_pca = 8
+    pcasolver = "auto"
+    pcaoversamples = 10
+    pcapoweriterations = "auto"
     max_iter = 250
     n_init = 100
     batch_size = 1000
@@ -251,6 +274,10 @@ def main():
                 "modelroot=",
                 "initialcenters=",
                 "quality",
+                "segmentoutput=",
+                "pcasolver=",
+                "pcaoversamples=",
+                "pcapoweriterations=",
                 "sigma=",
                 "samplefreq=",
                 "sampletime=",
@@ -382,6 +409,30 @@ def main():
             summaryonly = False
             if verbose:
                 print("will do silhouette test")
+        elif o == "--segmentoutput":
+            segmentoutput = a
+            if segmentoutput not in ["store", "files"]:
+                print("segmentoutput must be 'store' or 'files'")
+                sys.exit()
+            if verbose:
+                print("per segment output mode set to", segmentoutput)
+        elif o == "--pcasolver":
+            pcasolver = a
+            if pcasolver not in ccalc_math.PCASOLVERS:
+                print("pcasolver must be one of", ccalc_math.PCASOLVERS)
+                sys.exit()
+            if verbose:
+                print("will use the", pcasolver, "pca solver")
+        elif o == "--pcaoversamples":
+            pcaoversamples = int(a)
+            if verbose:
+                print("will use", pcaoversamples, "oversamples in the randomized pca solver")
+        elif o == "--pcapoweriterations":
+            pcapoweriterations = int(a)
+            if verbose:
+                print(
+                    "will use", pcapoweriterations, "power iterations in the randomized pca solver"
+                )
         elif o == "-v":
             verbose = True
             if verbose:
@@ -590,18 +641,23 @@ def main():
             datafile_hdr,
             datafiledims,
             datafilesizes,
+            prenormfacs,
+            premeans,
         ) = niftidecomp_workflow(
-            "spatial",
             infilename,
+            outputroot,
             datamaskname=datamaskname,
             decomptype="pca",
             pcacomponents=n_pca,
             icacomponents=None,
-            varnorm=True,
+            normmethod="z",
             demean=True,
             theprefilter=theprefilter,
             sigma=sigma,
             maskthresh=maskthresh,
+            pcasolver=pcasolver,
+            pcaoversamples=pcaoversamples,
+            pcapoweriterations=pcapoweriterations,
         )
 
         print(f"{outputcomponents.shape=}")
@@ -703,36 +759,22 @@ def main():
     else:
         numsegs = int(n_samples // segsize)
 
-    for feature in range(n_features):
-        if verbose:
-            print("preprocessing feature", feature)
-        for segment in range(numsegs):
-            subsegstart = segment * segsize
-            for subseglen in subsegs:
-                if detrendorder > 0:
-                    segdata = ccalc_fit.detrend(
-                        reformdata[feature, subsegstart : subsegstart + subseglen]
-                    )
-                else:
-                    segdata = reformdata[feature, subsegstart : subsegstart + subseglen]
-
-                if timenormmethod == "none":
-                    segnorm = segdata - np.mean(segdata)
-                elif timenormmethod == "pctnorm":
-                    segnorm = ccalc_math.pcnormalize(segdata)
-                elif timenormmethod == "varnorm":
-                    segnorm = ccalc_math.varnormalize(segdata)
-                elif timenormmethod == "stdnorm":
-                    segnorm = ccalc_math.stdnormalize(segdata)
-                elif timenormmethod == "ppnorm":
-                    segnorm = ccalc_math.ppnormalize(segdata)
-                else:
-                    segnorm = segdata
-
-                reformdata[feature, subsegstart : subsegstart + subseglen] = theprefilter.apply(
-                    Fs, segnorm
-                )
-                subsegstart += subseglen
+    postnormmethods = {
+        "none": "None",
+        "pctnorm": "percent",
+        "varnorm": "variance",
+        "stdnorm": "stddev",
+        "ppnorm": "p2p",
+    }
+    ccalc_preproc.preprocesssegments(
+        reformdata,
+        Fs,
+        subsegs,
+        detrendorder=detrendorder,
+        normmethod=postnormmethods.get(timenormmethod, timenormmethod),
+        thefilter=theprefilter,
+        debug=verbose,
+    )
     X = np.nan_to_num(np.transpose(reformdata))
 
     if standardscale:
@@ -744,9 +786,21 @@ def main():
         if trainedmodelroot is None:
             print("running PCA")
             if n_pca <= 0:
-                thepca = PCA(n_components="mle", svd_solver="full").fit(X)
+                thepca = ccalc_math.fitpca(
+                    X,
+                    "mle",
+                    solver=pcasolver,
+                    n_oversamples=pcaoversamples,
+                    iterated_power=pcapoweriterations,
+                )
             else:
-                thepca = PCA(n_components=n_pca).fit(X)
+                thepca = ccalc_math.fitpca(
+                    X,
+                    n_pca,
+                    solver=pcasolver,
+                    n_oversamples=pcaoversamples,
+                    iterated_power=pcapoweriterations,
+                )
 
             # save the model
             joblib.dump(thepca, outputroot + "_pca.joblib")
@@ -951,133 +1005,45 @@ def main():
         alllenlists = []
         for i in range(n_clusters):
             alllenlists.append([])
+        segmentrawtransmats, segmentstats, segmentlenlists = capcalc_utils.statestats_batch(
+            np.reshape(thestatelabels[: numsegs * segsize], (numsegs, segsize)),
+            n_clusters,
+            0,
+            minout=minoutlength,
+            minhold=minholdlength,
+        )
         for segment in range(numsegs):
-            thesestatelabels = thestatelabels[segment * segsize : (segment + 1) * segsize]
-
-            outputaffine = np.eye(4)
-            rawtransmat, thestats, lenlist = capcalc_utils.statestats(
-                thesestatelabels, n_clusters, 0, minout=minoutlength, minhold=minholdlength
-            )
+            rawtransmat = segmentrawtransmats[segment]
+            thestats = segmentstats[segment]
+            lenlist = segmentlenlists[segment]
             allrawtransmats.append(rawtransmat * 1.0)
             allstatestats.append(thestats)
             for i in range(n_clusters):
                 alllenlists[i] += lenlist[i]
-            normtransmat, offdiagtransmat = capcalc_utils.calcmats(rawtransmat, n_clusters)
-            init_img = nib.Nifti1Image(normtransmat, outputaffine)
-            init_hdr = init_img.header
-            init_sizes = init_hdr["pixdim"]
-            ccalc_io.savetonifti(
-                np.transpose(rawtransmat),
-                init_hdr,
-                outputroot + "_seg_" + str(segment).zfill(4) + "_rawtransmat",
-            )
-            ccalc_io.savetonifti(
-                np.transpose(normtransmat),
-                init_hdr,
-                outputroot + "_seg_" + str(segment).zfill(4) + "_normtransmat",
-            )
-            ccalc_io.savetonifti(
-                np.transpose(offdiagtransmat),
-                init_hdr,
-                outputroot + "_seg_" + str(segment).zfill(4) + "_offdiagtransmat",
-            )
-
-            # write as text as well
-            rows = []
-            cols = []
-            for i in range(n_clusters):
-                rows.append("from state " + str(i + 1))
-                cols.append("to state " + str(i + 1))
-            df = pd.DataFrame(data=rawtransmat, columns=cols)
-            df.insert(0, "sources", pd.Series(rows))
-            df.to_csv(
-                outputroot + "_seg_" + str(segment).zfill(4) + "_rawtransmat.csv",
-                index=False,
-            )
-            df = pd.DataFrame(data=normtransmat, columns=cols)
-            df.insert(0, "sources", pd.Series(rows))
-            df.to_csv(
-                outputroot + "_seg_" + str(segment).zfill(4) + "_normtransmat.csv",
-                index=False,
-            )
-            df = pd.DataFrame(data=offdiagtransmat, columns=cols)
-            df.insert(0, "sources", pd.Series(rows))
-            df.to_csv(
-                outputroot + "_seg_" + str(segment).zfill(4) + "_offdiagtransmat.csv",
-                index=False,
-            )
-            # rawtransmat files are an n_clusters by n_clusters matrix with the total number of transitions from each state to each other state.
-            # normtransmat files are an n_clusters by n_clusters matrix with the total for of transitions from each state to each other state.
-
-            cols = [
-                "% TRs in state",
-                "Number of runs in state",
-                "Total TRs in state",
-                "Min run (TRs)",
-                "Max run (TRs)",
-                "Mean run (TRs)",
-                "Median run (TRs)",
-                "StdDev run (TRs)",
-            ]
-            df = pd.DataFrame(data=thestats, columns=cols)
-            df.to_csv(
-                outputroot + "_seg_" + str(segment).zfill(4) + "_statestats.csv",
-                index=False,
-            )
-            # ccalc_io.writenpvecs(np.transpose(thestats), outputroot + '_seg_' + str(segment).zfill(4) + '_statestats.txt')
-            thetimestats = 1.0 * thestats
-            thetimestats[:, 2:] *= sampletime
-            cols = [
-                "% Seconds in state",
-                "Number of runs in state",
-                "Total seconds in state",
-                "Min run (sec)",
-                "Max run (sec)",
-                "Mean run (sec)",
-                "Median run (sec)",
-                "StdDev run (sec)",
-            ]
-            df = pd.DataFrame(data=thetimestats, columns=cols)
-            df.to_csv(
-                outputroot + "_seg_" + str(segment).zfill(4) + "_statetimestats.csv",
-                index=False,
-            )
-            # ccalc_io.writenpvecs(np.transpose(thetimestats), outputroot + '_seg_' + str(segment).zfill(4) + '_statetimestats.txt')
-
-            ccalc_io.writenpvecs(
-                thesestatelabels,
-                outputroot + "_seg_" + str(segment).zfill(4) + "_statelabels.txt",
-            )
             print(
                 "Segment %d average silhouette Coefficient: %0.3f" % (segment, thesilavgs[segment])
             )
-            for state in range(n_clusters):
-                tc = np.where(thesestatelabels == state, 1, 0)
-                ccalc_io.writenpvecs(
-                    tc,
-                    outputroot
-                    + "_seg_"
-                    + str(segment).zfill(4)
-                    + "_instate_"
-                    + str(state).zfill(2)
-                    + ".txt",
-                )
-            if not summaryonly:
-                cols = ["Mean", "Median", "Min", "Max"]
-                df = pd.DataFrame(
-                    data=np.transpose(thesilclusterstats[segment, :, :]), columns=cols
-                )
-                df.to_csv(
-                    outputroot + "_seg_" + str(segment).zfill(4) + "_silhouetteclusterstats.csv",
-                    index=False,
-                )
-                # ccalc_io.writenpvecs(thesilclusterstats[segment, :, :],
-                #             outputroot + '_seg_' + str(segment).zfill(4) + '_silhouetteclusterstats.txt')
-
             for state in range(n_clusters):
                 if thestats[state, 2] > 0:
                     silinfo[state].append(thesilclusterstats[segment, 0, state])
 
+        # write all of the per segment results in one go
+        if summaryonly:
+            segsilclusterstats = None
+        else:
+            segsilclusterstats = thesilclusterstats
+        storename = ccalc_segstore.writesegmentstore(
+            outputroot,
+            np.reshape(thestatelabels[: numsegs * segsize], (numsegs, segsize)),
+            segmentrawtransmats,
+            segmentstats,
+            sampletime,
+            silclusterstats=segsilclusterstats,
+            debug=verbose,
+        )
+        if segmentoutput == "files":
+            ccalc_segstore.exportsegmentstore(storename, outputroot=outputroot, debug=verbose)
+
         # now generate some summary information
         overallstatestats = []
         thetimestats = []
@@ -1144,6 +1110,7 @@ def main():
             outputroot + "_overall_statetimestats.csv",
             index=False,
         )
+        outputaffine = np.eye(4)
         overallrawtransmat = allrawtransmats[0] * 0.0
         for segment in range(numsegs):
             overallrawtransmat += allrawtransmats[segment]
@@ -18,13 +18,16 @@
 #
 import argparse
 import os
+import shutil
+import sys
+import tempfile
 
 import numpy as np
 import scipy.sparse as ss
 from pylab import *
 from scipy.cluster.hierarchy import dendrogram
 from sklearn.cluster import DBSCAN, AgglomerativeClustering, KMeans, MiniBatchKMeans
-from sklearn.decomposition import PCA, FastICA
+from sklearn.decomposition import FastICA
 from sklearn.manifold import TSNE
 from sklearn.metrics import davies_bouldin_score, silhouette_score
 from sklearn.neighbors import kneighbors_graph
@@ -32,7 +35,9 @@ from sklearn.preprocessing import RobustScaler, StandardScaler
 
 import capcalc.io as ccalc_io
 import capcalc.miscmath as ccalc_math
+import capcalc.multiproc as ccalc_mp
 import capcalc.parser_funcs as pf
+import capcalc.preprocess as ccalc_preproc
 
 clusteringmethods = ["kmeans", "agglomerative", "dbscan"]
 
@@ -171,6 +176,56 @@ DEFAULT_NCOMPONENTS = 8
 DEFAULT_MINCLUSTERSIZE = 50
 DEFAULT_REPEATS = 1
 DEFAULT_NINIT = 100
+DEFAULT_DBSTOPWINDOW = 10
+
+
+def _kmeansrepeat(
+    coefficients, seed, n_clusters, minibatch=True, batch_size=1000, max_iter=250, n_init=100
+):
+    # do one kmeans repeat.  coefficients can be the name of a saved array, which is memory
+    # mapped read only, so that all of the workers share one copy.
+    if isinstance(coefficients, str):
+        coefficients = np.load(coefficients, mmap_mode="r")
+    if minibatch:
+        kmeans = MiniBatchKMeans(
+            n_clusters=n_clusters,
+            batch_size=batch_size,
+            max_iter=max_iter,
+            random_state=seed,
+        ).fit(coefficients)
+    else:
+        kmeans = KMeans(
+            n_clusters=n_clusters,
+            max_iter=max_iter,
+            n_init=n_init,
+            random_state=seed,
+        ).fit(coefficients)
+    return kmeans.labels_.astype(np.int32), davies_bouldin_score(coefficients, kmeans.labels_)
+
+
+def _dbscoresstable(dbscores, window, tol):
+    r"""Decide whether more kmeans repeats are worth doing.
+
+    Parameters
+    ----------
+    dbscores : 1D float array
+        The Davies-Bouldin scores of the repeats done so far, in repeat order
+    window : int
+        Number of repeats over which to look for a change
+    tol : float
+        Largest fractional change in the running mean of the scores that counts as stable
+
+    Returns
+    -------
+    isstable : bool
+        True if the running mean of the scores has changed by less than tol over the last
+        window repeats
+    """
+    if len(dbscores) <= window:
+        return False
+    runningmeans = np.cumsum(dbscores) / np.arange(1, len(dbscores) + 1)
+    lastmeans = runningmeans[-(window + 1) :]
+    return np.max(np.fabs(lastmeans - lastmeans[-1])) <= tol * np.fabs(lastmeans[-1])
 
 
 def _get_parser():
@@ -285,6 +340,44 @@ def _get_parser():
         help=f"Number of times to perform clustering.  Default is {DEFAULT_REPEATS}.",
         default=DEFAULT_REPEATS,
     )
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        action="store",
+        type=lambda x: pf.is_int(parser, x),
+        metavar="SEED",
+        help=(
+            "Seed for the random state of the kmeans repeats.  Each repeat gets its own seed "
+            "derived from SEED, so results are the same however many processes are used.  "
+            "The seeds are saved to the _seeds.txt file.  Default is to pick a seed at random."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--dbstoptol",
+        dest="dbstoptol",
+        action="store",
+        type=lambda x: pf.is_float(parser, x),
+        metavar="TOL",
+        help=(
+            "Stop the kmeans repeats early once the running mean of the Davies-Bouldin "
+            "scores has changed by less than the fraction TOL over the last DBSTOPWINDOW "
+            "repeats.  Default is to do all the repeats."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--dbstopwindow",
+        dest="dbstopwindow",
+        action="store",
+        type=lambda x: pf.is_int(parser, x),
+        metavar="DBSTOPWINDOW",
+        help=(
+            "Number of repeats to consider when checking for stable Davies-Bouldin scores.  "
+            f"Default is {DEFAULT_DBSTOPWINDOW}."
+        ),
+        default=DEFAULT_DBSTOPWINDOW,
+    )
     parser.add_argument(
         "--display",
         dest="display",
@@ -362,6 +455,9 @@ def _get_parser():
         help=f"N initial.  Default is {DEFAULT_NINIT}",
         default=DEFAULT_NINIT,
     )
+    pf.adddtypeopts(parser)
+    pf.addpcasolveropts(parser)
+    pf.addmultiprocopts(parser)
     return parser
 
 
@@ -532,18 +628,9 @@ def main():
 
     print("Will perform", args.clustertype, "clustering")
 
-    # read in data
-    print("reading in data array")
-    (
-        datafile_img,
-        datafile_data,
-        datafile_hdr,
-        datafiledims,
-        datafilesizes,
-    ) = ccalc_io.readfromnifti(args.datafilename)
-
-    print("reading in mask array")
+    # read in data.  If there is a mask, only the voxels inside it are read.
     if args.maskfilename is not None:
+        print("reading in mask array")
         (
             datamask_img,
             datamask_data,
@@ -551,6 +638,24 @@ def main():
             datamaskdims,
             datamasksizes,
         ) = ccalc_io.readfromnifti(args.maskfilename)
+        if not datamaskdims[4] == 1:
+            print("input mask time must have time dimension of 1")
+            exit()
+        procmask = datamask_data.reshape((-1)) > args.maskthresh
+
+        print("reading in masked data array")
+        procdata, datafile_hdr, datafiledims, datafilesizes = ccalc_io.readmaskedfromnifti(
+            args.datafilename, procmask, thedtype=args.dtype
+        )
+    else:
+        print("reading in data array")
+        (
+            datafile_img,
+            datafile_data,
+            datafile_hdr,
+            datafiledims,
+            datafilesizes,
+        ) = ccalc_io.readfromnifti(args.datafilename, thedtype=args.dtype)
 
     xsize, ysize, numslices, timepoints = ccalc_io.parseniftidims(datafiledims)
     xdim, ydim, slicethickness, tr = ccalc_io.parseniftisizes(datafilesizes)
@@ -561,56 +666,44 @@ def main():
         if not ccalc_io.checkspacematch(datafile_hdr, datamask_hdr):
             print("input mask spatial dimensions do not match image")
             exit()
-        if not datamaskdims[4] == 1:
-            print("input mask time must have time dimension of 1")
-            exit()
 
-    # allocating arrays
-    print("reshaping arrays")
     numspatiallocs = int(xsize) * int(ysize) * int(numslices)
     print(f"there are {numspatiallocs} voxels")
-    rs_datafile = datafile_data.reshape((numspatiallocs, timepoints))
-
-    print("masking arrays")
-    if args.maskfilename is not None:
-        proclocs = np.where(datamask_data.reshape((numspatiallocs)) > args.maskthresh)
-    else:
+    if args.maskfilename is None:
+        print("masking arrays")
         datamaskdims = [1, xsize, ysize, numslices, 1]
+        rs_datafile = datafile_data.reshape((numspatiallocs, timepoints))
         themaxes = np.max(rs_datafile, axis=1)
         themins = np.min(rs_datafile, axis=1)
         thediffs = (themaxes - themins).reshape((numspatiallocs))
-        proclocs = np.where(thediffs > 0.0)
-    procdata = rs_datafile[proclocs, :][0]
-    print(f"unmasked shape: {rs_datafile.shape}, masked shape: {procdata.shape}")
+        procmask = thediffs > 0.0
+        procdata = rs_datafile[procmask, :]
+        rs_datafile = None
+        datafile_data = None
+    proclocs = np.where(procmask)
+    procmask = procmask.reshape((xsize, ysize, numslices))
+    print(f"unmasked shape: {(numspatiallocs, timepoints)}, masked shape: {procdata.shape}")
 
     # set the initial methodname
     methodname = args.clustertype
 
-    # Scale the data
-    intlist = None
-    if intlist is None:
-        intlist = [timepoints]
-
     # scale every timepoint, if selected
+    coefficients = procdata
+    procdata = None
     if args.scaler is not None:
         print("prescaling each timepoint")
-        coefficients = procdata * 0.0
-
-        thepos = 0
-        for interval in intlist:
-            if args.scaler == "standard":
-                for coff in range(timepoints):
-                    print(f"normalizing {coff}")
-                    coefficients[:, coff] = ccalc_math.stdnormalize(procdata[:, coff])
-            else:
-                for coff in range(timepoints):
-                    print(f"normalizing {coff}")
-                    coefficients[:, coff] = ccalc_math.madnormalize(procdata[:, coff])
+        if args.scaler == "standard":
+            thenormalizer = ccalc_preproc.SegmentNormalizer(
+                normmethod="stddev", axis=0, verbose=False
+            )
+        else:
+            thenormalizer = ccalc_preproc.SegmentNormalizer(
+                normmethod="mad", center="median", axis=0, verbose=False
+            )
+        thenormalizer.normalize(coefficients)
         print("After prescaling...")
         print()
         methodname += f"_{args.scaler}"
-    else:
-        coefficients = procdata
 
     # normalize if selected
     if args.normalize:
@@ -628,15 +721,23 @@ def main():
         print("shape going in:", coefficients.shape)
 
         if args.n_pca <= 0.0:
-            thepca = PCA(n_components="mle", svd_solver="full").fit(coefficients)
+            pcacomponents = "mle"
+        elif args.n_pca >= 1.0:
+            args.n_pca = int(args.n_pca)
+            pcacomponents = args.n_pca
         else:
-            if args.n_pca >= 1.0:
-                args.n_pca = int(args.n_pca)
-            thepca = PCA(n_components=args.n_pca).fit(coefficients)
+            pcacomponents = args.n_pca
+        thepca = ccalc_math.fitpca(
+            coefficients,
+            pcacomponents,
+            solver=args.pcasolver,
+            n_oversamples=args.pcaoversamples,
+            iterated_power=args.pcapoweriterations,
+        )
 
         print(f"n_components found: {thepca.n_components_}")
         print(f"n_samples: {thepca.n_samples_}")
-        print(f"n_features: {thepca.n_features_}")
+        print(f"n_features: {thepca.n_features_in_}")
         coefficients = thepca.transform(coefficients)
         # coefficients = thepca.inverse_transform(thetransform)
         print("shape coming out:", coefficients.shape)
@@ -658,12 +759,9 @@ def main():
             args.outputrootname + "_" + methodname + "_pcacomponents_transpose.txt",
         )
         print("data reduction done")
-        theheader = datafile_hdr
-        theheader["dim"][4] = thepca.n_components_
-        tempout = np.zeros((numspatiallocs, thepca.n_components_), dtype="float")
-        tempout[proclocs, :] = coefficients[:, :]
-        ccalc_io.savetonifti(
-            tempout.reshape((xsize, ysize, numslices, thepca.n_components_)),
+        ccalc_io.savemaskedtonifti(
+            coefficients,
+            procmask,
             datafile_hdr,
             args.outputrootname + "_" + methodname + "_pcareduced",
         )
@@ -686,12 +784,9 @@ def main():
             args.outputrootname + methodname + "_" + "_icacomponents_transpose.txt",
         )
         print("data reduction done")
-        theheader = datafile_hdr
-        theheader["dim"][4] = theica.n_components_
-        tempout = np.zeros((numspatiallocs, theica.n_components_), dtype="float")
-        tempout[proclocs, :] = coefficients[:, :]
-        ccalc_io.savetonifti(
-            tempout.reshape((xsize, ysize, numslices, theica.n_components_)),
+        ccalc_io.savemaskedtonifti(
+            coefficients,
+            procmask,
             datafile_hdr,
             args.outputrootname + "_" + methodname + "_icareduced",
         )
@@ -767,30 +862,75 @@ def main():
         print("coefficients shape:", coefficients.shape)
         theregionlabels = np.zeros((coefficients.shape[0], args.repeats), dtype="int")
         dbscores = np.zeros((args.repeats), dtype="float")
-        for therepeat in range(args.repeats):
-            if args.minibatch:
-                kmeans = MiniBatchKMeans(
-                    n_clusters=args.n_clusters,
-                    batch_size=args.batch_size,
-                    max_iter=args.max_iter,
-                ).fit(coefficients)
-            else:
-                kmeans = KMeans(
-                    n_clusters=args.n_clusters,
-                    max_iter=args.max_iter,
-                    n_init=args.n_init,
-                ).fit(coefficients)
-
-            theclusters = np.transpose(kmeans.cluster_centers_)
-            print("cluster_centers shape", theclusters.shape)
-            theregionlabels[:, therepeat] = kmeans.labels_ + 0
-            dbscores[therepeat] = davies_bouldin_score(coefficients, kmeans.labels_)
-            print(f"Davies Bouldin score for repeat {therepeat} = {dbscores[therepeat]}")
+        seeds = np.random.SeedSequence(args.seed).generate_state(args.repeats)
+        nprocs = min(ccalc_mp.getnprocs(args.nprocs), args.repeats)
+
+        # with more than one process, the workers all map the same copy of the coefficients
+        tempdir = None
+        if nprocs > 1:
+            tempdir = tempfile.mkdtemp(
+                prefix="clusternifti_",
+                dir=os.path.dirname(os.path.abspath(args.outputrootname)),
+            )
+            coefficientsource = os.path.join(tempdir, "coefficients.npy")
+            np.save(coefficientsource, coefficients)
+        else:
+            coefficientsource = coefficients
+        thearglist = [
+            (
+                coefficientsource,
+                int(seeds[therepeat]),
+                args.n_clusters,
+                args.minibatch,
+                args.batch_size,
+                args.max_iter,
+                args.n_init,
+            )
+            for therepeat in range(args.repeats)
+        ]
+
+        # repeats can finish out of order, so only the leading run of finished repeats is used
+        # for the stopping test, which keeps the result the same for any number of processes
+        isdone = np.zeros((args.repeats), dtype=bool)
+        numrepeats = 0
+        stopped = False
+        therepeats = ccalc_mp.iter_multiproc(_kmeansrepeat, thearglist, nprocs=nprocs)
+        try:
+            for therepeat, (thelabels, thescore) in therepeats:
+                theregionlabels[:, therepeat] = thelabels
+                dbscores[therepeat] = thescore
+                isdone[therepeat] = True
+                print(f"Davies Bouldin score for repeat {therepeat} = {dbscores[therepeat]}")
+                while numrepeats < args.repeats and isdone[numrepeats]:
+                    numrepeats += 1
+                    if args.dbstoptol is not None and _dbscoresstable(
+                        dbscores[:numrepeats], args.dbstopwindow, args.dbstoptol
+                    ):
+                        stopped = True
+                        break
+                if stopped:
+                    break
+        finally:
+            therepeats.close()
+            if tempdir is not None:
+                shutil.rmtree(tempdir, ignore_errors=True)
+        if stopped:
+            print(
+                f"Davies Bouldin scores stable after {numrepeats} of {args.repeats} repeats - "
+                "stopping"
+            )
+            theregionlabels = theregionlabels[:, :numrepeats]
+            dbscores = dbscores[:numrepeats]
+            seeds = seeds[:numrepeats]
         methodname += f"_{str(args.n_clusters).zfill(2)}"
         ccalc_io.writevec(
             dbscores,
             args.outputrootname + "_" + methodname + "_dbscores.txt",
         )
+        ccalc_io.writevec(
+            seeds,
+            args.outputrootname + "_" + methodname + "_seeds.txt",
+        )
 
         # print("Silhouette Coefficient: %0.3f"
         # % metrics.silhouette_score(coefficients, theregionlabels))
@@ -807,12 +947,9 @@ def main():
 
     print("theregionlabels shape", theregionlabels.shape)
     print("clustering done")
-    theheader = datafile_hdr
-    theheader["dim"][4] = args.repeats
-    tempout = np.zeros((numspatiallocs, args.repeats), dtype="int")
-    tempout[proclocs] = theregionlabels[:, :] + 1
-    ccalc_io.savetonifti(
-        tempout.reshape((xsize, ysize, numslices, args.repeats)),
+    ccalc_io.savemaskedtonifti(
+        theregionlabels.astype("int") + 1,
+        procmask,
         datafile_hdr,
         args.outputrootname + "_" + methodname + "_regions",
     )
@@ -21,7 +21,7 @@ import sys
 
 import numpy as np
 from pylab import *
-from scipy.stats import pearsonr
+from scipy.optimize import linear_sum_assignment
 
 import capcalc.io as ccalc_io
 import capcalc.parser_funcs as pf
@@ -31,7 +31,113 @@ DEFAULTPCT = 98.0
 DEFAULTPASSES = 1
 
 
-def calccorrs(intemplatedata, indata, numregionstemplate, numregions, debug=False):
+def _labelcodes(thelabels, numlabels):
+    # convert a label vector to integers in the range 0 to numlabels, with everything that
+    # is not a region label (background, or out of range) mapped to 0
+    thelabels = np.asarray(thelabels)
+    if np.issubdtype(thelabels.dtype, np.integer):
+        thecodes = thelabels.astype(np.int64)
+    else:
+        thecodes = np.rint(thelabels).astype(np.int64)
+    thecodes[(thecodes < 1) | (thecodes > numlabels)] = 0
+    return thecodes
+
+
+def contingencytable(intemplatedata, indata, numregionstemplate, numregions):
+    r"""Count the voxels with each combination of template and data labels.
+
+    Parameters
+    ----------
+    intemplatedata : 1D array
+        The template labels, one per voxel.  Regions are numbered from 1.
+    indata : 1D array
+        The labels to compare to the template.
+    numregionstemplate : int
+        Number of regions in the template
+    numregions : int
+        Number of regions in the data
+
+    Returns
+    -------
+    thetable : 2D int array
+        The number of voxels with template label i and data label j, with shape
+        (numregionstemplate + 1, numregions + 1).  Row and column 0 count the voxels not in
+        any region.
+    """
+    thecodes = _labelcodes(intemplatedata, numregionstemplate) * (numregions + 1) + _labelcodes(
+        indata, numregions
+    )
+    return np.bincount(thecodes, minlength=(numregionstemplate + 1) * (numregions + 1)).reshape(
+        (numregionstemplate + 1, numregions + 1)
+    )
+
+
+def phicorrs(thetable):
+    r"""Calculate the correlation between the indicator vectors of every pair of regions.
+
+    This is the Pearson correlation of the binary vectors (the phi coefficient), which
+    depends only on the counts in the contingency table.
+
+    Parameters
+    ----------
+    thetable : 2D int array
+        A contingency table from contingencytable
+
+    Returns
+    -------
+    thecorrs : 2D float array
+        The correlation of template region i + 1 with data region j + 1, with shape
+        (numregionstemplate, numregions).  Pairs involving a region that is empty, or that
+        covers every voxel, have no defined correlation, and are set to 0.
+    """
+    numvoxels = float(np.sum(thetable))
+    templatesizes = np.sum(thetable, axis=1)[1:].astype(np.float64)
+    datasizes = np.sum(thetable, axis=0)[1:].astype(np.float64)
+    thenumerator = numvoxels * thetable[1:, 1:] - np.outer(templatesizes, datasizes)
+    thedenominator = np.sqrt(
+        np.outer(templatesizes * (numvoxels - templatesizes), datasizes * (numvoxels - datasizes))
+    )
+    thecorrs = np.zeros_like(thenumerator)
+    np.divide(thenumerator, thedenominator, out=thecorrs, where=(thedenominator > 0.0))
+    return thecorrs
+
+
+def greedymatch(thecorrmat, nummatches):
+    r"""Pair rows and columns of a correlation matrix, best correlation first.
+
+    Parameters
+    ----------
+    thecorrmat : 2D float array
+        The correlation matrix
+    nummatches : int
+        Number of pairs to make
+
+    Returns
+    -------
+    rows, cols : 1D int arrays
+        The matched row and column indices, in the order they were matched
+    """
+    rowused = np.zeros((thecorrmat.shape[0]), dtype=bool)
+    colused = np.zeros((thecorrmat.shape[1]), dtype=bool)
+    rows = []
+    cols = []
+    # a stable sort matches ties in the same order as repeatedly taking the argmax
+    for theindex in np.argsort(-thecorrmat, axis=None, kind="stable"):
+        therow, thecol = np.unravel_index(theindex, thecorrmat.shape)
+        if rowused[therow] or colused[thecol]:
+            continue
+        rowused[therow] = True
+        colused[thecol] = True
+        rows.append(therow)
+        cols.append(thecol)
+        if len(rows) == nummatches:
+            break
+    return np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+
+
+def calccorrs(
+    intemplatedata, indata, numregionstemplate, numregions, matchmethod="greedy", debug=False
+):
     # first calculate all correlations
     if debug:
         print("calccorrs:")
@@ -42,44 +148,59 @@ def calccorrs(intemplatedata, indata, numregionstemplate, numregions, debug=Fals
 
     maxdim = max(numregionstemplate, numregions)
     thecorrmat = np.zeros((maxdim, maxdim), dtype=np.float64)
-    outdata = indata * 0
-
-    for i in range(numregionstemplate):
-        cluster1 = np.where(intemplatedata == (i + 1), 1.0, 0.0)
-        if debug:
-            print(f"index {i}")
-        for j in range(numregions):
-            cluster2 = np.where(indata == (j + 1), 1.0, 0.0)
-            thecorrmat[i, j], dummy = pearsonr(cluster1, cluster2)
+    thecorrmat[:numregionstemplate, :numregions] = phicorrs(
+        contingencytable(intemplatedata, indata, numregionstemplate, numregions)
+    )
 
     # now find the best match of each region to a template region
     # make sure that each row and each column only get 1 match
-    matches = []
-    for i in range(numregions):
-        thisloc = np.unravel_index(thecorrmat.argmax(), thecorrmat.shape)
-        thiscorrval = thecorrmat[thisloc]
-        matches.append([thisloc[0] + 0, thisloc[1] + 0, thiscorrval + 0.0])
-        thecorrmat[:, thisloc[1]] = -1.0
-        thecorrmat[thisloc[0], :] = -1.0
-
-    bestmatchlocs = np.zeros((numregions), dtype=int)
-    bestmatchvals = np.zeros((numregions), dtype=float)
-    for i in range(numregions):
-        bestmatchlocs[matches[i][0]] = matches[i][1]
-        bestmatchvals[i] = matches[i][2]
+    if matchmethod == "hungarian":
+        matchrows, matchcols = linear_sum_assignment(thecorrmat, maximize=True)
+    else:
+        matchrows, matchcols = greedymatch(thecorrmat, numregions)
+    matchvals = thecorrmat[matchrows, matchcols]
 
     if debug:
         print("after matching")
-        print(matches)
-        for i in range(numregions):
-            print(
-                f"component {i}: best match of {bestmatchvals[i]} at component {bestmatchlocs[i]}"
-            )
-
-    for i in range(numregions):
-        outdata[np.where(indata == (bestmatchlocs[i] + 1))] = i + 1
-
-    return outdata
+        for therow, thecol, theval in zip(matchrows, matchcols, matchvals):
+            print(f"template component {therow}: best match of {theval} at component {thecol}")
+
+    # relabel the data with a lookup table - unmatched labels go to 0
+    thelut = np.zeros((numregions + 1), dtype=indata.dtype)
+    isdataregion = matchcols < numregions
+    thelut[matchcols[isdataregion] + 1] = matchrows[isdataregion] + 1
+    return thelut[_labelcodes(indata, numregions)]
+
+
+def probabilitymap(thelabels, numregions, blockvoxels=2**16):
+    r"""Find the fraction of runs in which each voxel is assigned to each region.
+
+    Parameters
+    ----------
+    thelabels : 2D array
+        The region labels, with shape (voxels, runs).  Regions are numbered from 1, and
+        other labels are ignored.
+    numregions : int
+        Number of regions
+    blockvoxels : int, optional
+        Number of voxels to count at a time.  Default is 65536.
+
+    Returns
+    -------
+    probmap : 2D float array
+        The fraction of runs with each label, with shape (voxels, numregions)
+    """
+    numvoxels, numruns = thelabels.shape
+    probmap = np.zeros((numvoxels, numregions), dtype=np.float64)
+    for startvox in range(0, numvoxels, blockvoxels):
+        endvox = min(startvox + blockvoxels, numvoxels)
+        thecodes = _labelcodes(thelabels[startvox:endvox, :], numregions)
+        thecodes += (numregions + 1) * np.arange(endvox - startvox, dtype=np.int64)[:, None]
+        thecounts = np.bincount(
+            thecodes.ravel(), minlength=(endvox - startvox) * (numregions + 1)
+        ).reshape((endvox - startvox, numregions + 1))
+        probmap[startvox:endvox, :] = thecounts[:, 1:] / numruns
+    return probmap
 
 
 def _get_parser():
@@ -130,6 +251,20 @@ def _get_parser():
         default=DEFAULTPASSES,
     )
 
+    parser.add_argument(
+        "--matchmethod",
+        dest="matchmethod",
+        action="store",
+        type=str,
+        choices=["greedy", "hungarian"],
+        help=(
+            "How to pair regions with template regions.  greedy repeatedly takes the best "
+            "remaining correlation; hungarian finds the pairing with the largest total "
+            "correlation.  Default is greedy."
+        ),
+        default="greedy",
+    )
+
     parser.add_argument(
         "--debug",
         dest="debug",
@@ -155,15 +290,9 @@ def main():
         args.outputrootname + "_commandline.txt",
     )
 
-    # read in data
-    print("reading in data array")
-    (
-        datafile_img,
-        datafile_data,
-        datafile_hdr,
-        datafiledims,
-        datafilesizes,
-    ) = ccalc_io.readfromnifti(args.datafilename)
+    # read in the data header - the voxel data itself is read after masking
+    print("reading in data header")
+    datafile_hdr, datafiledims, datafilesizes = ccalc_io.readniftiheader(args.datafilename)
 
     if args.maskfilename is not None:
         print("reading in mask array")
@@ -207,24 +336,32 @@ def main():
             exit()
 
     # allocating arrays
-    print("reshaping arrays")
     numspatiallocs = int(xsize) * int(ysize) * int(numslices)
     print(f"there are {numspatiallocs} voxels")
-    rs_datafile = datafile_data.reshape((numspatiallocs, timepoints))
+
+    # find the largest label in each voxel one block of volumes at a time, so the full 4D
+    # array is never in memory
+    print("finding voxel maxima")
+    themaxes = np.full((numspatiallocs), -np.inf)
+    for startvol, theblock in ccalc_io.iterniftiblocks(
+        args.datafilename, np.ones((numspatiallocs), dtype=bool)
+    ):
+        themaxes = np.maximum(themaxes, np.max(theblock, axis=1))
+    numregions = int(np.max(themaxes))
 
     print("masking arrays")
     if args.maskfilename is not None:
-        proclocs = np.where(datamask_data.reshape((numspatiallocs)) > 0.5)
+        procmask = datamask_data.reshape((numspatiallocs)) > 0.5
     else:
-        themaxes = np.max(rs_datafile, axis=1).reshape((numspatiallocs))
-        proclocs = np.where(themaxes > 0)
-    procdata = rs_datafile[proclocs, :][0]
+        procmask = themaxes > 0
+    proclocs = np.where(procmask)
+    procdata, datafile_hdr, datafiledims, datafilesizes = ccalc_io.readmaskedfromnifti(
+        args.datafilename, procmask
+    )
     if args.debug:
-        print(f"unmasked shape: {rs_datafile.shape}, masked shape: {procdata.shape}")
+        print(f"unmasked shape: {(numspatiallocs, timepoints)}, masked shape: {procdata.shape}")
 
-    outputarray = procdata * 0
-    outputarray[:, 0] = procdata[:, 0]
-    numregions = int(np.max(rs_datafile))
+    outputarray = np.zeros(procdata.shape, dtype=np.int16)
 
     for thepass in range(args.passes):
         if thepass == 0:
@@ -248,20 +385,19 @@ def main():
                 procdata[:, thetimepoint],
                 numregionstemplate,
                 numregions,
+                matchmethod=args.matchmethod,
                 debug=args.debug,
             )
 
         # make a probability map
-        probmap = np.zeros((procdata.shape[0], numregions), dtype=np.float64)
+        probmap = probabilitymap(outputarray, numregions)
         regionpercentileprob = np.zeros((numregions), dtype=np.float64)
         regionsize = np.zeros((numregions), dtype=int)
         weightedregionsize = np.zeros((numregions), dtype=np.float64)
         for theregion in range(numregions):
-            thisarray = np.where(outputarray == (theregion + 1), 1.0, 0.0)
-            probmap[:, theregion] = np.mean(thisarray, axis=1)
-            regvoxels = probmap[np.where(probmap[:, theregion] > 0.0), theregion]
+            regvoxels = probmap[:, theregion][probmap[:, theregion] > 0.0]
             regionpercentileprob[theregion] = np.percentile(regvoxels, args.percentile)
-            regionsize[theregion] = len(regvoxels[0])
+            regionsize[theregion] = len(regvoxels)
             weightedregionsize[theregion] = regionsize[theregion] * regionpercentileprob[theregion]
 
         # sort the probability map by rank
@@ -280,43 +416,42 @@ def main():
                 + f"{DEFAULTPCT}th percentile:{regionpercentileprob[rankindices[i]]}"
             )
 
+        # region rankindices[i] + 1 becomes region i + 1, and anything else becomes 0
+        ranklut = np.zeros((numregions + 1), dtype=np.int16)
+        ranklut[rankindices + 1] = np.arange(1, numregions + 1)
+
         # save the sorted cluster maps
-        remappedoutputarray = np.zeros((procdata.shape[0], timepoints), dtype=int)
-        for theregion in range(numregions):
-            remappedoutputarray[np.where(outputarray == rankindices[theregion] + 1)] = (
-                theregion + 1
-            )
-        remappedtempout = np.zeros((numspatiallocs, timepoints), dtype=int)
-        remappedtempout[proclocs, :] = remappedoutputarray
+        remappedtempout = np.zeros((numspatiallocs, timepoints), dtype=np.int16)
+        remappedtempout[proclocs, :] = ranklut[_labelcodes(outputarray, numregions)]
+        output_hdr = datafile_hdr.copy()
+        output_hdr.set_data_dtype(np.int16)
         ccalc_io.savetonifti(
             remappedtempout.reshape((xsize, ysize, numslices, timepoints)),
-            datafile_hdr,
+            output_hdr,
             args.outputrootname + passlabel,
         )
+        del remappedtempout
 
         # write out the individual probability maps
-        tempout = np.zeros((numspatiallocs, numregions), dtype=np.float64)
-        remappedtempout = np.zeros((numspatiallocs, numregions), dtype=np.float64)
-        for theregion in range(numregions):
-            tempout[proclocs, theregion] = probmap[:, theregion]
-        for theregion in range(numregions):
-            remappedtempout[:, theregion] = tempout[:, rankindices[theregion]]
-        output_hdr = datafile_hdr
+        remappedtempout = np.zeros((numspatiallocs, numregions), dtype=np.float32)
+        remappedtempout[proclocs, :] = probmap[:, rankindices]
+        output_hdr = datafile_hdr.copy()
         output_hdr["dim"][4] = numregions
+        output_hdr.set_data_dtype(np.float32)
         ccalc_io.savetonifti(
             remappedtempout.reshape((xsize, ysize, numslices, numregions)),
             output_hdr,
             args.outputrootname + "_probseg" + passlabel,
         )
+        del remappedtempout
 
         # write out the maxprob map
-        tempout = np.zeros((numspatiallocs), dtype=int)
-        remappedtempout = np.zeros((numspatiallocs), dtype=int)
-        tempout[proclocs] = np.argmax(probmap, axis=1) + 1
-        for theregion in range(numregions):
-            remappedtempout[np.where(tempout == rankindices[theregion] + 1)] = theregion + 1
+        remappedtempout = np.zeros((numspatiallocs), dtype=np.int16)
+        remappedtempout[proclocs] = ranklut[np.argmax(probmap, axis=1) + 1]
+        output_hdr = datafile_hdr.copy()
         output_hdr["dim"][0] = 3
         output_hdr["dim"][4] = 1
+        output_hdr.set_data_dtype(np.int16)
         ccalc_io.savetonifti(
             remappedtempout.reshape((xsize, ysize, numslices)),
             output_hdr,
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2019-2025 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+import argparse
+
+import capcalc.parser_funcs as pf
+import capcalc.segmentstore as ccalc_segstore
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog="exportsegments",
+        description=(
+            "Write out the per segment results in a capfromtcs or capfromany segment store "
+            "(OUTPUTROOT_segments.npz) as individual OUTPUTROOT_seg_XXXX_* files"
+        ),
+    )
+    parser.add_argument(
+        "storename",
+        help="The segment store file",
+        type=lambda x: pf.is_valid_file(parser, x),
+    )
+    parser.add_argument(
+        "--outputroot",
+        dest="outputroot",
+        action="store",
+        type=str,
+        metavar="ROOT",
+        help="Root name of the exported files.  Default is the root the store was written with.",
+        default=None,
+    )
+    parser.add_argument(
+        "--statelabelfiletype",
+        dest="statelabelfiletype",
+        action="store",
+        type=str,
+        choices=["npy", "text"],
+        help='Format for the per segment state label files.  Default is "text".',
+        default="text",
+    )
+    parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Print extended debugging information.",
+        default=False,
+    )
+    return parser
+
+
+def main():
+    args = _get_parser().parse_args()
+    ccalc_segstore.exportsegmentstore(
+        args.storename,
+        outputroot=args.outputroot,
+        statelabelfiletype=args.statelabelfiletype,
+        debug=args.debug,
+    )
+
+
+def entrypoint():
+    main()
+
+
+if __name__ == "__main__":
+    entrypoint()
@@ -16,12 +16,228 @@
 #   limitations under the License.
 #
 #
+import getopt
+import os
 import sys
 
 import numpy as np
 
 import capcalc.fit as ccalc_fit
 import capcalc.io as ccalc_io
+import capcalc.multiproc as ccalc_mp
+
+DEFAULT_CHUNKSIZE = 65536
+
+
+def usage():
+    print("usage: fitglm tcfile outputroot evfile [evfile_2...evfile_n] [options]")
+    print("    Fits multiple evs to timecourses in a file")
+    print("")
+    print("required arguments:")
+    print("    tcfile           - a text file of timecourses, or a 4D nifti or cifti file")
+    print("    outputroot       - the root name of the output files")
+    print("    evfile           - the regressors, one text file each")
+    print("")
+    print("optional arguments (for nifti and cifti input):")
+    print("    --maskfile=MASK  - only fit the voxels inside the 3D nifti file MASK.  Default is")
+    print("                       to fit every voxel with any variance")
+    print("    --chunksize=N    - fit about N voxels at a time.  Memory use is set by this, not")
+    print(f"                       by the image size.  Default is {DEFAULT_CHUNKSIZE}")
+    print("    --nprocs=NPROCS  - fit the chunks with NPROCS worker processes.  NPROCS less")
+    print("                       than 1 uses one less than the number of cpus")
+    print("")
+    print("    For nifti and cifti input, the mean, coefficient, R and residual maps are saved")
+    print("    as nifti (or cifti) files.")
+    return ()
+
+
+def glmfit(trimmeddata, regressors):
+    r"""Fit a set of regressors to each of a set of timecourses.
+
+    Parameters
+    ----------
+    trimmeddata : 2D float array
+        The timecourses, with shape (timecourses, timepoints)
+    regressors : 2D float array
+        The regressors, with shape (regressors, timepoints)
+
+    Returns
+    -------
+    meandata : 1D float array
+        The constant term of each fit
+    coefficient : 2D float array
+        The regressor coefficients, with shape (timecourses, regressors)
+    Rdata : 1D float array
+        The multiple correlation coefficient of each fit
+    residuals : 2D float array
+        The data minus the regressor part of the fit (the constant term is not removed)
+
+    Timecourses with no variance are not fit, and get zeros for everything but the
+    residuals.
+    """
+    numtcs = trimmeddata.shape[0]
+    numregressors = regressors.shape[0]
+    meandata = np.zeros((numtcs), dtype="float")
+    coefficient = np.zeros((numtcs, numregressors), dtype="float")
+    Rdata = np.zeros((numtcs), dtype="float")
+    thetcs = np.flatnonzero(np.max(trimmeddata, axis=1) - np.min(trimmeddata, axis=1) > 0.0)
+    if len(thetcs) > 0:
+        thisfit, R = ccalc_fit.mlregressbatch(regressors, trimmeddata[thetcs, :])
+        meandata[thetcs] = thisfit[:, 0]
+        coefficient[thetcs, :] = thisfit[:, 1:]
+        Rdata[thetcs] = R
+    residuals = trimmeddata - coefficient @ regressors
+    return meandata, coefficient, Rdata, residuals
+
+
+def _fitniftislab(inputfile, startslice, endslice, slabmask, regressors):
+    # read the masked voxels in a range of slices and fit them
+    theslab = ccalc_io.readniftislices(inputfile, startslice, endslice)
+    return glmfit(theslab[slabmask], regressors)
+
+
+def _glmfitniftifile(inputfile, outputroot, regressors, maskfile, chunksize, nprocs):
+    # fit every voxel of a 4D nifti file, a slab of slices at a time
+    input_hdr, thedims, thesizes = ccalc_io.readniftiheader(inputfile)
+    xsize, ysize, numslices, timepoints = ccalc_io.parseniftidims(thedims)
+    spatialshape = (int(xsize), int(ysize), int(numslices))
+    numregressors = regressors.shape[0]
+    if timepoints != regressors.shape[1]:
+        print("Input file and ev file dimensions do not match")
+        exit()
+    if maskfile is not None:
+        (
+            mask_img,
+            mask_data,
+            mask_hdr,
+            maskdims,
+            masksizes,
+        ) = ccalc_io.readfromnifti(maskfile)
+        if not ccalc_io.checkspacematch(input_hdr, mask_hdr):
+            print("mask does not match spatial coverage of the input file")
+            exit()
+        themask = mask_data.reshape(spatialshape) > 0
+    else:
+        themask = np.ones(spatialshape, dtype=bool)
+    numvoxels = int(np.sum(themask))
+    print(f"fitting {numvoxels} voxels")
+
+    # the maps are small enough to hold in memory - the residuals are collected in a
+    # scratch file in the mask order used by savemaskedtonifti
+    meanmap = np.zeros(spatialshape, dtype=np.float32)
+    coefficientmap = np.zeros(spatialshape + (numregressors,), dtype=np.float32)
+    Rmap = np.zeros(spatialshape, dtype=np.float32)
+    maskrows = (np.cumsum(themask.reshape(-1)) - 1).reshape(spatialshape)
+    scratchname = f"{outputroot}_residuals_scratch.{os.getpid()}.npy"
+    residuals = np.lib.format.open_memmap(
+        scratchname, mode="w+", dtype=np.float32, shape=(numvoxels, int(timepoints))
+    )
+    slicesperchunk = int(np.max([1, chunksize // (spatialshape[0] * spatialshape[1])]))
+    theslabs = [
+        (startslice, int(np.min([startslice + slicesperchunk, spatialshape[2]])))
+        for startslice in range(0, spatialshape[2], slicesperchunk)
+    ]
+    try:
+        for theslab, thefit in ccalc_mp.iter_multiproc(
+            _fitniftislab,
+            [
+                (inputfile, startslice, endslice, themask[:, :, startslice:endslice], regressors)
+                for startslice, endslice in theslabs
+            ],
+            nprocs=nprocs,
+        ):
+            startslice, endslice = theslabs[theslab]
+            slabmask = themask[:, :, startslice:endslice]
+            print(f"fit slices {startslice} to {endslice - 1}")
+            meanmap[:, :, startslice:endslice][slabmask] = thefit[0]
+            coefficientmap[:, :, startslice:endslice][slabmask] = thefit[1]
+            Rmap[:, :, startslice:endslice][slabmask] = thefit[2]
+            residuals[maskrows[:, :, startslice:endslice][slabmask], :] = thefit[3]
+
+        print("processing complete: about to save data")
+        theheader = input_hdr.copy()
+        theheader.set_data_dtype(np.float32)
+        theheader["dim"][0] = 3
+        theheader["dim"][4] = 1
+        ccalc_io.savetonifti(meanmap, theheader, outputroot + "_mean")
+        for j in range(0, numregressors):
+            ccalc_io.savetonifti(
+                coefficientmap[:, :, :, j],
+                theheader,
+                outputroot + "_coefficient_" + str(j).zfill(2),
+            )
+        ccalc_io.savetonifti(Rmap, theheader, outputroot + "_R")
+        theheader = input_hdr.copy()
+        theheader.set_data_dtype(np.float32)
+        ccalc_io.savemaskedtonifti(residuals, themask, theheader, outputroot + "_residuals")
+    finally:
+        del residuals
+        os.remove(scratchname)
+
+
+def _fitciftichunk(inputfile, startpt, endpt, regressors):
+    # read a range of grayordinates and fit them
+    return glmfit(ccalc_io.readciftichunk(inputfile, startpt, endpt), regressors)
+
+
+def _glmfitciftifile(inputfile, outputroot, regressors, chunksize, nprocs):
+    # fit every grayordinate of a cifti file, a chunk at a time
+    cifti_hdr, nifti_hdr, thedims, thesizes, timestep = ccalc_io.readciftiheader(inputfile)
+    timepoints, numgrayordinates = int(thedims[5]), int(thedims[6])
+    numregressors = regressors.shape[0]
+    if timepoints != regressors.shape[1]:
+        print("Input file and ev file dimensions do not match")
+        exit()
+    print(f"fitting {numgrayordinates} grayordinates")
+
+    # as for nifti files, the residuals are collected in a scratch file
+    meandata = np.zeros((numgrayordinates), dtype=np.float32)
+    coefficient = np.zeros((numgrayordinates, numregressors), dtype=np.float32)
+    Rdata = np.zeros((numgrayordinates), dtype=np.float32)
+    scratchname = f"{outputroot}_residuals_scratch.{os.getpid()}.npy"
+    residuals = np.lib.format.open_memmap(
+        scratchname, mode="w+", dtype=np.float32, shape=(numgrayordinates, timepoints)
+    )
+    thechunks = [
+        (startpt, int(np.min([startpt + chunksize, numgrayordinates])))
+        for startpt in range(0, numgrayordinates, chunksize)
+    ]
+    try:
+        for thechunk, thefit in ccalc_mp.iter_multiproc(
+            _fitciftichunk,
+            [(inputfile, startpt, endpt, regressors) for startpt, endpt in thechunks],
+            nprocs=nprocs,
+        ):
+            startpt, endpt = thechunks[thechunk]
+            meandata[startpt:endpt] = thefit[0]
+            coefficient[startpt:endpt, :] = thefit[1]
+            Rdata[startpt:endpt] = thefit[2]
+            residuals[startpt:endpt, :] = thefit[3]
+
+        print("processing complete: about to save data")
+        ccalc_io.savetocifti(meandata, cifti_hdr, nifti_hdr, outputroot + "_mean", names=["mean"])
+        for j in range(0, numregressors):
+            ccalc_io.savetocifti(
+                coefficient[:, j],
+                cifti_hdr,
+                nifti_hdr,
+                outputroot + "_coefficient_" + str(j).zfill(2),
+                names=["coefficient_" + str(j).zfill(2)],
+            )
+        ccalc_io.savetocifti(Rdata, cifti_hdr, nifti_hdr, outputroot + "_R", names=["R"])
+        if timestep is None:
+            timestep = 1.0
+        ccalc_io.savetocifti(
+            residuals,
+            cifti_hdr,
+            nifti_hdr,
+            outputroot + "_residuals",
+            isseries=True,
+            step=timestep,
+        )
+    finally:
+        del residuals
+        os.remove(scratchname)
 
 
 def main():
@@ -29,32 +245,49 @@ def main():
     #       Initial setup
     #
     # read in the datafile
-    nargs = len(sys.argv)
-    if nargs < 5:
-        print("usage: fitglm tcfile outputroot evfile [evfile_2...evfile_n]")
-        print("    Fits multiple evs to timecourses in a file")
+    try:
+        opts, args = getopt.gnu_getopt(
+            sys.argv[1:], "h", ["maskfile=", "chunksize=", "nprocs=", "help"]
+        )
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err))  # will print something like "option -x not recognized"
+        usage()
+        sys.exit(2)
+    if len(args) < 3:
+        usage()
         exit()
 
+    maskfile = None
+    chunksize = DEFAULT_CHUNKSIZE
+    nprocs = 1
+    for o, a in opts:
+        if o == "--maskfile":
+            maskfile = a
+        elif o == "--chunksize":
+            chunksize = int(a)
+        elif o == "--nprocs":
+            nprocs = int(a)
+        elif o == "-h" or o == "--help":
+            usage()
+            exit()
+        else:
+            assert False, "unhandled option"
+
     # initialize some variables
     evdata = []
     evfilename = []
 
     # read in the parameters
-    inputfile = sys.argv[1]
-    outputroot = sys.argv[2]
-    evfilename.append(sys.argv[3])
+    inputfile = args[0]
+    outputroot = args[1]
+    evfilename.append(args[2])
     numfiles = 1
     print(evfilename[0])
-    if nargs > 4:
-        for i in range(4, nargs):
-            numfiles += 1
-            evfilename.append(sys.argv[i])
-            print(evfilename[numfiles - 1])
-
-    # read the datafile and the evfiles
-    tc_data = ccalc_io.readvecs(inputfile)
-    numtcs = tc_data.shape[0]
-    timepoints = tc_data.shape[1]
+    for i in range(3, len(args)):
+        numfiles += 1
+        evfilename.append(args[i])
+        print(evfilename[numfiles - 1])
 
     numregressors = 0
     for i in range(0, numfiles):
@@ -64,43 +297,41 @@ def main():
         print("timeseries length = ", len(evtimeseries))
         evdata.append(1.0 * evtimeseries)
         numregressors += 1
+    print("will perform GLM with ", numregressors, " regressors")
+    for j in range(1, numregressors):
+        if len(evdata[0]) != len(evdata[j]):
+            print("ev file ", j, " does not have the same length as ev file 0")
+            exit()
+    regressors = np.vstack(evdata)
+
+    # voxelwise data is fit a chunk at a time
+    if ccalc_io.checkifnifti(inputfile):
+        if ccalc_io.checkifcifti(inputfile):
+            if maskfile is not None:
+                print("masks are not used with cifti input - fitting every grayordinate")
+            _glmfitciftifile(inputfile, outputroot, regressors, chunksize, nprocs)
+        else:
+            _glmfitniftifile(inputfile, outputroot, regressors, maskfile, chunksize, nprocs)
+        return
+
+    # read the datafile
+    tc_data = ccalc_io.readvecs(inputfile)
+    numtcs = tc_data.shape[0]
+    timepoints = tc_data.shape[1]
 
     for j in range(0, numregressors):
         if timepoints != len(evdata[j]):
             print("Input file and ev file ", j, " dimensions do not match")
             exit()
 
-    print("will perform GLM with ", numregressors, " regressors")
-    meandata = np.zeros((numtcs), dtype="float")
-    coefficient = np.zeros((numtcs, numregressors), dtype="float")
-    Rdata = np.zeros((numtcs), dtype="float")
-    component = np.zeros((numtcs, timepoints, numregressors), dtype="float")
-    thefit = np.zeros((numtcs, timepoints), dtype="float")
-    residuals = 1.0 * thefit
-    trimmeddata = 1.0 * tc_data[:, :]
     print("numtcs = ", numtcs)
     print("timepoints = ", timepoints)
     print("numregressors = ", numregressors)
 
-    for thetc in range(0, numtcs):
-        regressorvec = []
-        for j in range(0, numregressors):
-            regressorvec.append(evdata[j])
-        if np.max(trimmeddata[thetc, :]) - np.min(trimmeddata[thetc, :]) > 0.0:
-            thisfit, R = ccalc_fit.mlregress(regressorvec, trimmeddata[thetc, :])
-            meandata[thetc] = thisfit[0, 0]
-            Rdata[thetc] = R
-            for j in range(0, numregressors):
-                coefficient[thetc, j] = thisfit[0, j + 1]
-                component[thetc, :, j] = thisfit[0, j + 1] * regressorvec[j]
-        else:
-            meandata[thetc] = 0.0
-            Rdata[thetc] = 0.0
-            for j in range(0, numregressors):
-                coefficient[thetc, j] = 0.0
-                component[thetc, :, j] = 0.0 * regressorvec[j]
-        thefit[thetc, :] = np.sum(component[thetc, :, :], axis=1)
-        residuals[thetc, :] = trimmeddata[thetc, :] - thefit[thetc, :]
+    # fit all of the timecourses with any variance at once
+    trimmeddata = 1.0 * tc_data[:, :]
+    meandata, coefficient, Rdata, residuals = glmfit(trimmeddata, regressors)
+    thefit = coefficient @ regressors
 
     print("processing complete: about to save data")
 
@@ -110,9 +341,12 @@ def main():
         ccalc_io.writenpvecs(coefficient[:, j], outputroot + "_coefficient_" + str(j).zfill(2))
     ccalc_io.writenpvecs(Rdata, outputroot + "_R")
 
-    # now save the things with full timecourses
+    # now save the things with full timecourses - the components are made one at a time
     for j in range(0, numregressors):
-        ccalc_io.writenpvecs(component[:, :, j], outputroot + "_component_" + str(j).zfill(2))
+        ccalc_io.writenpvecs(
+            np.outer(coefficient[:, j], regressors[j, :]),
+            outputroot + "_component_" + str(j).zfill(2),
+        )
     ccalc_io.writenpvecs(thefit, outputroot + "_fit")
     ccalc_io.writenpvecs(residuals, outputroot + "_residuals")
 
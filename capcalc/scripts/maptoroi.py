@@ -16,13 +16,16 @@
 #   limitations under the License.
 #
 #
+import getopt
+
 from pylab import *
 
 import capcalc.io as ccalc_io
+import capcalc.utils as ccalc_utils
 
 
 def usage():
-    print("usage: maptoroi inputfile templatefile outputroot")
+    print("usage: maptoroi inputfile templatefile outputroot [--dtype=DTYPE] [--maskfile=MASK]")
     print("")
     print("required arguments:")
     print(
@@ -31,6 +34,11 @@ def usage():
     print("    templatefile     - the name of the template region file")
     print("    outputfile       - the name of the output nifti file")
     print("")
+    print("optional arguments:")
+    print("    --dtype=DTYPE    - write the output as DTYPE (float32 or float64).  Default is")
+    print("                       float64")
+    print("    --maskfile=MASK  - only write values to the voxels inside MASK")
+    print("")
     return ()
 
 
@@ -45,6 +53,33 @@ def main():
     templatefile = sys.argv[2]
     outputfile = sys.argv[3]
 
+    thedtype = "float64"
+    maskfile = None
+
+    # now scan for optional arguments
+    try:
+        opts, args = getopt.getopt(sys.argv[4:], "h", ["dtype=", "maskfile=", "help"])
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err))  # will print something like "option -x not recognized"
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == "--dtype":
+            if a not in ["float32", "float64"]:
+                print("dtype must be float32 or float64")
+                usage()
+                sys.exit()
+            thedtype = a
+        elif o == "--maskfile":
+            maskfile = a
+        elif o == "-h" or o == "--help":
+            usage()
+            exit()
+        else:
+            assert False, "unhandled option"
+
     print("loading data")
     theclustercenters = ccalc_io.readvecs(inputfilename)
     template_img, template_data, template_hdr, thedims, thesizes = ccalc_io.readfromnifti(
@@ -60,35 +95,41 @@ def main():
     numslices = thedims[3]
     numpatterns = thedims[4]
     numvoxels = int(xsize) * int(ysize) * int(numslices)
-    output_data = zeros((numvoxels, numclusters), dtype="float")
+
+    if maskfile is None:
+        themask = np.ones((xsize, ysize, numslices), dtype=bool)
+    else:
+        print("loading mask")
+        mask_img, mask_data, mask_hdr, maskdims, masksizes = ccalc_io.readfromnifti(maskfile)
+        if not ccalc_io.checkspacematch(mask_hdr, template_hdr):
+            print("mask does not match spatial coverage of the template file")
+            sys.exit()
+        themask = mask_data.reshape((xsize, ysize, numslices)) > 0
+    maskvoxels = np.flatnonzero(themask)
 
     # check to see if the template file has ROIs or networks
-    isroifile = True
     if numpatterns > 1:
-        # handle multipattern files
+        # each output map is the weighted sum of the network maps
         print("treating template as a network file")
-        templatevoxels = reshape(template_data, (numvoxels)).astype(int)
-        isroifile = False
+        if numpatterns != numregions:
+            print(f"template has {numpatterns} networks, but there are {numregions} regions")
+            sys.exit()
+        output_data = ccalc_utils.maskedprojection(
+            template_data.reshape((numvoxels, numpatterns))[maskvoxels, :], theclustercenters
+        )
     else:
+        # each voxel gets the values of its region
         print("treating template as an ROI file")
-        templatevoxels = reshape(template_data, (numvoxels, numpatterns))
-
-    for thecluster in range(numclusters):
-        print("processing cluster", thecluster)
-        if isroifile:
-            for i in range(1, numregions + 1):
-                output_data[where(templatevoxels == i), thecluster] = theclustercenters[
-                    i - 1, thecluster
-                ]
-        else:
-            output_data[:, thecluster] += (
-                theclustercenters[i - 1, thecluster] * templatevoxels[:, i]
-            )
-
-    theheader = template_hdr
-    theheader["dim"][4] = numclusters
-    ccalc_io.savetonifti(
-        output_data.reshape((xsize, ysize, numslices, numclusters)), theheader, outputfile
+        averager = ccalc_utils.RegionAverager(
+            template_data.reshape((numvoxels))[maskvoxels], numregions
+        )
+        output_data = np.zeros((len(maskvoxels), numclusters), dtype=thedtype)
+        averager.expand(theclustercenters, output_data)
+
+    theheader = template_hdr.copy()
+    theheader.set_data_dtype(thedtype)
+    ccalc_io.savemaskedtonifti(
+        output_data.astype(thedtype, copy=False), themask, theheader, outputfile
     )
 
 
@@ -17,11 +17,95 @@
 #
 #
 import getopt
+import glob
+import os
 
 from pylab import *
 
 import capcalc.io as ccalc_io
-import capcalc.miscmath as ccalc_math
+import capcalc.multiproc as ccalc_mp
+import capcalc.preprocess as ccalc_preproc
+import capcalc.utils as ccalc_utils
+
+# the SegmentNormalizer equivalent of each normalization method, apart from pctnorm
+NORMMETHODS = {"none": "None", "stdnorm": "stddev", "varnorm": "variance", "ppnorm": "p2p"}
+
+
+def normalizetimecourses(timecourses, normmethod):
+    r"""Normalize every region timecourse, in place.
+
+    Parameters
+    ----------
+    timecourses : 2D float array
+        The timecourses, with shape (regions, timepoints).  Modified in place.
+    normmethod : {'none', 'pctnorm', 'stdnorm', 'varnorm', 'ppnorm'}
+        The normalization.  All but pctnorm remove the mean and divide by the standard
+        deviation, variance or peak to peak range (if it is nonzero).  pctnorm converts
+        each timecourse to a fraction of its mean, if the mean is positive.
+
+    Returns
+    -------
+    timecourses : 2D float array
+        The normalized timecourses
+    """
+    if normmethod == "pctnorm":
+        themeans = np.mean(timecourses, axis=1)
+        ispositive = themeans > 0.0
+        timecourses[ispositive, :] = timecourses[ispositive, :] / themeans[ispositive, None] - 1.0
+    elif normmethod in NORMMETHODS:
+        ccalc_preproc.SegmentNormalizer(
+            normmethod=NORMMETHODS[normmethod], verbose=False
+        ).normalize(timecourses)
+    else:
+        print("illegal normalization method")
+        usage()
+        sys.exit()
+    return timecourses
+
+
+def extracttimecourses(inputfilename, inregion, averager, normmethod):
+    r"""Extract the normalized region timecourses from one 4D fmri file.
+
+    Parameters
+    ----------
+    inputfilename : str
+        The name of the fmri file
+    inregion : 3D bool array
+        True for the voxels in any region
+    averager : RegionAverager
+        The region index for the voxels in inregion
+    normmethod : str
+        The normalization (see normalizetimecourses)
+
+    Returns
+    -------
+    timecourses : 2D float array
+        The timecourses, with shape (regions, timepoints)
+    """
+    input_hdr, thedims, thesizes = ccalc_io.readniftiheader(inputfilename)
+    timecourses = np.zeros((averager.numregions, thedims[4]), dtype="float")
+    for startpt, theblock in ccalc_io.iterniftiblocks(inputfilename, inregion):
+        timecourses[:, startpt : startpt + theblock.shape[1]] = averager.means(theblock)
+    return normalizetimecourses(timecourses, normmethod)
+
+
+def batchfilelist(inputspec):
+    r"""Get the list of fmri files for a batch run.
+
+    Parameters
+    ----------
+    inputspec : str
+        Either a text file with one fmri file name per line, or a glob pattern
+
+    Returns
+    -------
+    filelist : list of str
+        The fmri file names (sorted, for a glob pattern)
+    """
+    if os.path.isfile(inputspec) and not ccalc_io.checkifnifti(inputspec):
+        with open(inputspec, "r") as thefile:
+            return [theline.strip() for theline in thefile if theline.strip() != ""]
+    return sorted(glob.glob(inputspec))
 
 
 def usage():
@@ -40,6 +124,17 @@ def usage():
     print("    --varnorm        - scale each timecourse to have a variance of 1.0")
     print("    --stdnorm        - scale each timecourse to have a standard deviation of 1.0")
     print("    --ppnorm         - scale each timecourse to have a peak to peak range of 1.0")
+    print("    --batch          - process many fmri files against the same template.  fmrifile")
+    print("                       is then a text file with one fmri file per line, or a quoted")
+    print("                       glob pattern, and outputfile is an output root.  The")
+    print("                       timecourses are saved together as OUTPUTROOT_timecourses.npy,")
+    print("                       with shape (files, regions, timepoints), and the file names")
+    print("                       as OUTPUTROOT_files.txt")
+    print("    --persubject     - in batch mode, also write each file's timecourses to")
+    print("                       OUTPUTROOT_subjNNNN.txt, where NNNN is the (zero based) line")
+    print("                       number of the file in OUTPUTROOT_files.txt")
+    print("    --nprocs=NPROCS  - in batch mode, process the files with NPROCS worker processes.")
+    print("                       NPROCS less than 1 uses one less than the number of cpus")
     print("")
     return ()
 
@@ -55,11 +150,26 @@ def main():  # get the command line parameters
     outputfile = sys.argv[3]
 
     normmethod = "none"
+    batchmode = False
+    persubject = False
+    nprocs = 1
 
     # now scan for optional arguments
     try:
         opts, args = getopt.getopt(
-            sys.argv[4:], "h", ["nonorm", "pctnorm", "varnorm", "stdnorm", "ppnorm", "help"]
+            sys.argv[4:],
+            "h",
+            [
+                "nonorm",
+                "pctnorm",
+                "varnorm",
+                "stdnorm",
+                "ppnorm",
+                "batch",
+                "persubject",
+                "nprocs=",
+                "help",
+            ],
         )
     except getopt.GetoptError as err:
         # print help information and exit:
@@ -78,6 +188,12 @@ def main():  # get the command line parameters
             normmethod = "varnorm"
         elif o == "--ppnorm":
             normmethod = "ppnorm"
+        elif o == "--batch":
+            batchmode = True
+        elif o == "--persubject":
+            persubject = True
+        elif o == "--nprocs":
+            nprocs = int(a)
         elif o == "-h" or o == "--help":
             usage()
             exit()
@@ -95,8 +211,6 @@ def main():  # get the command line parameters
     elif normmethod == "ppnorm":
         print("will normalize timecourses to p-p deviation of 1.0")
 
-    print("loading fmri data")
-    input_img, input_data, input_hdr, thedims, thesizes = ccalc_io.readfromnifti(inputfilename)
     print("loading template data")
     (
         template_img,
@@ -105,54 +219,87 @@ def main():  # get the command line parameters
         templatedims,
         templatesizes,
     ) = ccalc_io.readfromnifti(templatefile)
+    if batchmode:
+        inputfilenames = batchfilelist(inputfilename)
+        if len(inputfilenames) == 0:
+            print("no fmri files match", inputfilename)
+            sys.exit()
+        print(f"processing {len(inputfilenames)} fmri files")
+    else:
+        inputfilenames = [inputfilename]
 
     print("checking dimensions")
-    if not ccalc_io.checkspacematch(input_hdr, template_hdr):
-        print("template file does not match spatial coverage of input fmri file")
-        sys.exit()
+    numtimepoints = None
+    for thisfilename in inputfilenames:
+        input_hdr, thedims, thesizes = ccalc_io.readniftiheader(thisfilename)
+        if not ccalc_io.checkspacematch(input_hdr, template_hdr):
+            print(f"template file does not match spatial coverage of {thisfilename}")
+            sys.exit()
+        if numtimepoints is not None and thedims[4] != numtimepoints:
+            print(f"{thisfilename} does not have the same number of timepoints as the other files")
+            sys.exit()
+        numtimepoints = thedims[4]
 
-    print("reshaping")
+    print("indexing regions")
     xsize = thedims[1]
     ysize = thedims[2]
     numslices = thedims[3]
-    numtimepoints = thedims[4]
     numvoxels = int(xsize) * int(ysize) * int(numslices)
     templatevoxels = np.reshape(template_data, numvoxels).astype(int)
-    inputvoxels = np.reshape(input_data, (numvoxels, numtimepoints))
     numregions = np.max(templatevoxels)
-    timecourses = np.zeros((numregions, numtimepoints), dtype="float")
 
     if numtimepoints > 1:
+        # only the voxels in a region are read, a block of timepoints at a time
+        inregion = (templatevoxels > 0).reshape(template_data.shape[:3])
+        averager = ccalc_utils.RegionAverager(templatevoxels[templatevoxels > 0], numregions)
         for theregion in range(1, numregions + 1):
-            thevoxels = inputvoxels[np.where(templatevoxels == theregion), :]
-            print("extracting", thevoxels.shape[1], "voxels from region", theregion)
-            if thevoxels.shape[1] > 0:
-                regiontimecourse = np.nan_to_num(np.mean(thevoxels, axis=1))
-            else:
-                regiontimecourse = timecourses[0, :] * 0.0
-            if normmethod == "none":
-                timecourses[theregion - 1, :] = regiontimecourse - np.mean(regiontimecourse)
-            elif normmethod == "pctnorm":
-                timecourses[theregion - 1, :] = ccalc_math.pcnormalize(regiontimecourse)
-            elif normmethod == "varnorm":
-                timecourses[theregion - 1, :] = ccalc_math.varnormalize(regiontimecourse)
-            elif normmethod == "stdnorm":
-                timecourses[theregion - 1, :] = ccalc_math.stdnormalize(regiontimecourse)
-            elif normmethod == "ppnorm":
-                timecourses[theregion - 1, :] = ccalc_math.ppnormalize(regiontimecourse)
-            else:
-                print("illegal normalization method")
-                usage()
-                sys.exit()
-        ccalc_io.writenpvecs(timecourses, outputfile)
+            print(
+                "extracting", averager.regionsizes[theregion - 1], "voxels from region", theregion
+            )
+        if not batchmode:
+            print("loading fmri data")
+            ccalc_io.writenpvecs(
+                extracttimecourses(inputfilename, inregion, averager, normmethod), outputfile
+            )
+        else:
+            # the results are written into the consolidated file as each one finishes
+            ccalc_io.writevec(inputfilenames, outputfile + "_files.txt")
+            alltimecourses = np.lib.format.open_memmap(
+                outputfile + "_timecourses.npy",
+                mode="w+",
+                dtype=np.float64,
+                shape=(len(inputfilenames), int(numregions), int(numtimepoints)),
+            )
+            for thesubject, timecourses in ccalc_mp.iter_multiproc(
+                extracttimecourses,
+                [
+                    (thisfilename, inregion, averager, normmethod)
+                    for thisfilename in inputfilenames
+                ],
+                nprocs=nprocs,
+            ):
+                print(f"extracted timecourses from {inputfilenames[thesubject]}")
+                alltimecourses[thesubject, :, :] = timecourses
+                if persubject:
+                    # name by position in the file list, since files in different
+                    # directories often share a name
+                    ccalc_io.writenpvecs(
+                        timecourses, outputfile + "_subj" + str(thesubject).zfill(4) + ".txt"
+                    )
+            alltimecourses.flush()
+            del alltimecourses
+    elif batchmode:
+        print("batch mode needs 4D fmri files")
+        sys.exit()
     else:
-        outputvoxels = np.reshape(input_data, (numvoxels, numtimepoints))
-        for theregion in range(1, numregions + 1):
-            regionval = np.nan_to_num(np.mean(inputvoxels[np.where(templatevoxels == theregion)]))
-            outputvoxels[np.where(templatevoxels == theregion)] = regionval
-        template_hdr["dim"][4] = numregions
+        print("loading fmri data")
+        input_img, input_data, input_hdr, thedims, thesizes = ccalc_io.readfromnifti(inputfilename)
+        outputvoxels = np.reshape(input_data, (numvoxels))
+        averager = ccalc_utils.RegionAverager(templatevoxels, numregions)
+        averager.expand(averager.means(outputvoxels), outputvoxels)
+        template_hdr["dim"][4] = 1
         ccalc_io.savetonifti(
-            outputvoxels.reshape((xsize, ysize, numslices, numregions)),
+            outputvoxels.reshape((xsize, ysize, numslices)),
             template_hdr,
             outputfile,
         )
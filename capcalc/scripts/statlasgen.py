@@ -17,17 +17,76 @@
 #
 #
 import argparse
-import os
-import subprocess
 import sys
 
 import numpy as np
 
 import capcalc.filter as ccalc_filt
 import capcalc.io as ccalc_io
+import capcalc.multiproc as ccalc_mp
 import capcalc.parser_funcs as pf
 
 
+def labelhistograms(inputvoxels, numregions, thedtype=np.float64, blockvoxels=2**16):
+    r"""Calculate the normalized histogram of the labels in every voxel.
+
+    This gives the same values as calling np.histogram(thevoxel, bins=(numregions + 1),
+    range=[0, numregions], density=True) on each voxel with a positive label, but counts
+    a block of voxels at a time with a single bincount.
+
+    Parameters
+    ----------
+    inputvoxels : 2D array
+        The labels, with shape (voxels, samples)
+    numregions : int
+        The largest region label
+    thedtype : numpy dtype, optional
+        Data type of the histograms.  Default is float64.
+    blockvoxels : int, optional
+        Number of voxels to count at a time.  Default is 65536.
+
+    Returns
+    -------
+    outputhistogram : 2D array
+        The histogram density of labels 1 to numregions, with shape (voxels, numregions).
+        Voxels with no positive labels are 0.
+    histmask : 1D int array
+        1 for voxels with a positive label, 0 elsewhere
+    """
+    numvoxels = inputvoxels.shape[0]
+    numregions = int(numregions)
+    numbins = numregions + 1
+    binedges = np.linspace(0, numregions, numbins + 1)
+    binwidths = np.diff(binedges)
+    outputhistogram = np.zeros((numvoxels, numregions), dtype=thedtype)
+    histmask = np.zeros((numvoxels), dtype=int)
+    for startvox in range(0, numvoxels, blockvoxels):
+        endvox = min(startvox + blockvoxels, numvoxels)
+        thevoxels = np.asarray(inputvoxels[startvox:endvox, :], dtype=np.float64)
+        blockmask = np.max(thevoxels, axis=1) > 0
+
+        # find the histogram bin of each sample the way np.histogram does, with out of range
+        # values in an extra bin
+        inrange = (thevoxels >= 0.0) & (thevoxels <= numregions)
+        thebins = np.where(inrange, thevoxels * (numbins / numregions), 0).astype(np.int64)
+        thebins[thebins == numbins] = numbins - 1
+        thebins[inrange & (thevoxels < binedges[thebins])] -= 1
+        thebins[inrange & (thevoxels >= binedges[thebins + 1]) & (thebins != numbins - 1)] += 1
+        thebins[~inrange] = numbins
+        thebins += (numbins + 1) * np.arange(endvox - startvox, dtype=np.int64)[:, None]
+        thecounts = np.bincount(
+            thebins.ravel(), minlength=(endvox - startvox) * (numbins + 1)
+        ).reshape((endvox - startvox, numbins + 1))[:, :numbins]
+
+        thetotals = np.sum(thecounts, axis=1)
+        thetotals[~blockmask] = 1
+        outputhistogram[startvox:endvox, :] = np.where(
+            blockmask[:, None], thecounts[:, 1:] / binwidths[1:] / thetotals[:, None], 0.0
+        )
+        histmask[startvox:endvox] = blockmask
+    return outputhistogram, histmask
+
+
 def _get_parser():
     """
     Argument parser for atlastool
@@ -80,7 +139,10 @@ def _get_parser():
         action="store",
         type=lambda x: pf.is_valid_file(parser, x),
         metavar="TARGET",
-        help=("Match the resolution of TARGET"),
+        help=(
+            "Resample the atlas onto the voxel grid of TARGET, using the affines in the "
+            "nifti headers"
+        ),
         default=None,
     )
     parser.add_argument(
@@ -90,6 +152,8 @@ def _get_parser():
         help=("Output additional debugging information."),
         default=False,
     )
+    pf.adddtypeopts(parser)
+    pf.addmultiprocopts(parser)
 
     return parser
 
@@ -109,7 +173,7 @@ def main():
         input_hdr,
         inputdims,
         inputsizes,
-    ) = ccalc_io.readfromnifti(args.inputname)
+    ) = ccalc_io.readfromnifti(args.inputname, thedtype=args.dtype)
 
     print("reshaping")
     xsize, ysize, numslices, numtimepoints = ccalc_io.parseniftidims(inputdims)
@@ -121,26 +185,14 @@ def main():
         # array is already 4d, just reshape it
         numregions = np.floor(np.max(input_data)).astype(np.uint16)
         inputvoxels = np.reshape(input_data, (numvoxels, numtimepoints))
-        outputhistogram = np.zeros((numvoxels, numregions), dtype=float)
-        histmask = np.zeros((numvoxels), dtype=int)
     else:
         print("input file must be 4 dimensional.  Exiting.")
         sys.exit()
 
     # make histograms for all voxels
-    for thevoxel in range(numvoxels):
-        if np.max(inputvoxels[thevoxel, :]) > 0:
-            thehist, thebins = np.histogram(
-                inputvoxels[thevoxel, :],
-                bins=(numregions + 1),
-                range=[0, numregions],
-                density=True,
-            )
-            if args.debug:
-                print(len(thebins), thebins)
-                print(len(thehist), thehist)
-            outputhistogram[thevoxel, :] = thehist[1:]
-            histmask[thevoxel] = 1
+    outputhistogram, histmask = labelhistograms(inputvoxels, numregions, thedtype=args.dtype)
+    if args.debug:
+        print(f"{np.sum(histmask)} voxels have labels")
 
     # do spatial filtering if requested
     if args.gausssigma < 0.0:
@@ -149,57 +201,44 @@ def main():
     if args.gausssigma > 0.0:
         print(f"applying gaussian spatial filter with sigma={args.gausssigma}")
         rs_outputhistogram = outputhistogram.reshape((xsize, ysize, numslices, numregions))
-        for i in range(0, numregions):
-            rs_outputhistogram[:, :, :, i] = ccalc_filt.ssmooth(
-                xdim,
-                ydim,
-                slicethickness,
-                args.gausssigma,
-                rs_outputhistogram[:, :, :, i],
-            )
+        thesmoothedregions = ccalc_mp.iter_multiproc(
+            ccalc_filt.ssmooth,
+            [
+                (xdim, ydim, slicethickness, args.gausssigma, rs_outputhistogram[:, :, :, i])
+                for i in range(0, numregions)
+            ],
+            nprocs=args.nprocs,
+        )
+        for i, thesmoothedregion in thesmoothedregions:
+            rs_outputhistogram[:, :, :, i] = thesmoothedregion
 
     if args.targetfile is not None:
-        # do the resampling here
+        # do the resampling here - linear for the histograms, nearest neighbor for the mask
         print("resampling to new resolution")
-        fsldir = os.environ.get("FSLDIR")
-        if fsldir is not None:
-            # first write out a temp file with the data
-            outputvoxels = inputvoxels
-            input_hdr["dim"][4] = numregions
-            ccalc_io.savetonifti(
-                outputvoxels.reshape((xsize, ysize, numslices, numregions)),
-                input_hdr,
-                "temppre",
-            )
-            flirtcmd = os.path.join(fsldir, "bin", "flirt")
-            thecommand = []
-            thecommand.append(flirtcmd)
-            thecommand.append("-in")
-            thecommand.append("temppre")
-            thecommand.append("-ref")
-            thecommand.append(args.targetfile)
-            thecommand.append("-applyxfm")
-            thecommand.append("-init")
-            thecommand.append(os.path.join(fsldir, "data", "atlases", "bin", "eye.mat"))
-            thecommand.append("-out")
-            thecommand.append("temppost")
-            subprocess.call(thecommand)
-            (
-                input_img,
-                input_data,
-                input_hdr,
-                inputdims,
-                inputsizes,
-            ) = ccalc_io.readfromnifti("temppost")
-            xsize = inputdims[1]
-            ysize = inputdims[2]
-            numslices = inputdims[3]
-            numregions = inputdims[4]
-            numvoxels = int(xsize) * int(ysize) * int(numslices)
-            inputvoxels = np.around(np.reshape(input_data, (numvoxels, numregions))).astype("int")
-        else:
-            print("FSL directory not found - aborting")
-            sys.exit()
+        target_hdr, targetdims, targetsizes = ccalc_io.readniftiheader(args.targetfile)
+        targetshape = (int(targetdims[1]), int(targetdims[2]), int(targetdims[3]))
+        outputhistogram = ccalc_filt.affineresample(
+            outputhistogram.reshape((xsize, ysize, numslices, numregions)),
+            input_hdr.get_best_affine(),
+            target_hdr.get_best_affine(),
+            targetshape,
+            order=1,
+            nprocs=args.nprocs,
+        )
+        histmask = ccalc_filt.affineresample(
+            histmask.reshape((xsize, ysize, numslices)),
+            input_hdr.get_best_affine(),
+            target_hdr.get_best_affine(),
+            targetshape,
+            order=0,
+        )
+        xsize, ysize, numslices = targetshape
+        numvoxels = int(xsize) * int(ysize) * int(numslices)
+        outputhistogram = outputhistogram.reshape((numvoxels, numregions))
+        histmask = histmask.reshape((numvoxels))
+        outputdtype = input_hdr.get_data_dtype()
+        input_hdr = target_hdr.copy()
+        input_hdr.set_data_dtype(outputdtype)
 
     if args.volumeperregion:
         outputvoxels = outputhistogram
@@ -211,10 +250,9 @@ def main():
         )
     else:
         print("collapsing back to 3d")
-        outputvoxels = outputhistogram[:, 0] * 0
-        for i in range(numvoxels):
-            if histmask[i] > 0:
-                outputvoxels[i] = np.argmax(outputhistogram[i, :]) + 1
+        outputvoxels = np.where(histmask > 0, np.argmax(outputhistogram, axis=1) + 1, 0).astype(
+            outputhistogram.dtype
+        )
         input_hdr["dim"][4] = 1
         ccalc_io.savetonifti(
             outputvoxels.reshape((xsize, ysize, numslices)),
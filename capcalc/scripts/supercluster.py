@@ -253,6 +253,7 @@ def _get_parser():
         help="Output additional debugging information.",
         default=False,
     )
+    pf.adddtypeopts(parser)
     return parser
 
 
@@ -268,15 +269,8 @@ def main():
 
     print("Will perform", args.classifiertype, "classification")
 
-    # read in data
+    # read in data.  If there is a mask, only the voxels inside it or in a known class are read.
     print("reading in data arrays")
-    (
-        datafile_img,
-        datafile_data,
-        datafile_hdr,
-        datafiledims,
-        datafilesizes,
-    ) = ccalc_io.readfromnifti(args.datafilename)
     (
         classfile_img,
         classfile_data,
@@ -284,6 +278,11 @@ def main():
         classfiledims,
         classfilesizes,
     ) = ccalc_io.readfromnifti(args.classfilename)
+    if not classfiledims[4] == 1:
+        print("class file must have time dimension of 1")
+        exit()
+    rs_classfile = classfile_data.reshape((-1))
+    knownmask = rs_classfile > 0
     if args.maskfilename is not None:
         (
             datamask_img,
@@ -292,6 +291,22 @@ def main():
             datamaskdims,
             datamasksizes,
         ) = ccalc_io.readfromnifti(args.maskfilename)
+        if not datamaskdims[4] == 1:
+            print("input mask time must have time dimension of 1")
+            exit()
+        procmask = datamask_data.reshape((-1)) > 0.9
+        readmask = np.logical_or(procmask, knownmask)
+        readdata, datafile_hdr, datafiledims, datafilesizes = ccalc_io.readmaskedfromnifti(
+            args.datafilename, readmask, thedtype=args.dtype
+        )
+    else:
+        (
+            datafile_img,
+            datafile_data,
+            datafile_hdr,
+            datafiledims,
+            datafilesizes,
+        ) = ccalc_io.readfromnifti(args.datafilename, thedtype=args.dtype)
 
     xsize, ysize, numslices, timepoints = ccalc_io.parseniftidims(datafiledims)
     xdim, ydim, slicethickness, tr = ccalc_io.parseniftisizes(datafilesizes)
@@ -301,46 +316,46 @@ def main():
     if not ccalc_io.checkspacematch(datafile_hdr, classfile_hdr):
         print("target map spatial dimensions do not match image")
         exit()
-    if not classfiledims[4] == 1:
-        print("class file must have time dimension of 1")
-        exit()
 
     if args.maskfilename is not None:
         print("checking mask dimensions")
         if not ccalc_io.checkspacematch(datafile_hdr, datamask_hdr):
             print("input mask spatial dimensions do not match image")
             exit()
-        if not datamaskdims[4] == 1:
-            print("input mask time must have time dimension of 1")
-            exit()
 
     # allocating arrays
     print("reshaping arrays")
     numspatiallocs = int(xsize) * int(ysize) * int(numslices)
-    rs_datafile = datafile_data.reshape((numspatiallocs, timepoints))
-    rs_classfile = classfile_data.reshape((numspatiallocs))
 
     # find known data
     print("calculating knownlocs")
-    knownlocs = np.where(rs_classfile > 0)
+    knownlocs = np.where(knownmask)
 
     # mask the data
     print("masking arrays")
     if args.maskfilename is not None:
-        proclocs = np.where(datamask_data.reshape((numspatiallocs)) > 0.9)
+        # the rows of readdata are the voxels in readmask, in order
+        readrows = np.cumsum(readmask) - 1
+        proclocs = np.where(procmask)
+        X_known = readdata[readrows[knownmask], :]
+        X_predict = readdata[readrows[procmask], :]
+        readdata = None
     else:
+        rs_datafile = datafile_data.reshape((numspatiallocs, timepoints))
         themaxes = np.max(rs_datafile, axis=1)
         themins = np.min(rs_datafile, axis=1)
         thediffs = (themaxes - themins).reshape((numspatiallocs))
         proclocs = np.where(thediffs > 0.0)
+        X_known = rs_datafile[knownlocs, :][0]
+        X_predict = rs_datafile[proclocs, :][0]
+        rs_datafile = None
+        datafile_data = None
 
     # construct the arrays
     Y_known = rs_classfile[knownlocs]
 
-    X_known = rs_datafile[knownlocs, :][0]
-    X_predict = rs_datafile[proclocs, :][0]
-    print(rs_datafile.shape, X_known.shape, X_predict.shape, Y_known.shape)
-    n_features = rs_datafile.shape[1]
+    print((numspatiallocs, timepoints), X_known.shape, X_predict.shape, Y_known.shape)
+    n_features = timepoints
 
     print("data has", n_features, "features")
     if args.max_features == -1:
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2019-2025 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+A single file store for per segment state statistics, and an exporter to the original
+one file per result layout.
+"""
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+import capcalc.io as ccalc_io
+import capcalc.utils as ccalc_utils
+
+STATESTATSCOLS = [
+    "% TRs in state",
+    "Number of runs in state",
+    "Total TRs in state",
+    "Min run (TRs)",
+    "Max run (TRs)",
+    "Mean run (TRs)",
+    "Median run (TRs)",
+    "StdDev run (TRs)",
+]
+
+STATETIMESTATSCOLS = [
+    "% Seconds in state",
+    "Number of runs in state",
+    "Total seconds in state",
+    "Min run (sec)",
+    "Max run (sec)",
+    "Mean run (sec)",
+    "Median run (sec)",
+    "StdDev run (sec)",
+]
+
+SILHOUETTECOLS = ["Mean", "Median", "Min", "Max"]
+
+
+def segmentstorename(outputroot):
+    return outputroot + "_segments.npz"
+
+
+def writesegmentstore(
+    outputroot,
+    statelabels,
+    rawtransmats,
+    statestats,
+    sampletime,
+    silclusterstats=None,
+    debug=False,
+):
+    r"""Write all of the per segment results to a single file.
+
+    The file is an uncompressed numpy .npz archive in which every array has the segment
+    number as its first axis, so all segments are written at once and any one of them
+    can be read back without touching the others.
+
+    Parameters
+    ----------
+    outputroot : str
+        The root name of the output files.  The store is saved as OUTPUTROOT_segments.npz
+    statelabels : 2D int array
+        The state labels, with shape (numsegs, segsize)
+    rawtransmats : 3D float array
+        The transition counts, with shape (numsegs, n_clusters, n_clusters)
+    statestats : 3D float array
+        The state statistics in TRs, with shape (numsegs, n_clusters, 8)
+    sampletime : float
+        The time per TR in seconds
+    silclusterstats : 3D float array, optional
+        The per cluster silhouette statistics, with shape (numsegs, 4, n_clusters)
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    storename : str
+        The name of the file that was written
+    """
+    statelabels = np.asarray(statelabels)
+    rawtransmats = np.asarray(rawtransmats, dtype="float")
+    statestats = np.asarray(statestats, dtype="float")
+    numsegs, n_clusters = rawtransmats.shape[:2]
+
+    normtransmats = np.zeros_like(rawtransmats)
+    offdiagtransmats = np.zeros_like(rawtransmats)
+    for segment in range(numsegs):
+        normtransmats[segment], offdiagtransmats[segment] = ccalc_utils.calcmats(
+            rawtransmats[segment], n_clusters
+        )
+    statetimestats = 1.0 * statestats
+    statetimestats[:, :, 2:] *= sampletime
+
+    thearrays = {
+        "segment": np.arange(numsegs),
+        "sampletime": np.asarray(sampletime, dtype="float"),
+        "statelabels": statelabels,
+        "rawtransmat": rawtransmats,
+        "normtransmat": normtransmats,
+        "offdiagtransmat": offdiagtransmats,
+        "statestats": statestats,
+        "statestatscols": np.asarray(STATESTATSCOLS),
+        "statetimestats": statetimestats,
+        "statetimestatscols": np.asarray(STATETIMESTATSCOLS),
+    }
+    if silclusterstats is not None:
+        thearrays["silhouetteclusterstats"] = np.asarray(silclusterstats, dtype="float")
+        thearrays["silhouetteclusterstatscols"] = np.asarray(SILHOUETTECOLS)
+
+    storename = segmentstorename(outputroot)
+    if debug:
+        print(f"writing {numsegs} segments to {storename}")
+    np.savez(storename, **thearrays)
+    return storename
+
+
+def readsegmentstore(storename):
+    r"""Read a segment store written by writesegmentstore.
+
+    Parameters
+    ----------
+    storename : str
+        The name of the store file
+
+    Returns
+    -------
+    thestore : dict
+        The arrays in the store, keyed by name
+    """
+    with np.load(storename, allow_pickle=False) as thefile:
+        thestore = {key: thefile[key] for key in thefile.files}
+    return thestore
+
+
+def exportsegmentstore(storename, outputroot=None, statelabelfiletype="text", debug=False):
+    r"""Recreate the original per segment output files from a segment store.
+
+    Parameters
+    ----------
+    storename : str
+        The name of the store file
+    outputroot : str, optional
+        The root name of the output files.  Default is the root name the store was
+        written with.
+    statelabelfiletype : {'text', 'npy'}, optional
+        Format of the per segment state label files.  Default is 'text'.
+    debug : bool, optional
+        Print extended debugging information.
+    """
+    thestore = readsegmentstore(storename)
+    if outputroot is None:
+        if storename.endswith("_segments.npz"):
+            outputroot = storename[: -len("_segments.npz")]
+        else:
+            print("cannot infer the output root from", storename, "- specify it explicitly")
+            return
+    n_clusters = thestore["rawtransmat"].shape[1]
+    rows = []
+    cols = []
+    for i in range(n_clusters):
+        rows.append("from state " + str(i + 1))
+        cols.append("to state " + str(i + 1))
+    outputaffine = np.eye(4)
+    for segment in thestore["segment"]:
+        segroot = outputroot + "_seg_" + str(segment).zfill(4)
+        if debug:
+            print(f"exporting {segroot}")
+        init_img = nib.Nifti1Image(thestore["normtransmat"][segment], outputaffine)
+        init_hdr = init_img.header
+        for matname in ["rawtransmat", "normtransmat", "offdiagtransmat"]:
+            ccalc_io.savetonifti(
+                np.transpose(thestore[matname][segment]),
+                init_hdr,
+                segroot + "_" + matname,
+            )
+        for matname in ["rawtransmat", "normtransmat", "offdiagtransmat"]:
+            df = pd.DataFrame(data=thestore[matname][segment], columns=cols)
+            df.insert(0, "sources", pd.Series(rows))
+            df.to_csv(segroot + "_" + matname + ".csv", index=False)
+        for statname in ["statestats", "statetimestats"]:
+            df = pd.DataFrame(
+                data=thestore[statname][segment], columns=list(thestore[statname + "cols"])
+            )
+            df.to_csv(segroot + "_" + statname + ".csv", index=False)
+        thesestatelabels = thestore["statelabels"][segment]
+        ccalc_io.writenpvecs(
+            thesestatelabels,
+            segroot + "_statelabels.txt",
+            filetype=statelabelfiletype,
+        )
+        for state in range(n_clusters):
+            tc = np.where(thesestatelabels == state, 1, 0)
+            ccalc_io.writenpvecs(tc, segroot + "_instate_" + str(state).zfill(2) + ".txt")
+        if "silhouetteclusterstats" in thestore:
+            df = pd.DataFrame(
+                data=np.transpose(thestore["silhouetteclusterstats"][segment]),
+                columns=list(thestore["silhouetteclusterstatscols"]),
+            )
+            df.to_csv(segroot + "_silhouetteclusterstats.csv", index=False)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: latin-1 -*-
+#
+#   Copyright 2019-2025 Blaise Frederick
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""
+A content addressed, on disk cache for the results of pipeline stages.
+"""
+import hashlib
+import json
+import os
+
+import joblib
+
+
+def filechecksum(filename, blocksize=2**20):
+    r"""Calculate a checksum of the contents of a file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file
+    blocksize : int, optional
+        Number of bytes to read at a time.  Default is 1MB.
+
+    Returns
+    -------
+    checksum : str
+        The hexadecimal sha256 digest of the file contents
+    """
+    thehash = hashlib.sha256()
+    with open(filename, "rb") as thefile:
+        for theblock in iter(lambda: thefile.read(blocksize), b""):
+            thehash.update(theblock)
+    return thehash.hexdigest()
+
+
+def filtersignature(thefilter):
+    r"""Summarize the settings of a NoncausalFilter for use in a cache key.
+
+    Parameters
+    ----------
+    thefilter : NoncausalFilter or None
+        The filter
+
+    Returns
+    -------
+    thesignature : dict or None
+        The filter attributes that affect its output
+    """
+    if thefilter is None:
+        return None
+    return {
+        key: value
+        for key, value in sorted(vars(thefilter).items())
+        if key not in ["debug", "species"]
+    }
+
+
+class StageCache:
+    def __init__(self, cachedir=None, debug=False):
+        r"""Store and retrieve the results of pipeline stages, keyed by their inputs.
+
+        Each stage result is saved (with joblib) under a key that is a hash of the stage
+        name, the parameters that affect the result, the checksums of any input files, and
+        the keys of the stages it depends on.  A change to anything upstream therefore
+        changes every downstream key, and stale results are simply never looked up again.
+
+        Parameters
+        ----------
+        cachedir : str, optional
+            Directory in which to keep the cache.  If None, the cache is disabled: load
+            always returns None and save does nothing.
+        debug : bool, optional
+            Print extended debugging information.
+        """
+        self.cachedir = cachedir
+        self.debug = debug
+        self.checksums = {}
+        if self.cachedir is not None:
+            os.makedirs(self.cachedir, exist_ok=True)
+            self.checksumfile = os.path.join(self.cachedir, "filechecksums.json")
+            if os.path.isfile(self.checksumfile):
+                try:
+                    with open(self.checksumfile, "r") as thefile:
+                        self.checksums = json.load(thefile)
+                except (OSError, ValueError):
+                    self.checksums = {}
+
+    def enabled(self):
+        return self.cachedir is not None
+
+    def filesignature(self, filename):
+        r"""Get the content checksum of a file, reusing the stored value if the file's size
+        and modification time have not changed.
+
+        Parameters
+        ----------
+        filename : str
+            The name of the file.  None is passed through.
+
+        Returns
+        -------
+        checksum : str or None
+            The checksum of the file contents
+        """
+        if filename is None:
+            return None
+        fullname = os.path.abspath(filename)
+        thestat = os.stat(fullname)
+        entry = self.checksums.get(fullname, None)
+        if (
+            entry is None
+            or entry["size"] != thestat.st_size
+            or entry["mtime"] != thestat.st_mtime_ns
+        ):
+            if self.debug:
+                print(f"calculating checksum of {fullname}")
+            entry = {
+                "size": thestat.st_size,
+                "mtime": thestat.st_mtime_ns,
+                "checksum": filechecksum(fullname),
+            }
+            self.checksums[fullname] = entry
+            if self.enabled():
+                with open(self.checksumfile, "w") as thefile:
+                    json.dump(self.checksums, thefile, indent=4, sort_keys=True)
+        return entry["checksum"]
+
+    def key(self, stagename, params, inputfiles=[], parentkeys=[]):
+        r"""Construct the cache key for a stage.
+
+        Parameters
+        ----------
+        stagename : str
+            Name of the stage
+        params : dict
+            The parameters that affect the stage result.  Values must be representable
+            in json (anything else is converted with repr).
+        inputfiles : list of str, optional
+            Files read by the stage.  Their contents, rather than their names, go into
+            the key.
+        parentkeys : list of str, optional
+            Keys of the stages whose results this stage uses.
+
+        Returns
+        -------
+        thekey : str
+            The key (a hexadecimal sha256 digest)
+        """
+        if not self.enabled():
+            return None
+        thedescription = {
+            "stage": stagename,
+            "params": params,
+            "inputfiles": [self.filesignature(thefile) for thefile in inputfiles],
+            "parents": list(parentkeys),
+        }
+        thekey = hashlib.sha256(
+            json.dumps(thedescription, sort_keys=True, default=repr).encode("utf-8")
+        ).hexdigest()
+        if self.debug:
+            print(f"cache key for {stagename}: {thekey}")
+        return thekey
+
+    def _stagefile(self, stagename, thekey):
+        return os.path.join(self.cachedir, stagename, f"{thekey}.joblib")
+
+    def load(self, stagename, thekey):
+        r"""Retrieve the stored result of a stage.
+
+        Parameters
+        ----------
+        stagename : str
+            Name of the stage
+        thekey : str
+            The key returned by key()
+
+        Returns
+        -------
+        theresult : object or None
+            The stored result, or None if there is none (or the cache is disabled)
+        """
+        if not self.enabled():
+            return None
+        thefilename = self._stagefile(stagename, thekey)
+        if not os.path.isfile(thefilename):
+            print(f"no cached result for {stagename} - calculating")
+            return None
+        try:
+            theresult = joblib.load(thefilename)
+        except Exception as ex:
+            template = (
+                "An exception of type {0} occurred when trying to open {1}. Arguments:\n{2!r}"
+            )
+            message = template.format(type(ex).__name__, thefilename, ex.args)
+            print(message)
+            print(f"ignoring cached result for {stagename}")
+            return None
+        print(f"using cached result for {stagename} from {thefilename}")
+        return theresult
+
+    def save(self, stagename, thekey, theresult):
+        r"""Store the result of a stage.
+
+        Parameters
+        ----------
+        stagename : str
+            Name of the stage
+        thekey : str
+            The key returned by key()
+        theresult : object
+            Anything joblib can save
+        """
+        if not self.enabled():
+            return
+        thefilename = self._stagefile(stagename, thekey)
+        os.makedirs(os.path.dirname(thefilename), exist_ok=True)
+
+        # write to a temporary name first so an interrupted run never leaves a partial entry
+        tempname = f"{thefilename}.{os.getpid()}.tmp"
+        try:
+            joblib.dump(theresult, tempname)
+            os.replace(tempname, thefilename)
+        except OSError as ex:
+            print(f"could not save {stagename} to the cache: {ex}")
+            if os.path.isfile(tempname):
+                os.remove(tempname)
+        if self.debug:
+            print(f"saved {stagename} to {thefilename}")
@@ -16,53 +16,192 @@
 #   limitations under the License.
 #
 #
+import sys
+
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.sparse as ss
 from sklearn import metrics
 
 
 def statefilter(thestates, minlength, minhold, debug=False):
+    # Runs of a state shorter than minlength that return to the previous state are patched
+    # to the previous state, and runs shorter than minhold that go to a new state are filled
+    # with the previous state.  The decisions are only made where the label changes, so the
+    # stretches between raw label changes (found all at once) are copied over as blocks.
     print("state filtering with length", minlength)
-    thefiltstates = np.zeros((len(thestates)), dtype=int)
-    thefiltstates[0] = thestates[0]
+    thestatearray = np.asarray(thestates)
+    numpoints = len(thestatearray)
+    thefiltstates = np.zeros((numpoints), dtype=int)
+    thefiltstates[0] = thestatearray[0]
+    if (minlength <= 1) and (minhold <= 1) and not debug:
+        # no run can be shorter than 1 point, so there is nothing to filter
+        thefiltstates[:] = thestatearray
+        return thefiltstates
+
+    # runend[i] is the index just past the run of identical raw labels containing point i
+    rawrunbounds = np.concatenate(([0], np.flatnonzero(np.diff(thestatearray)) + 1, [numpoints]))
+    runend = np.repeat(rawrunbounds[1:], np.diff(rawrunbounds)).tolist()
+    thestates = thestatearray.tolist()
+
     currentstate = thestates[0]
     laststate = currentstate + 0
     currentlen = 1
     lastlen = 1
-    for state in range(1, len(thestates)):
+    state = 1
+    while state < numpoints:
         if thestates[state] == currentstate:
-            currentlen += 1
-            thefiltstates[state] = thestates[state]
+            thisend = runend[state]
+            thefiltstates[state:thisend] = thestatearray[state:thisend]
+            if debug:
+                for i in range(state, thisend):
+                    print("state", i, "(", thestates[i], "):continue")
+            currentlen += thisend - state
+            state = thisend
+            continue
+        if (currentlen < minlength) and (thestates[state] == laststate):
+            thefiltstates[state - currentlen : state + 1] = laststate
+            currentstate = laststate + 0
+            currentlen += lastlen
+            if debug:
+                print("state", state, "(", thestates[state], "):patch")
+        elif (currentlen < minhold) and (thestates[state] != laststate):
+            thefiltstates[state - currentlen : state + 1] = laststate
+            currentstate = laststate + 0
+            currentlen += lastlen
             if debug:
-                print("state", state, "(", thestates[state], "):continue")
+                print("state", state, "(", thestates[state], "):fill")
         else:
-            if (currentlen < minlength) and (thestates[state] == laststate):
-                thefiltstates[state - currentlen : state + 1] = laststate
-                currentstate = laststate + 0
-                currentlen += lastlen
-                if debug:
-                    print("state", state, "(", thestates[state], "):patch")
-            elif (currentlen < minhold) and (thestates[state] != laststate):
-                thefiltstates[state - currentlen : state + 1] = laststate
-                currentstate = laststate + 0
-                currentlen += lastlen
-                if debug:
-                    print("state", state, "(", thestates[state], "):fill")
-            else:
-                lastlen = currentlen + 1
-                currentlen = 1
-                laststate = currentstate + 0
-                currentstate = thestates[state]
-                thefiltstates[state] = thestates[state]
-                if debug:
-                    print("state", state, "(", thestates[state], "):switch")
+            lastlen = currentlen + 1
+            currentlen = 1
+            laststate = currentstate + 0
+            currentstate = thestates[state]
+            thefiltstates[state] = thestates[state]
+            if debug:
+                print("state", state, "(", thestates[state], "):switch")
+        state += 1
     if debug:
         for state in range(len(thestates)):
             print(state, thestates[state], thefiltstates[state])
     return thefiltstates
 
 
+def statestats_batch(thestates, numlabels, minlabel, minout=1, minhold=1, debug=False):
+    r"""Calculate transition matrices and run length statistics for a set of segments.
+
+    Each segment is state filtered (see statefilter), then the label sequence is run
+    length encoded, and everything is calculated from the runs.  The results for each
+    segment are identical to those of statestats.
+
+    Parameters
+    ----------
+    thestates : 2D int array
+        The state labels, with shape (numsegs, segsize)
+    numlabels : int
+        The number of states
+    minlabel : int
+        The value of the lowest state label
+    minout : int, optional
+        Minimum length of an excursion to another state (see statefilter).  Default is 1.
+    minhold : int, optional
+        Minimum time in a new state (see statefilter).  Default is 1.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    transmats : 3D float array
+        transmats[seg, a, b] is the number of transitions from state a to state b
+    thestats : 3D float array
+        The run statistics for each segment and state, with shape (numsegs, numlabels, 8).
+        The columns are the percentage of TRs in the state, the number of runs, the total
+        TRs in the state, and the minimum, maximum, mean, median, and standard deviation of
+        the run lengths.
+    lenlists : list
+        lenlists[seg][state] is the list of run lengths in that state, in time order
+    """
+    thestates = np.asarray(thestates)
+    numsegs, segsize = thestates.shape
+    thefiltstates = np.zeros((numsegs, segsize), dtype=int)
+    for segment in range(numsegs):
+        thefiltstates[segment, :] = statefilter(
+            thestates[segment, :], minout, minhold, debug=debug
+        )
+    thefiltstates -= minlabel
+
+    # transitions between every pair of consecutive points
+    transmats = np.zeros((numsegs, numlabels, numlabels), dtype="float")
+    np.add.at(
+        transmats,
+        (
+            np.repeat(np.arange(numsegs), segsize - 1),
+            thefiltstates[:, :-1].ravel(),
+            thefiltstates[:, 1:].ravel(),
+        ),
+        1.0,
+    )
+
+    # run length encode each segment.  Each run is identified by its segment and state, so
+    # sorting runs (stably) on that gives the runs in each group in time order.
+    isstart = np.ones((numsegs, segsize), dtype=bool)
+    isstart[:, 1:] = thefiltstates[:, 1:] != thefiltstates[:, :-1]
+    runstarts = np.flatnonzero(isstart)
+    runlens = np.diff(np.append(runstarts, numsegs * segsize))
+    rungroups = (runstarts // segsize) * numlabels + thefiltstates.ravel()[runstarts]
+    order = np.argsort(rungroups, kind="stable")
+    grouplens = runlens[order].astype("float")
+    counts = np.bincount(rungroups, minlength=numsegs * numlabels)
+    groupstarts = np.cumsum(counts) - counts
+    occupied = np.flatnonzero(counts > 0)
+
+    sortedrunlens = runlens[order].tolist()
+    groupbounds = np.append(groupstarts, len(sortedrunlens)).tolist()
+    lenlists = []
+    for segment in range(numsegs):
+        lenlists.append([])
+        for state in range(numlabels):
+            thegroup = segment * numlabels + state
+            lenlists[segment].append(
+                sortedrunlens[groupbounds[thegroup] : groupbounds[thegroup + 1]]
+            )
+
+    # grouped reductions, done the same way as the numpy functions in statestats
+    thestats = np.zeros((numsegs * numlabels, 8), dtype="float")
+    if len(occupied) > 0:
+        thecounts = counts[occupied]
+        thesums = np.add.reduceat(grouplens, groupstarts[occupied])
+        themeans = thesums / thecounts
+        thestats[occupied, 0] = 100.0 * thesums / segsize
+        thestats[occupied, 1] = thecounts
+        thestats[occupied, 2] = thesums
+        thestats[occupied, 3] = np.minimum.reduceat(grouplens, groupstarts[occupied])
+        thestats[occupied, 4] = np.maximum.reduceat(grouplens, groupstarts[occupied])
+        thestats[occupied, 5] = themeans
+        # the median of each group, from the run lengths sorted within each group
+        sortedlens = grouplens[np.lexsort((grouplens, rungroups[order]))]
+        lowmid = groupstarts[occupied] + (thecounts - 1) // 2
+        highmid = groupstarts[occupied] + thecounts // 2
+        themedians = (sortedlens[lowmid] + sortedlens[highmid]) / 2.0
+
+        # statestats only calculates the median and standard deviation with 3 or more runs.
+        # The standard deviations are calculated for all groups with the same number of runs
+        # at once, since np.std along rows sums in the same order as np.std on each group.
+        many = thecounts > 2
+        thestats[occupied[many], 6] = themedians[many]
+        for thecount in np.unique(thecounts[many]):
+            thesegroups = occupied[thecounts == thecount]
+            thestats[thesegroups, 7] = np.std(
+                grouplens[groupstarts[thesegroups][:, None] + np.arange(thecount)[None, :]],
+                axis=1,
+            )
+        two = thecounts == 2
+        thestats[occupied[two], 6] = grouplens[groupstarts[occupied[two]] + 1]
+        one = thecounts == 1
+        thestats[occupied[one], 6] = themeans[one]
+    return transmats, thestats.reshape((numsegs, numlabels, 8)), lenlists
+
+
 def statestats(thestates, numlabels, minlabel, minout=1, minhold=1, debug=False):
     # returns statestats and transmat
     #
@@ -79,81 +218,152 @@ def statestats(thestates, numlabels, minlabel, minout=1, minhold=1, debug=False)
     # transmat contains an n_states by n_states matrix:
     #     the number of transitions from state a to state b is in location [a, b]
     #
-    minlabel = minlabel
-    maxlabel = minlabel + numlabels - 1
-    numlabels = maxlabel - minlabel + 1
-    transmat = np.zeros((numlabels, numlabels), dtype="float")
+    # this is a single segment call to statestats_batch
+    transmats, thestats, lenlists = statestats_batch(
+        np.asarray(thestates).reshape((1, -1)),
+        numlabels,
+        minlabel,
+        minout=minout,
+        minhold=minhold,
+        debug=debug,
+    )
+    return transmats[0], thestats[0], lenlists[0]
 
-    # prefilter
-    thestates = statefilter(thestates, minout, minhold, debug=debug)
 
-    # now tabulate states
-    currentstate = thestates[0]
-    currentlen = 1
-    lenlist = [[]]
-    for i in range(numlabels - 1):
-        lenlist.append([])
-    for state in range(1, len(thestates)):
-        if thestates[state] == currentstate:
-            currentlen += 1
-        else:
-            lenlist[currentstate - minlabel].append(currentlen)
-            currentstate = thestates[state]
-            currentlen = 1
-        sourcestate = thestates[state - 1] - minlabel
-        deststate = thestates[state] - minlabel
-        transmat[sourcestate, deststate] += 1.0
-
-    # for debugging - remove!
-    # for i in range(numlabels):
-    #    transmat[0, i] = i
-
-    lenlist[currentstate - minlabel].append(currentlen)
-    thestats = []
-    for i in range(numlabels):
-        lenarray = np.asarray(lenlist[i], dtype="float")
-        if len(lenarray) > 2:
-            thestats.append(
-                [
-                    100.0 * np.sum(lenarray) / len(thestates),
-                    len(lenarray),
-                    np.sum(lenarray),
-                    np.min(lenarray),
-                    np.max(lenarray),
-                    np.mean(lenarray),
-                    np.median(lenarray),
-                    np.std(lenarray),
-                ]
-            )
-        elif len(lenarray) > 1:
-            thestats.append(
-                [
-                    100.0 * np.sum(lenarray) / len(thestates),
-                    len(lenarray),
-                    np.sum(lenarray),
-                    np.min(lenarray),
-                    np.max(lenarray),
-                    np.mean(lenarray),
-                    lenarray[1],
-                    0.0,
-                ]
-            )
-        elif len(lenarray) > 0:
-            thestats.append(
-                [
-                    100.0 * np.sum(lenarray) / len(thestates),
-                    len(lenarray),
-                    np.sum(lenarray),
-                    lenarray[0],
-                    lenarray[0],
-                    lenarray[0],
-                    lenarray[0],
-                    0.0,
-                ]
+def maskedprojection(thebasis, theweights, themask=None, debug=False):
+    r"""Project weights on a set of spatial basis maps back into image space.
+
+    Output map j is the sum over i of theweights[i, j] * thebasis[..., i].  Only the
+    voxels in the mask are computed, as a single (nvoxels x n_basis) by
+    (n_basis x n_maps) matrix product that is then scattered into the output array.
+
+    Parameters
+    ----------
+    thebasis : array
+        The basis maps, with the map index last, e.g. (xsize, ysize, numslices, n_basis)
+        for a set of NIfTI component maps or (numvoxels, n_basis) for a flattened set.
+    theweights : 2D array
+        The weights, with shape (n_basis, n_maps)
+    themask : array, optional
+        Nonzero for the voxels to compute.  Must have the same number of elements as one
+        basis map.  If None, every voxel where any basis map is nonzero is used.
+    debug : bool, optional
+        Print extended debugging information.
+
+    Returns
+    -------
+    theprojection : array
+        The projected maps, with the spatial shape of thebasis and n_maps as the last
+        dimension.  Voxels outside the mask are zero.
+    """
+    theweights = np.asarray(theweights)
+    spatialshape = thebasis.shape[:-1]
+    n_basis = thebasis.shape[-1]
+    if theweights.shape[0] != n_basis:
+        print(
+            f"maskedprojection: {theweights.shape[0]} weights per map do not match {n_basis} basis maps"
+        )
+        sys.exit()
+    flatbasis = thebasis.reshape((-1, n_basis))
+    if themask is None:
+        thevoxels = np.flatnonzero(np.any(flatbasis != 0.0, axis=1))
+    else:
+        thevoxels = np.flatnonzero(np.asarray(themask).reshape(-1))
+    if debug:
+        print(
+            f"maskedprojection: projecting {theweights.shape[1]} maps from {n_basis} basis maps in {len(thevoxels)} voxels"
+        )
+    theprojection = np.zeros(
+        (flatbasis.shape[0], theweights.shape[1]), dtype=np.result_type(flatbasis, theweights)
+    )
+    theprojection[thevoxels, :] = flatbasis[thevoxels, :] @ theweights
+    return theprojection.reshape(spatialshape + (theweights.shape[1],))
+
+
+class RegionAverager:
+    def __init__(self, thelabels, numregions=None):
+        r"""Average data over labelled regions.
+
+        The labels are indexed once, as a sparse (regions x voxels) matrix of the
+        weights 1 / (region size), so the means of all regions at all timepoints are a
+        single sparse matrix product.  The same averager can be applied to any number of
+        datasets (or blocks of timepoints) that share the labels.
+
+        Parameters
+        ----------
+        thelabels : 1D array
+            The region label of each voxel.  Regions are numbered from 1; voxels with
+            labels less than 1 (or greater than numregions) are not in any region.
+        numregions : int, optional
+            The number of regions.  Default is the largest label.
+        """
+        thelabels = np.rint(np.asarray(thelabels).reshape(-1)).astype(np.int64)
+        if numregions is None:
+            numregions = int(np.max([0, np.max(thelabels)]))
+        self.numregions = numregions
+        self.numvoxels = len(thelabels)
+        self.voxels = np.flatnonzero((thelabels >= 1) & (thelabels <= numregions))
+        self.labels = thelabels[self.voxels]
+        self.regionsizes = np.bincount(self.labels - 1, minlength=numregions)
+        self.weights = ss.csr_matrix(
+            (
+                1.0 / self.regionsizes[self.labels - 1],
+                (self.labels - 1, self.voxels),
+            ),
+            shape=(numregions, self.numvoxels),
+        )
+
+    def means(self, thedata, blockpoints=None):
+        r"""Calculate the mean of every region.
+
+        Parameters
+        ----------
+        thedata : 1D or 2D array
+            The data, with shape (voxels,) or (voxels, timepoints)
+        blockpoints : int, optional
+            Number of timepoints to average at a time, to bound the size of the
+            temporaries.  Default is to do them all at once.
+
+        Returns
+        -------
+        themeans : 1D or 2D float64 array
+            The region means, with shape (numregions,) or (numregions, timepoints).  Empty
+            regions, and timepoints where a region contains a nan, are 0.
+        """
+        if thedata.shape[0] != self.numvoxels:
+            print(f"RegionAverager: data has {thedata.shape[0]} voxels, expected {self.numvoxels}")
+            sys.exit()
+        if thedata.ndim == 1:
+            return self.means(thedata.reshape((-1, 1)), blockpoints=blockpoints)[:, 0]
+        numpoints = thedata.shape[1]
+        if blockpoints is None:
+            blockpoints = np.max([1, numpoints])
+        themeans = np.zeros((self.numregions, numpoints), dtype=np.float64)
+        for startpt in range(0, numpoints, blockpoints):
+            endpt = np.min([startpt + blockpoints, numpoints])
+            themeans[:, startpt:endpt] = self.weights @ np.asarray(
+                thedata[:, startpt:endpt], dtype=np.float64
             )
-        else:
-            thestats.append([0.0, len(lenarray), 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
-    return transmat, np.asarray(thestats, dtype="float"), lenlist
+        return np.nan_to_num(themeans, copy=False)
+
+    def expand(self, themeans, thedata):
+        r"""Replace the value in each voxel with the value of its region.
+
+        Parameters
+        ----------
+        themeans : 1D or 2D array
+            The region values, as returned by means
+        thedata : 1D or 2D array
+            The voxel data.  Voxels inside a region are overwritten in place; the others
+            are left alone.
+
+        Returns
+        -------
+        thedata : 1D or 2D array
+            The modified data
+        """
+        thedata[self.voxels] = np.asarray(themeans, dtype=thedata.dtype)[self.labels - 1]
+        return thedata
 
 
 def calcmats(rawtransmat, n_clusters):